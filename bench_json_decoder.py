@@ -0,0 +1,57 @@
+#!/bin/python3
+
+import argparse
+import bz2
+import gc
+import itertools
+import time
+
+import json_decoder
+from import_wikidata import preparse_entity
+
+
+def read_samples(dump, limit):
+  """The first limit entity lines of a wikidata json dump, as they're passed to the decoder."""
+  samples = []
+  with (bz2.open(dump, 'rb') if dump.endswith('.bz2') else open(dump, 'rb')) as f:
+    for line in itertools.islice(f, limit + 2):
+      line = line.strip()
+      if line[:1] == b'{':
+        samples.append(line[:-1] if line[-1:] == b',' else line)
+  return samples[:limit]
+
+
+def measure(name, fn, samples, size):
+  gc.collect()
+  start = time.perf_counter()
+  for sample in samples:
+    fn(sample)
+  elapsed = time.perf_counter() - start
+  print('%-22s %9.0f entities/s %8.1f MB/s %8.1f us/entity' % (
+      name, len(samples) / elapsed, size / elapsed / 1e6, elapsed / len(samples) * 1e6))
+
+
+def main(dump, limit, repeat):
+  samples = read_samples(dump, limit)
+  size = sum(len(sample) for sample in samples)
+  print('%d entities, %.1f kB on average' % (len(samples), size / len(samples) / 1e3))
+  expected = [preparse_entity(json_decoder.project(json_decoder.Decoder('json').loads(s))) for s in samples]
+  for name in json_decoder.available():
+    decoder = json_decoder.Decoder(name)
+    # what the importer gets out of the entity has to be the same whatever decodes it
+    actual = [preparse_entity(decoder.loads_entity(s)) for s in samples]
+    if actual != expected:
+      print('%s: %d entities differ from json' % (name, sum(1 for a, b in zip(actual, expected) if a != b)))
+    for _ in range(repeat):
+      measure(name + ' loads', decoder.loads, samples, size)
+      measure(name + ' loads_entity', decoder.loads_entity, samples, size)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the json backends on entities from a wikidata dump')
+  parser.add_argument('dump', type=str, help='latest-all.json, optionally bzipped')
+  parser.add_argument('--limit', type=int, default=20000, help='entities to decode')
+  parser.add_argument('--repeat', type=int, default=1, help='times to run each measurement')
+
+  args = parser.parse_args()
+  main(args.dump, args.limit, args.repeat)
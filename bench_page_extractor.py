@@ -0,0 +1,76 @@
+#!/bin/python3
+
+import argparse
+import bz2
+import io
+import random
+import time
+
+from import_wikipedia import extract_pages, read_pages
+
+PAGE = """  <page>
+    <title>%(title)s</title>
+    <ns>0</ns>
+    <id>%(id)d</id>
+    <revision>
+      <id>%(revision)d</id>
+      <timestamp>2016-08-15T06:01:51Z</timestamp>
+      <contributor>
+        <username>Someone</username>
+        <id>9092818</id>
+      </contributor>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text xml:space="preserve">%(text)s</text>
+      <sha1>az60vahaazg403faw6x2gzpbmiws0o3</sha1>
+    </revision>
+  </page>
+"""
+
+LINE = "'''%s''' is a [[political philosophy]] that &lt;ref&gt;{{cite book|title=%s}}&lt;/ref&gt; advocates [[self-governance|self-governed]] societies.\n"
+
+
+def synthetic_dump(pages, seed=1):
+  rnd = random.Random(seed)
+  parts = ['<mediawiki xml:lang="en">\n']
+  for i in range(pages):
+    title = 'Page %d' % i
+    text = ''.join(LINE % (title, rnd.random()) for _ in range(rnd.randint(5, 150)))
+    text += '[[Category:Things in %s]]' % title
+    parts.append(PAGE % {'title': title, 'id': i, 'revision': i + 1000, 'text': text})
+  parts.append('</mediawiki>\n')
+  return ''.join(parts).encode('utf-8')
+
+
+def measure(name, pages_fn, count_bytes):
+  start = time.perf_counter()
+  pages = sum(1 for _ in pages_fn())
+  elapsed = time.perf_counter() - start
+  print('%-5s %8d pages %7.2fs %10.0f pages/s %8.1f MB/s %8.1f us/page' % (
+      name, pages, elapsed, pages / elapsed, count_bytes / elapsed / 1e6, elapsed / pages * 1e6))
+  return elapsed / pages
+
+
+def main(dump, pages, buffer_size):
+  if dump:
+    with (bz2.open(dump, 'rb') if dump.endswith('.bz2') else open(dump, 'rb')) as f:
+      data = f.read()
+  else:
+    data = synthetic_dump(pages)
+  # both read from memory, so this only measures the page parsing, not the decompression
+  sax = measure('sax', lambda: read_pages(io.BytesIO(data)), len(data))
+  fast = measure('fast', lambda: extract_pages(io.BytesIO(data), buffer_size), len(data))
+  print('fast saves %.1f us per page (%.1fx)' % ((sax - fast) * 1e6, sax / fast))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the page extractor with the xml.sax reader')
+  parser.add_argument('--dump', type=str, default=None,
+                      help='pages-articles xml (optionally bzipped) to read, a synthetic dump if not given')
+  parser.add_argument('--pages', type=int, default=20000,
+                      help='pages in the synthetic dump')
+  parser.add_argument('--buffer_size', type=int, default=4 * 1024 * 1024,
+                      help='read size of the page extractor')
+
+  args = parser.parse_args()
+  main(args.dump, args.pages, args.buffer_size)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+"""Throughput of each stage of the importers on synthetic dumps from dump_generators: decompress, parse,
+transform and load, in pages (entities, revisions, pageview lines) per second and MB of decompressed dump per
+second.
+
+The stages run one after the other over the whole dump, each on what the stage before it produced, so each one
+is timed on its own rather than as part of a pipeline where the slowest one sets the pace. They call the same
+functions the importers do. Loading goes to a null sink, which only counts the rows, or with --postgres into
+the tables the importers load. Use a scratch database for that, the benchmark empties those tables.
+
+Every run appends its results to a json lines file, with the commit it ran on, so --compare can show how the
+rates changed since the last run on another commit (or on this one, before the changes that aren't committed
+yet) with the same settings.
+"""
+
+import argparse
+import datetime
+import gc
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+import psycopg2
+
+import dump_generators
+import id_name_store
+import import_stats
+import import_wikidata
+import import_wikipedia
+import json_decoder
+import page_extractor
+import wd_updater
+
+# the size of each dump at --scale 1, about a minute for all four importers
+SCALE = {'pages': 2000, 'entities': 5000, 'revisions': 2000, 'hours': 2, 'lines': 100000}
+IMPORTERS = ('import_wikipedia', 'import_wikidata', 'wd_updater', 'import_stats')
+STAGES = ('decompress', 'parse', 'transform', 'load')
+RESULTS_FILE = 'benchmarks.jsonl'
+# where wd_updater applies its revisions with --postgres
+UPDATER_SCHEMA = 'bench'
+
+
+class NullSink():
+  """Takes rows like the COPY sinks do and only counts them."""
+  def __init__(self):
+    self.count = 0
+
+  def write(self, row):
+    self.count += 1
+
+  def flush(self):
+    pass
+
+
+class Timer():
+  """Runs the stages of one importer, collecting a result for each."""
+  def __init__(self, importer, unit):
+    self.importer = importer
+    self.unit = unit
+    self.results = []
+    self._seconds = {}
+
+  def run(self, stage, fn, *args):
+    gc.collect()
+    start = time.perf_counter()
+    result = fn(*args)
+    self._seconds[stage] = time.perf_counter() - start
+    return result
+
+  def report(self, items, size):
+    """Rates for items pages (or entities, ...) and size bytes of decompressed dump, once that's known."""
+    for stage in STAGES:
+      seconds = self._seconds[stage]
+      result = {'importer': self.importer, 'stage': stage, 'unit': self.unit, 'items': items,
+                'seconds': round(seconds, 4), 'rate': round(items / seconds, 1),
+                'mb_per_s': round(size / seconds / 1e6, 2)}
+      print('%-16s %-10s %8d %-9s %7.2fs %10.0f %s/s %8.1f MB/s' % (
+          self.importer, stage, items, self.unit, seconds, result['rate'], self.unit, result['mb_per_s']), flush=True)
+      self.results.append(result)
+    return self.results
+
+
+def decompress(path, tool):
+  # the importers read the dumps through bzcat and zcat as well
+  with open(path, 'rb') as f:
+    return subprocess.run([tool], stdin=f, stdout=subprocess.PIPE, check=True).stdout
+
+
+def load(rows, sink, conn):
+  for row in rows:
+    sink.write(row)
+  sink.flush()
+  if conn:
+    conn.commit()
+
+
+def bench_wikipedia(dump, postgres, analyzer):
+  timer = Timer('import_wikipedia', 'pages')
+  data = timer.run('decompress', decompress, dump, 'bzcat')
+  pages = timer.run('parse', lambda: list(import_wikipedia.extract_pages(io.BytesIO(data))))
+  analyze = import_wikipedia.ANALYZERS[analyzer]
+  rows = timer.run('transform', lambda: [import_wikipedia.analyze_page(page, analyze) for page in pages])
+  conn = sink = None
+  if postgres:
+    conn, cursor = import_wikipedia.setup_db(postgres)
+    sink = import_wikipedia.CopySink(cursor)
+  timer.run('load', load, (row for row in rows if row is not None), sink or NullSink(), conn)
+  if conn:
+    conn.close()
+  return timer.report(len(pages), len(data))
+
+
+def bench_wikidata(dump, postgres, directory):
+  timer = Timer('import_wikidata', 'entities')
+  data = timer.run('decompress', decompress, dump, 'bzcat')
+  entities = timer.run('parse', lambda: [d for d in map(import_wikidata.parse_wikidata, io.BytesIO(data)) if d])
+  # made by the first scan over the dump, which isn't timed here
+  names = ((d['id'], import_wikidata.entity_name(d)) for d in entities)
+  id_name_map = id_name_store.write_store(os.path.join(directory, 'wikidata.idx'),
+                                          (item for item in names if item[1] is not None))
+  rows = timer.run('transform', lambda: [import_wikidata.entity_row(d, id_name_map)[1] for d in entities])
+  conn = sink = None
+  if postgres:
+    conn, cursor = import_wikidata.setup_db(postgres)
+    sink = import_wikidata.make_sink('copy', cursor)
+  timer.run('load', load, (row for row in rows if row is not None), sink or NullSink(), conn)
+  if conn:
+    conn.close()
+  id_name_map.close()
+  return timer.report(len(entities), len(data))
+
+
+def setup_updater_schema(cursor, schema):
+  """The tables wd_updater writes to, empty; geo needs postgis, as it does for the real thing."""
+  cursor.execute('CREATE SCHEMA IF NOT EXISTS %s' % schema)
+  cursor.execute('CREATE TABLE IF NOT EXISTS %s.wikidata (wikipedia_id TEXT PRIMARY KEY, title TEXT, '
+                 'wikidata_id TEXT UNIQUE, description TEXT, labels JSONB, sitelinks JSONB, properties JSONB)' % schema)
+  cursor.execute('CREATE TABLE IF NOT EXISTS %s.geo (wikidata_id TEXT UNIQUE, geometry geometry(POINT, 4326))' % schema)
+  cursor.execute('CREATE TABLE IF NOT EXISTS %s.labels (wikidata_id TEXT, label TEXT, UNIQUE (wikidata_id, label))' % schema)
+  cursor.execute('CREATE TABLE IF NOT EXISTS %s.instance (wikidata_id TEXT UNIQUE, instance_of TEXT)' % schema)
+  for table in 'wikidata', 'geo', 'labels', 'instance':
+    cursor.execute('TRUNCATE %s.%s' % (schema, table))
+
+
+def revision_ops(records, id_name_map):
+  ops = []
+  for record in records:
+    try:
+      ops.append(wd_updater.revision_op(record.text, record.title, id_name_map))
+    except ValueError:
+      continue
+  return ops
+
+
+def apply_ops(ops, conn, cursor, schema, batch_size=wd_updater.BATCH_SIZE):
+  """apply_batch for every batch_size ops, or without a connection only the collapse they start with."""
+  for i in range(0, len(ops), batch_size):
+    if cursor is None:
+      wd_updater.collapse(ops[i:i + batch_size])
+    else:
+      wd_updater.apply_batch(ops[i:i + batch_size], cursor, schema)
+      conn.commit()
+
+
+def bench_updater(dump, wikidata_dump, postgres, directory):
+  timer = Timer('wd_updater', 'revisions')
+  data = timer.run('decompress', decompress, dump, 'bzcat')
+  stats = {'skipped': 0}
+  records = timer.run('parse', lambda: list(wd_updater.latest_revisions(
+      page_extractor.iter_pages(io.BytesIO(data)), stats)))
+  # the store the full import left behind, the updates change it as they go
+  entities = (import_wikidata.parse_wikidata(line) for line in io.BytesIO(decompress(wikidata_dump, 'bzcat')))
+  names = ((d['id'], import_wikidata.entity_name(d)) for d in entities if d)
+  id_name_map = id_name_store.write_store(os.path.join(directory, 'updater.idx'),
+                                          (item for item in names if item[1] is not None))
+  ops = timer.run('transform', revision_ops, records, id_name_map)
+  conn = cursor = None
+  if postgres:
+    conn = psycopg2.connect(postgres)
+    cursor = conn.cursor()
+    setup_updater_schema(cursor, UPDATER_SCHEMA)
+    conn.commit()
+  timer.run('load', apply_ops, ops, conn, cursor, UPDATER_SCHEMA)
+  if conn:
+    conn.close()
+  id_name_map.close()
+  return timer.report(len(records) + stats['skipped'], len(data))
+
+
+def merge_partials(directory, counts):
+  """What aggregate does with the counts of each file: write them to a partial and add the partials up."""
+  total = Counter()
+  for name, c in counts:
+    import_stats.write_partial(os.path.join(directory, name + import_stats.PARTIAL_SUFFIX), c)
+  for name, _ in counts:
+    for title, count in import_stats.read_partial(os.path.join(directory, name + import_stats.PARTIAL_SUFFIX)):
+      total[title] += count
+  return total
+
+
+def upsert(total, names, postgres):
+  if not postgres:
+    return sum(1 for count in total.values() if count)
+  conn = psycopg2.connect(postgres)
+  conn.cursor().execute('CREATE SCHEMA IF NOT EXISTS wp')
+  conn.commit()
+  conn.close()
+  conn, cursor = import_stats.setup_db(postgres)
+  import_stats.upsert(cursor, total, names, [])
+  conn.commit()
+  conn.close()
+
+
+def bench_stats(dump_dir, names, postgres, directory):
+  timer = Timer('import_stats', 'lines')
+  data = timer.run('decompress', lambda: [decompress(os.path.join(dump_dir, name), 'zcat') for name in names])
+  counts = timer.run('parse', lambda: [(name, import_stats.count_lines(io.BytesIO(hour)))
+                                       for name, hour in zip(names, data)])
+  partials = os.path.join(directory, import_stats.PARTIAL_DIR)
+  os.makedirs(partials, exist_ok=True)
+  total = timer.run('transform', merge_partials, partials, counts)
+  timer.run('load', upsert, total, names, postgres)
+  return timer.report(sum(hour.count(b'\n') for hour in data), sum(len(hour) for hour in data))
+
+
+def make_dumps(directory, scale, seed):
+  """The synthetic dumps for scale and seed in directory, written unless they're there already."""
+  sizes = {key: max(1, int(size * scale)) for key, size in SCALE.items()}
+  paths = {'wikipedia': os.path.join(directory, 'enwiki-pages-articles.xml.bz2'),
+           'wikidata': os.path.join(directory, 'latest-all.json.bz2'),
+           'revisions': os.path.join(directory, 'wikidatawiki-pages-meta-hist-incr.xml.bz2'),
+           'pageviews': os.path.join(directory, 'pageviews')}
+  start = time.perf_counter()
+  if not os.path.isfile(paths['wikipedia']):
+    dump_generators.write_wikipedia(paths['wikipedia'], sizes['pages'], seed)
+  if not os.path.isfile(paths['wikidata']):
+    dump_generators.write_wikidata(paths['wikidata'], sizes['entities'], seed)
+  if not os.path.isfile(paths['revisions']):
+    dump_generators.write_revisions(paths['revisions'], sizes['revisions'], sizes['entities'], seed)
+  if not os.path.isdir(paths['pageviews']):
+    os.makedirs(paths['pageviews'] + '.tmp', exist_ok=True)
+    dump_generators.write_pageviews(paths['pageviews'] + '.tmp', sizes['hours'], sizes['lines'], sizes['pages'], seed)
+    os.replace(paths['pageviews'] + '.tmp', paths['pageviews'])
+  print('dumps in %s (%.1fs)' % (directory, time.perf_counter() - start), flush=True)
+  return paths
+
+
+def commit():
+  """(commit, whether the tree has uncommitted changes), or (None, None) outside a git checkout."""
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  try:
+    head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                            stdout=subprocess.PIPE, check=True).stdout
+  except (OSError, subprocess.CalledProcessError):
+    return None, None
+  return head, bool(status.strip())
+
+
+def read_results(path):
+  if not os.path.isfile(path):
+    return []
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(previous, results):
+  """For every result the last of previous with the same importer, stage and settings on another commit, or on
+     the same one without the uncommitted changes. Returns (result, previous result or None) pairs."""
+  pairs = []
+  for result in results:
+    earlier = [p for p in previous if p['importer'] == result['importer'] and p['stage'] == result['stage']
+               and p['settings'] == result['settings']
+               and (p['commit'], p['dirty']) != (result['commit'], result['dirty'])]
+    pairs.append((result, earlier[-1] if earlier else None))
+  return pairs
+
+
+def print_comparison(pairs):
+  for result, earlier in pairs:
+    if earlier is None:
+      print('%-16s %-10s %10.0f %s/s, nothing to compare with' % (
+          result['importer'], result['stage'], result['rate'], result['unit']))
+    else:
+      print('%-16s %-10s %10.0f -> %10.0f %s/s %+6.1f%% since %s' % (
+          result['importer'], result['stage'], earlier['rate'], result['rate'], result['unit'],
+          (result['rate'] / earlier['rate'] - 1) * 100, (earlier['commit'] or '?')[:10]))
+
+
+def main(importers, scale, seed, postgres, analyzer, directory, results_file, compare_results):
+  keep = directory is not None
+  directory = os.path.join(directory, 'scale-%s-seed-%d' % (scale, seed)) if keep else tempfile.mkdtemp()
+  os.makedirs(directory, exist_ok=True)
+  work = tempfile.mkdtemp(dir=directory)
+  try:
+    dumps = make_dumps(directory, scale, seed)
+    results = []
+    if 'import_wikipedia' in importers:
+      results += bench_wikipedia(dumps['wikipedia'], postgres, analyzer)
+    if 'import_wikidata' in importers:
+      results += bench_wikidata(dumps['wikidata'], postgres, work)
+    if 'wd_updater' in importers:
+      results += bench_updater(dumps['revisions'], dumps['wikidata'], postgres, work)
+    if 'import_stats' in importers:
+      results += bench_stats(dumps['pageviews'], sorted(os.listdir(dumps['pageviews'])), postgres, work)
+  finally:
+    shutil.rmtree(work)
+    if not keep:
+      shutil.rmtree(directory)
+
+  head, dirty = commit()
+  settings = {'scale': scale, 'seed': seed, 'sink': 'postgres' if postgres else 'null', 'analyzer': analyzer,
+              'json': json_decoder.backend()}
+  date = datetime.datetime.now().isoformat(timespec='seconds')
+  for result in results:
+    result.update({'commit': head, 'dirty': dirty, 'date': date, 'settings': settings})
+  if compare_results:
+    print_comparison(compare(read_results(results_file), results))
+  if results_file:
+    with open(results_file, 'a') as f:
+      for result in results:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Pages per second for each stage of the importers on synthetic dumps')
+  parser.add_argument('importers', type=str, nargs='*',
+                      help='the importers to run, of %s; all of them by default' % ', '.join(IMPORTERS))
+  parser.add_argument('--scale', type=float, default=1,
+                      help='size of the dumps, 1 is %s' % ', '.join('%d %s' % (v, k) for k, v in SCALE.items()))
+  parser.add_argument('--seed', type=int, default=1, help='seed of the dump generators')
+  parser.add_argument('--postgres', type=str, default=None,
+                      help='connection string of a scratch database to load into, a null sink without')
+  parser.add_argument('--analyzer', choices=sorted(import_wikipedia.ANALYZERS), default='mwparser',
+                      help='wikitext analyzer of import_wikipedia')
+  parser.add_argument('--json', type=str, choices=json_decoder.BACKENDS, default=None,
+                      help='json library to decode the entities with, by default the fastest one installed')
+  parser.add_argument('--dir', type=str, default=None,
+                      help='keep the generated dumps here and reuse them on the next run, a temp dir by default')
+  parser.add_argument('--results', type=str, default=RESULTS_FILE,
+                      help='json lines file the results are appended to, "" to not save them')
+  parser.add_argument('--compare', action='store_true',
+                      help='show the change since the last run on another commit with the same settings')
+
+  args = parser.parse_args()
+  for importer in args.importers:
+    if importer not in IMPORTERS:
+      parser.error('there is no importer %s' % importer)
+  print('decoding json with', json_decoder.use(args.json), flush=True)
+  main(args.importers or IMPORTERS, args.scale, args.seed, args.postgres, args.analyzer, args.dir, args.results, args.compare)
@@ -0,0 +1,52 @@
+#!/bin/python3
+
+import json
+import os
+
+# bytes per read when skipping ahead in a stream
+SKIP_CHUNK = 16 * 1024 * 1024
+
+
+class Checkpoint():
+  """How far an import got, saved right after a commit so that --resume can pick up from there.
+
+     The state is a dict, the importers store the position in the dump they can restart from with
+     whatever counters they need. It belongs to one dump, a checkpoint of a different file is ignored.
+  """
+  def __init__(self, dump, path=None):
+    self._dump = os.path.abspath(dump)
+    self._path = path or dump + '.checkpoint'
+
+  def _identity(self):
+    return {'dump': self._dump, 'size': os.path.getsize(self._dump)}
+
+  def load(self):
+    if not os.path.isfile(self._path):
+      return None
+    with open(self._path) as f:
+      saved = json.load(f)
+    if saved.get('identity') != self._identity():
+      print('checkpoint', self._path, 'is for a different dump, ignoring it', flush=True)
+      return None
+    return saved['state']
+
+  def save(self, **state):
+    tmp = self._path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'identity': self._identity(), 'state': state}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, self._path)
+
+  def clear(self):
+    if os.path.isfile(self._path):
+      os.remove(self._path)
+
+
+def skip_bytes(stream, count):
+  """Reads and drops count bytes, a lot cheaper than parsing them."""
+  while count > 0:
+    data = stream.read(min(count, SKIP_CHUNK))
+    if not data:
+      break
+    count -= len(data)
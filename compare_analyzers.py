@@ -0,0 +1,59 @@
+#!/bin/python3
+
+import argparse
+import bz2
+import itertools
+import sys
+import time
+
+from import_wikipedia import analyze_text, analyze_text_fast, extract_pages
+
+FIELDS = ('infobox', 'templates', 'categories', 'general')
+
+
+def compare(title, text):
+  """Runs both analyzers on a page and returns a list of (field, only mwparser, only fast) disagreements."""
+  expected = analyze_text(title, text)
+  actual = analyze_text_fast(title, text)
+  if expected is None or actual is None:
+    return [] if expected == actual else [('page', expected, actual)]
+  diffs = []
+  for field, a, b in zip(FIELDS, expected, actual):
+    if field == 'infobox':
+      if a != b:
+        diffs.append((field, a, b))
+    elif a != b:
+      diffs.append((field, sorted(set(a) - set(b)), sorted(set(b) - set(a))))
+  return diffs
+
+
+def main(dump, limit, verbose):
+  pages = 0
+  disagreements = 0
+  fields = dict.fromkeys(FIELDS + ('page',), 0)
+  start = time.perf_counter()
+  with (bz2.open(dump, 'rb') if dump.endswith('.bz2') else open(dump, 'rb')) as f:
+    for page_id, title, text, _ in itertools.islice(extract_pages(f), limit):
+      pages += 1
+      diffs = compare(title, text)
+      if diffs:
+        disagreements += 1
+        for field, only_mwparser, only_fast in diffs:
+          fields[field] += 1
+          if verbose:
+            print('%s (%s) %s: mwparser %r fast %r' % (title, page_id, field, only_mwparser, only_fast))
+  print('%d pages, %d with disagreements in %.1fs' % (pages, disagreements, time.perf_counter() - start))
+  for field, count in fields.items():
+    if count:
+      print('  %-10s %d' % (field, count))
+  return disagreements
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run both wikitext analyzers over a dump and report where they disagree')
+  parser.add_argument('dump', type=str, help='pages-articles xml, optionally bzipped')
+  parser.add_argument('--limit', type=int, default=None, help='only compare the first LIMIT pages')
+  parser.add_argument('--quiet', action='store_true', help='only print the summary')
+
+  args = parser.parse_args()
+  sys.exit(1 if main(args.dump, args.limit, not args.quiet) else 0)
@@ -0,0 +1,189 @@
+#!/bin/python3
+
+"""Downloads for all the scripts that fetch dumps: streamed to disk, resumed with Range requests and checked.
+
+A file is written to path + '.part' and only renamed to path once it has the size the server announced
+and, if one is given, the right md5. A download that breaks off keeps its .part file, the next attempt asks
+for the rest of it. So a file at path is complete, unless it was put there by something else; those are
+checked against the size or the md5 before they're skipped.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import re
+import threading
+
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+TIMEOUT = 60
+# concurrent transfers, dumps.wikimedia.org doesn't like more than a few per client
+CONCURRENCY = 3
+
+RE_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+_local = threading.local()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class NotFound(DownloadError):
+    """The server doesn't have the file (yet), trying again won't help."""
+    pass
+
+
+def session():
+    # one per thread, requests doesn't promise sessions are thread safe
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def remote_size(url):
+    response = session().head(url, allow_redirects=True, timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise DownloadError('%s: HTTP %d' % (url, response.status_code))
+    size = response.headers.get('Content-Length')
+    return int(size) if size is not None else None
+
+
+def is_complete(path, url=None, md5=None):
+    """Whether path holds the whole file: by the md5 if we have it, else by the size the server reports."""
+    if not os.path.isfile(path):
+        return False
+    if md5:
+        return file_md5(path) == md5
+    if url:
+        return remote_size(url) == os.path.getsize(path)
+    return True
+
+
+def _transfer(url, part):
+    """Gets url into part, continuing where an earlier attempt left it. Returns the full size, or None if the
+       server doesn't say."""
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    with session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            # nothing after offset, the part file has it all already (or it's from some other file)
+            return offset
+        if response.status_code == 404:
+            raise NotFound('%s: HTTP 404' % url)
+        if response.status_code not in (200, 206):
+            raise DownloadError('%s: HTTP %d' % (url, response.status_code))
+        if response.status_code == 206:
+            match = RE_CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                raise DownloadError('%s: unexpected Content-Range %r' % (url, response.headers.get('Content-Range')))
+            size = int(match.group(3)) if match.group(3) != '*' else None
+            mode = 'ab'
+        else:
+            # no range support, start over
+            size = response.headers.get('Content-Length')
+            size = int(size) if size is not None else None
+            mode = 'wb'
+        with open(part, mode) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+    return size
+
+
+def download(url, path, md5=None, refresh=False, retries=RETRIES):
+    """Downloads url to path unless a complete copy is there already, or always with refresh (for small
+       files that change, like status.txt). Raises DownloadError if it doesn't work out in retries attempts,
+       NotFound right away if the server doesn't have it."""
+    if not refresh and is_complete(path, url, md5):
+        print('File %s already exists, skip downloading' % path, flush=True)
+        return path
+    part = path + '.part'
+    if refresh and os.path.isfile(part):
+        os.remove(part)
+    error = None
+    for attempt in range(retries):
+        try:
+            size = _transfer(url, part)
+        except NotFound:
+            raise
+        except (requests.RequestException, DownloadError) as e:
+            error = e
+            print('Download of %s failed (%s), attempt %d of %d' % (url, e, attempt + 1, retries), flush=True)
+            continue
+        got = os.path.getsize(part)
+        if size is not None and got != size:
+            # the connection broke off, the next attempt picks up from here
+            error = DownloadError('%s: got %d of %d bytes' % (url, got, size))
+            print(error, flush=True)
+            continue
+        if md5 and file_md5(part) != md5:
+            # no point in resuming this one
+            os.remove(part)
+            error = DownloadError('%s: md5 mismatch' % url)
+            print(error, flush=True)
+            continue
+        os.replace(part, path)
+        return path
+    raise error
+
+
+def download_all(jobs, concurrency=CONCURRENCY):
+    """Runs download(url, path, **options) for every (url, path, options) in jobs with at most concurrency
+       at the same time. Returns a list of (url, path, error) for the ones that failed."""
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(download, url, path, **options): (url, path) for url, path, options in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            url, path = futures[future]
+            try:
+                future.result()
+            except (requests.RequestException, DownloadError) as e:
+                failed.append((url, path, e))
+    return failed
+
+
+def read_md5sums(path):
+    """The file name -> md5 map from an md5sums.txt as published with the dumps."""
+    sums = {}
+    with open(path) as f:
+        for line in f:
+            bits = line.split()
+            if len(bits) == 2:
+                sums[bits[1].lstrip('*')] = bits[0]
+    return sums
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Download files, resuming and checking them')
+    parser.add_argument('directory', type=str, help='where to save the files')
+    parser.add_argument('urls', type=str, nargs='+', help='files to download')
+    parser.add_argument('--md5sums', type=str, help='url of an md5sums.txt to check the files against')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='files downloaded at the same time')
+
+    args = parser.parse_args()
+
+    sums = {}
+    if args.md5sums:
+        sums = read_md5sums(download(args.md5sums, os.path.join(args.directory, os.path.basename(args.md5sums)),
+                                     refresh=True))
+    jobs = []
+    for url in args.urls:
+        name = os.path.basename(url)
+        jobs.append((url, os.path.join(args.directory, name), {'md5': sums.get(name)}))
+    failed = download_all(jobs, args.concurrency)
+    for url, path, error in failed:
+        print('failed to get %s: %s' % (url, error), flush=True)
+    sys.exit(1 if failed else 0)
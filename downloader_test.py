@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import downloader
+
+DATA = bytes(range(256)) * 1000
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # set by the tests: path -> bytes, how many bytes to send before hanging up, and what came in
+    files = {}
+    cut_after = None
+    requests = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        with Handler.lock:
+            Handler.requests.append((self.path, self.headers.get('Range')))
+            Handler.active += 1
+            Handler.max_active = max(Handler.max_active, Handler.active)
+        try:
+            self.respond(True)
+        finally:
+            with Handler.lock:
+                Handler.active -= 1
+
+    def respond(self, body):
+        data = Handler.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if body:
+            chunk = data[start:]
+            if Handler.cut_after is not None:
+                chunk = chunk[:Handler.cut_after]
+                Handler.cut_after = None
+                self.close_connection = True
+            self.wfile.write(chunk)
+
+
+class TestDownloader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        Handler.files = {'/dump.bz2': DATA}
+        Handler.cut_after = None
+        Handler.requests = []
+        Handler.max_active = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name='dump.bz2'):
+        return os.path.join(self.dir, name)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        downloader.download(self.base_url + '/dump.bz2', self.path(), md5=hashlib.md5(DATA).hexdigest())
+        self.assertEqual(self.read(self.path()), DATA)
+        self.assertFalse(os.path.exists(self.path() + '.part'))
+
+        # there and complete, so not fetched again
+        downloader.download(self.base_url + '/dump.bz2', self.path())
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_resume(self):
+        with open(self.path() + '.part', 'wb') as f:
+            f.write(DATA[:1000])
+        downloader.download(self.base_url + '/dump.bz2', self.path())
+        self.assertEqual(Handler.requests, [('/dump.bz2', 'bytes=1000-')])
+        self.assertEqual(self.read(self.path()), DATA)
+
+    def test_broken_connection(self):
+        Handler.cut_after = 5000
+        # what arrived of a chunk when the connection broke is lost, so keep them smaller than that
+        with mock.patch.object(downloader, 'CHUNK_SIZE', 1000):
+            downloader.download(self.base_url + '/dump.bz2', self.path())
+        self.assertEqual(Handler.requests, [('/dump.bz2', None), ('/dump.bz2', 'bytes=5000-')])
+        self.assertEqual(self.read(self.path()), DATA)
+
+    def test_truncated_file_is_fetched_again(self):
+        with open(self.path(), 'wb') as f:
+            f.write(DATA[:10])
+        downloader.download(self.base_url + '/dump.bz2', self.path())
+        self.assertEqual(self.read(self.path()), DATA)
+
+    def test_failures(self):
+        self.assertRaises(downloader.DownloadError, downloader.download, self.base_url + '/dump.bz2', self.path(),
+                          md5=hashlib.md5(b'something else').hexdigest(), retries=2)
+        self.assertFalse(os.path.exists(self.path()))
+        self.assertFalse(os.path.exists(self.path() + '.part'))
+        Handler.requests = []
+        self.assertRaises(downloader.NotFound, downloader.download, self.base_url + '/missing', self.path())
+        self.assertEqual(Handler.requests, [('/missing', None)])
+
+    def test_download_all(self):
+        for i in range(6):
+            Handler.files['/%d' % i] = DATA[i:]
+        jobs = [(self.base_url + '/%d' % i, self.path(str(i)), {}) for i in range(6)]
+        jobs.append((self.base_url + '/missing', self.path('missing'), {'retries': 1}))
+        failed = downloader.download_all(jobs, concurrency=2)
+        self.assertEqual([(url, path) for url, path, _ in failed], [(self.base_url + '/missing', self.path('missing'))])
+        for i in range(6):
+            self.assertEqual(self.read(self.path(str(i))), DATA[i:])
+        self.assertLessEqual(Handler.max_active, 2)
+
+    def test_read_md5sums(self):
+        with open(self.path('md5sums.txt'), 'w') as f:
+            f.write('0123abcd  wikidatawiki-20240101-pages-meta-hist-incr.xml.bz2\n'
+                    '4567ef01 *wikidatawiki-20240101-stubs-meta-hist-incr.xml.gz\n')
+        self.assertEqual(downloader.read_md5sums(self.path('md5sums.txt')), {
+            'wikidatawiki-20240101-pages-meta-hist-incr.xml.bz2': '0123abcd',
+            'wikidatawiki-20240101-stubs-meta-hist-incr.xml.gz': '4567ef01'})
+
+
+if __name__ == '__main__':
+    unittest.main()
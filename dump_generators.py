@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""Synthetic dumps that look like the real ones, for benchmarks and tests: pages-articles xml, the wikidata json
+dump, the incremental xml dump of wikidata revisions and hourly pageview files. The same seed and scale make the
+same bytes, so runs on different commits read the same input.
+
+Article i is called title(i) everywhere: it's the enwiki sitelink of entity Q<FIRST_ITEM + i> and the pageview
+files count views for it, so joins and redirects line up the way they do in the real dumps.
+"""
+
+import argparse
+import bz2
+import datetime
+import functools
+import gzip
+import json
+import os
+import random
+import urllib.parse
+from xml.sax.saxutils import escape
+
+WORDS = ['River', 'Amber', 'Castle', 'North', 'Saint', 'Valley', 'Zürich', 'Kraków', 'São', 'Paulo', 'Lake',
+         'Battle', 'Church', 'Station', 'History', 'Mount', 'Island', 'Bridge', 'Old', 'New', 'Ōsaka', 'Łódź',
+         'Museum', 'School', 'Park', 'Forest', 'King', 'Queen', 'Duke', 'Street', "O'Brien", 'Road', 'Port']
+INFOBOXES = ['settlement', 'person', 'river', 'album', 'film', 'football biography', 'company', 'officeholder']
+LANGUAGES = ['en', 'de', 'fr', 'nl', 'es', 'it', 'pl', 'ja', 'ru', 'pt', 'sv', 'zh', 'uk', 'ar', 'ca', 'fa']
+# property id, english label and the kind of value the claims have
+PROPERTIES = [('P31', 'instance of', 'item'), ('P17', 'country', 'item'), ('P131', 'located in the administrative '
+              'territorial entity', 'item'), ('P625', 'coordinate location', 'globecoordinate'),
+              ('P569', 'date of birth', 'time'), ('P1082', 'population', 'quantity'),
+              ('P856', 'official website', 'string'), ('P1448', 'official name', 'monolingualtext')]
+# classes and countries, Q1 and up, that the items point at; the items start at FIRST_ITEM
+CLASSES = ['human', 'city', 'river', 'album', 'film', 'company', 'village', 'country']
+COUNTRIES = ['Netherlands', 'Germany', 'France', 'Japan', 'Brazil', 'Poland']
+FIRST_ITEM = 100
+PROJECTS = ['de', 'fr', 'en.m', 'commons.m', 'ja', 'nl']
+
+PAGE = """  <page>
+    <title>%(title)s</title>
+    <ns>%(ns)d</ns>
+    <id>%(id)d</id>
+%(revisions)s  </page>
+"""
+
+REVISION = """    <revision>
+      <id>%(revision)d</id>
+      <timestamp>%(timestamp)s</timestamp>
+      <contributor>
+        <username>Editor %(editor)d</username>
+        <id>%(editor)d</id>
+      </contributor>
+      <model>%(model)s</model>
+      <format>%(format)s</format>
+      %(text)s
+      <sha1>az60vahaazg403faw6x2gzpbmiws0o3</sha1>
+    </revision>
+"""
+
+HEADER = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>%s</dbname>
+    <generator>MediaWiki 1.41.0</generator>
+    <case>first-letter</case>
+  </siteinfo>
+"""
+
+FOOTER = '</mediawiki>\n'
+
+
+@functools.lru_cache(100000)
+def title(i):
+  """The title of article i, unique and the same for every generator."""
+  rnd = random.Random(i)
+  return '%s %s %d' % (rnd.choice(WORDS), rnd.choice(WORDS), i)
+
+
+def item_id(i):
+  return 'Q%d' % (FIRST_ITEM + i)
+
+
+def timestamp(rnd):
+  return '20%02d-%02d-%02dT%02d:%02d:%02dZ' % (rnd.randint(10, 24), rnd.randint(1, 12), rnd.randint(1, 28),
+                                               rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+
+
+def revision_xml(rnd, revision, text, model='wikitext', format='text/x-wiki'):
+  if text is None:
+    text_xml = '<text deleted="deleted" />'
+  else:
+    text_xml = '<text bytes="%d" xml:space="preserve">%s</text>' % (len(text), escape(text))
+  return REVISION % {'revision': revision, 'timestamp': timestamp(rnd), 'editor': rnd.randint(1, 10 ** 7),
+                     'model': model, 'format': format, 'text': text_xml}
+
+
+def sentence(rnd, pages):
+  words = []
+  for _ in range(rnd.randint(8, 30)):
+    k = rnd.random()
+    if k < 0.08:
+      words.append('[[%s]]' % title(rnd.randrange(pages)))
+    elif k < 0.1:
+      words.append('[[%s|%s]]' % (title(rnd.randrange(pages)), rnd.choice(WORDS).lower()))
+    elif k < 0.11:
+      words.append("'''%s'''" % rnd.choice(WORDS))
+    else:
+      words.append(rnd.choice(WORDS).lower())
+  text = ' '.join(words) + '.'
+  if rnd.random() < 0.3:
+    text += '<ref>{{cite web|url=https://example.org/%d|title=%s|access-date=2020-01-01}}</ref>' % (
+        rnd.randrange(10 ** 6), rnd.choice(WORDS))
+  return text
+
+
+def article_text(rnd, i, pages):
+  """Wikitext with the things the analyzers look for: an infobox, other templates, links, refs and categories.
+     Sizes vary the way they do in the dump, most articles are short, a few are long."""
+  parts = []
+  if rnd.random() < 0.6:
+    parts.append('{{Infobox %s\n| name = %s\n| image = %s.jpg\n| population = %d\n| country = [[%s]]\n}}\n' % (
+        rnd.choice(INFOBOXES), title(i), title(i), rnd.randrange(10 ** 7), rnd.choice(COUNTRIES)))
+  if rnd.random() < 0.3:
+    parts.append('{{Use dmy dates|date=March 2020}}\n')
+  sections = int(rnd.paretovariate(1.5))
+  for section in range(min(sections, 30)):
+    if section:
+      parts.append('\n== %s ==\n' % rnd.choice(WORDS))
+    parts.append(' '.join(sentence(rnd, pages) for _ in range(rnd.randint(2, 12))) + '\n')
+  parts.append('\n== References ==\n{{Reflist}}\n\n')
+  for _ in range(rnd.randint(0, 6)):
+    parts.append('[[Category:%s in %s]]\n' % (rnd.choice(CLASSES).capitalize() + 's', rnd.choice(COUNTRIES)))
+  return ''.join(parts)
+
+
+def wikipedia_pages(pages, seed=1, redirects=0.1):
+  """Yields the pages-articles xml of pages articles in pieces, a share of them redirects."""
+  rnd = random.Random(seed)
+  yield HEADER % 'enwiki'
+  for i in range(pages):
+    if rnd.random() < redirects:
+      text = '#REDIRECT [[%s]]\n\n{{R from alternative name}}' % title(rnd.randrange(pages))
+    else:
+      text = article_text(rnd, i, pages)
+    yield PAGE % {'title': escape(title(i)), 'ns': 0, 'id': i + 1,
+                  'revisions': revision_xml(rnd, 10 ** 6 + i, text)}
+  yield FOOTER
+
+
+def snak(rnd, kind, pages):
+  if kind == 'item':
+    value = {'entity-type': 'item', 'numeric-id': rnd.randint(1, len(CLASSES) + len(COUNTRIES))}
+    value['id'] = 'Q%d' % value['numeric-id']
+    return {'type': 'wikibase-entityid', 'value': value}
+  if kind == 'globecoordinate':
+    return {'type': 'globecoordinate', 'value': {'latitude': rnd.uniform(-90, 90), 'longitude': rnd.uniform(-180, 180),
+                                                 'altitude': None, 'precision': 0.0001,
+                                                 'globe': 'http://www.wikidata.org/entity/Q2'}}
+  if kind == 'time':
+    return {'type': 'time', 'value': {'time': '+%04d-%02d-00T00:00:00Z' % (rnd.randint(1000, 2020), rnd.randint(0, 12)),
+                                      'timezone': 0, 'before': 0, 'after': 0, 'precision': 10,
+                                      'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}}
+  if kind == 'quantity':
+    return {'type': 'quantity', 'value': {'amount': '+%d' % rnd.randrange(10 ** 7), 'unit': '1'}}
+  if kind == 'string':
+    return {'type': 'string', 'value': 'https://example.org/%d' % rnd.randrange(pages)}
+  return {'type': 'monolingualtext', 'value': {'text': rnd.choice(WORDS), 'language': rnd.choice(LANGUAGES)}}
+
+
+def claim(rnd, entity_id, prop, kind, pages):
+  return {'mainsnak': {'snaktype': 'value', 'property': prop, 'datavalue': snak(rnd, kind, pages),
+                       'datatype': 'wikibase-item' if kind == 'item' else kind},
+          'type': 'statement', 'id': '%s$%08x' % (entity_id, rnd.getrandbits(32)),
+          'rank': 'preferred' if rnd.random() < 0.05 else 'normal',
+          'references': [{'hash': '%040x' % rnd.getrandbits(160), 'snaks': {}, 'snaks-order': []}]}
+
+
+def monolingual(languages, value):
+  return {language: {'language': language, 'value': value} for language in languages}
+
+
+def entity(rnd, i, pages, version=0):
+  """Item i of the dump; version > 0 makes the same item as a later revision would have it."""
+  entity_id = item_id(i)
+  languages = rnd.sample(LANGUAGES, rnd.randint(1, len(LANGUAGES)))
+  if 'en' not in languages and rnd.random() < 0.8:
+    languages.append('en')
+  name = title(i) + (' (%d)' % version if version else '')
+  d = {'type': 'item', 'id': entity_id, 'labels': monolingual(languages, name),
+       'descriptions': monolingual(languages[:3], '%s in %s' % (rnd.choice(CLASSES), rnd.choice(COUNTRIES))),
+       'aliases': {language: [{'language': language, 'value': rnd.choice(WORDS)}] for language in languages[:2]},
+       'claims': {}, 'sitelinks': {}, 'lastrevid': 10 ** 8 + i * 10 + version}
+  if rnd.random() < 0.8:
+    d['sitelinks']['enwiki'] = {'site': 'enwiki', 'title': title(i), 'badges': []}
+  for language in languages:
+    if language != 'en':
+      d['sitelinks'][language + 'wiki'] = {'site': language + 'wiki', 'title': name, 'badges': []}
+  for prop, _, kind in PROPERTIES:
+    if prop == 'P31' or rnd.random() < 0.4:
+      d['claims'][prop] = [claim(rnd, entity_id, prop, kind, pages) for _ in range(rnd.randint(1, 3))]
+  return d
+
+
+def named_entities():
+  """The properties and the classes and countries the items point at."""
+  for prop, label, kind in PROPERTIES:
+    yield {'type': 'property', 'datatype': kind, 'id': prop, 'labels': monolingual(['en'], label),
+           'descriptions': {}, 'aliases': {}, 'claims': {}, 'lastrevid': 10 ** 7}
+  for n, label in enumerate(CLASSES + COUNTRIES):
+    yield {'type': 'item', 'id': 'Q%d' % (n + 1), 'labels': monolingual(['en', 'de'], label), 'descriptions': {},
+           'aliases': {}, 'claims': {}, 'sitelinks': {'enwiki': {'site': 'enwiki', 'title': label, 'badges': []}},
+           'lastrevid': 10 ** 7 + n}
+
+
+def wikidata_entities(entities, seed=1):
+  """The entities of latest-all.json: the properties and classes first, then entities items."""
+  rnd = random.Random(seed)
+  yield from named_entities()
+  for i in range(entities):
+    yield entity(rnd, i, entities)
+
+
+def wikidata_lines(entities, seed=1):
+  """latest-all.json in lines: one entity a line in a json array, the way the dump has it."""
+  yield '[\n'
+  previous = None
+  for d in wikidata_entities(entities, seed):
+    if previous is not None:
+      yield previous + ',\n'
+    previous = json.dumps(d, ensure_ascii=False, separators=(',', ':'))
+  if previous is not None:
+    yield previous + '\n'
+  yield ']\n'
+
+
+def revisions(pages, entities, seed=1):
+  """The incremental wikidata xml in pieces: pages pages picked from entities items, each with one to four
+     revisions. Some revisions are merges into another item and some have their text deleted."""
+  rnd = random.Random(seed)
+  yield HEADER % 'wikidatawiki'
+  revision = 2 * 10 ** 9
+  for page_id in sorted(rnd.sample(range(entities), min(pages, entities))):
+    parts = []
+    for version in range(rnd.randint(1, 4)):
+      revision += rnd.randint(1, 1000)
+      k = rnd.random()
+      if k < 0.03:
+        text = json.dumps({'entity': item_id(page_id), 'redirect': item_id(rnd.randrange(entities))})
+      elif k < 0.05:
+        text = None
+      else:
+        text = json.dumps(entity(rnd, page_id, entities, version + 1), ensure_ascii=False, separators=(',', ':'))
+      parts.append(revision_xml(rnd, revision, text, 'wikibase-item', 'application/json'))
+    yield PAGE % {'title': item_id(page_id), 'ns': 0, 'id': FIRST_ITEM + page_id, 'revisions': ''.join(parts)}
+  yield FOOTER
+
+
+def pageview_lines(lines, pages, seed=1):
+  """One hour of pageviews, sorted like the real files. Views of english articles follow a power law, the rest
+     is other projects, mobile, talk pages and titles that aren't articles at all."""
+  rnd = random.Random(seed)
+  rows = []
+  for _ in range(lines):
+    k = rnd.random()
+    page = int(pages * rnd.random() ** 4)
+    name = urllib.parse.quote(title(page).replace(' ', '_'), safe="_'(),")
+    views = max(1, int(rnd.paretovariate(1.2)))
+    if k < 0.55:
+      rows.append(('en', name, views))
+    elif k < 0.6:
+      rows.append(('en', 'Talk:' + name, views))
+    elif k < 0.62:
+      rows.append(('en', 'Special:Search/' + name, views))
+    else:
+      rows.append((rnd.choice(PROJECTS), name, views))
+  rows.sort()
+  return ['%s %s %d 0\n' % row for row in rows]
+
+
+def pageview_name(hour):
+  return hour.strftime('pageviews-%Y%m%d-%H0000.gz')
+
+
+def write_wikipedia(path, pages, seed=1):
+  with bz2.open(path, 'wt', encoding='utf-8') as f:
+    for piece in wikipedia_pages(pages, seed):
+      f.write(piece)
+  return path
+
+
+def write_wikidata(path, entities, seed=1):
+  with bz2.open(path, 'wt', encoding='utf-8') as f:
+    for line in wikidata_lines(entities, seed):
+      f.write(line)
+  return path
+
+
+def write_revisions(path, pages, entities, seed=1):
+  with bz2.open(path, 'wt', encoding='utf-8') as f:
+    for piece in revisions(pages, entities, seed):
+      f.write(piece)
+  return path
+
+
+def write_pageviews(directory, hours, lines, pages, seed=1, start=datetime.datetime(2024, 1, 1)):
+  """hours hourly files from start in directory, as import_stats downloads them. Returns their names."""
+  names = []
+  for n in range(hours):
+    name = pageview_name(start + datetime.timedelta(hours=n))
+    with gzip.open(os.path.join(directory, name), 'wt', encoding='utf-8') as f:
+      f.writelines(pageview_lines(lines, pages, seed + n))
+    names.append(name)
+  return names
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Write synthetic wikipedia, wikidata and pageview dumps')
+  parser.add_argument('directory', type=str, help='where to write them')
+  parser.add_argument('--pages', type=int, default=10000, help='articles in the pages-articles dump')
+  parser.add_argument('--entities', type=int, default=10000, help='items in the wikidata dump')
+  parser.add_argument('--revisions', type=int, default=5000, help='items changed in the incremental dump')
+  parser.add_argument('--hours', type=int, default=3, help='hourly pageview files')
+  parser.add_argument('--lines', type=int, default=100000, help='lines per pageview file')
+  parser.add_argument('--seed', type=int, default=1)
+
+  args = parser.parse_args()
+  os.makedirs(args.directory, exist_ok=True)
+  print(write_wikipedia(os.path.join(args.directory, 'enwiki-pages-articles.xml.bz2'), args.pages, args.seed))
+  print(write_wikidata(os.path.join(args.directory, 'latest-all.json.bz2'), args.entities, args.seed))
+  print(write_revisions(os.path.join(args.directory, 'wikidatawiki-pages-meta-hist-incr.xml.bz2'), args.revisions,
+                        args.entities, args.seed))
+  for name in write_pageviews(args.directory, args.hours, args.lines, args.pages, args.seed):
+    print(os.path.join(args.directory, name))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import dump_generators
+import import_stats
+import import_wikidata
+import import_wikipedia
+import page_extractor
+
+
+class TestDumpGenerators(unittest.TestCase):
+  def test_wikipedia(self):
+    data = ''.join(dump_generators.wikipedia_pages(50)).encode('utf-8')
+    self.assertEqual(data, ''.join(dump_generators.wikipedia_pages(50)).encode('utf-8'))
+    self.assertNotEqual(data, ''.join(dump_generators.wikipedia_pages(50, seed=2)).encode('utf-8'))
+    pages = list(import_wikipedia.extract_pages(io.BytesIO(data)))
+    self.assertEqual([page[1] for page in pages], [dump_generators.title(i) for i in range(50)])
+    # the xml parser reads them the same
+    self.assertEqual([page[:3] for page in import_wikipedia.read_pages(io.BytesIO(data))],
+                     [page[:3] for page in pages])
+    rows = [import_wikipedia.analyze_page(page, import_wikipedia.analyze_text_fast) for page in pages]
+    self.assertTrue(any(row[2] for row in rows))
+    self.assertTrue(any(row[5] for row in rows))
+
+  def test_wikidata(self):
+    lines = list(dump_generators.wikidata_lines(20))
+    self.assertEqual(len(json.loads(''.join(lines))), 20 + len(dump_generators.PROPERTIES) +
+                     len(dump_generators.CLASSES) + len(dump_generators.COUNTRIES))
+    entities = [d for d in (import_wikidata.parse_wikidata(line.encode('utf-8')) for line in lines) if d]
+    names = {d['id']: import_wikidata.entity_name(d) for d in entities}
+    self.assertEqual(names['P31'], 'instance of')
+    rows = [import_wikidata.entity_row(d, names)[1] for d in entities[-20:]]
+    row = next(row for row in rows if row)
+    self.assertEqual(row[0], dump_generators.title(int(row[2][1:]) - dump_generators.FIRST_ITEM))
+    self.assertIn(row[6]['instance of'] if isinstance(row[6]['instance of'], str) else row[6]['instance of'][0],
+                  dump_generators.CLASSES + dump_generators.COUNTRIES)
+
+  def test_revisions(self):
+    data = ''.join(dump_generators.revisions(30, 100)).encode('utf-8')
+    records = list(page_extractor.iter_pages(io.BytesIO(data)))
+    self.assertEqual(len(set(record.id for record in records)), 30)
+    self.assertGreater(len(records), 30)
+    for record in records:
+      self.assertEqual(record.title, 'Q%d' % record.id)
+
+  def test_pageviews(self):
+    lines = dump_generators.pageview_lines(2000, 100)
+    keys = [line.split(' ')[:2] for line in lines]
+    self.assertEqual(keys, sorted(keys))
+    counts = import_stats.count_lines(line.encode('utf-8') for line in lines)
+    self.assertLessEqual(set(counts), set(dump_generators.title(i) for i in range(100)))
+    # a few articles get most of the views
+    top = sum(count for _, count in counts.most_common(10))
+    self.assertGreater(top, sum(counts.values()) / 3)
+
+
+class TestBenchmark(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_main(self):
+    results_file = os.path.join(self.dir, 'results.jsonl')
+    results = benchmark.main(['import_wikipedia', 'import_stats'], 0.01, 1, None, 'fast', self.dir, results_file,
+                             False)
+    self.assertEqual([(r['importer'], r['stage']) for r in results],
+                     [(importer, stage) for importer in ('import_wikipedia', 'import_stats')
+                      for stage in benchmark.STAGES])
+    self.assertEqual(results[0]['items'], 20)
+    self.assertEqual(benchmark.read_results(results_file), results)
+    # the dumps are kept for the next run
+    self.assertEqual(sorted(os.listdir(self.dir)), ['results.jsonl', 'scale-0.01-seed-1'])
+
+  def test_compare(self):
+    settings = {'scale': 1}
+    result = {'importer': 'import_stats', 'stage': 'parse', 'settings': settings, 'commit': 'b', 'dirty': False}
+    previous = [dict(result, commit='a', rate=1), dict(result, commit='b', rate=2),
+                dict(result, commit='a', rate=3, settings={'scale': 2})]
+    self.assertEqual(benchmark.compare(previous, [result]), [(result, previous[0])])
+    # uncommitted changes compare with the commit they're on
+    dirty = dict(result, dirty=True)
+    self.assertEqual(benchmark.compare(previous, [dirty]), [(dirty, previous[1])])
+    self.assertEqual(benchmark.compare([], [result]), [(result, None)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,316 @@
+#!/bin/python3
+
+import argparse
+import bisect
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+
+MAGIC = b'IDNAME1\0'
+HEADER = struct.Struct('<8sQ')
+RUN_ENTRY = struct.Struct('<qI')
+# a change in the log: key and the length of the name that follows, -1 if the id was removed
+LOG_ENTRY = struct.Struct('<qi')
+LOG_SUFFIX = '.log'
+# entries sorted in memory before they're spilled to a run file
+RUN_SIZE = 1000000
+
+STORE_FILE = 'properties.idx'
+LEGACY_FILE = 'properties.json'
+# changes kept in the log before the updaters fold it into the store
+COMPACT_AFTER = 1000000
+
+
+def encode_key(entity_id):
+  """Q42 -> the numeric part with the letter in the top byte, so all ids of a kind sort together.
+     Returns None for ids that don't look like that."""
+  try:
+    return (ord(entity_id[0]) << 56) | int(entity_id[1:])
+  except (IndexError, TypeError, ValueError):
+    return None
+
+
+def decode_key(key):
+  return chr(key >> 56) + str(key & ((1 << 56) - 1))
+
+
+class IdNameStore():
+  """Maps wikidata ids to names from a file made by StoreWriter: a sorted array of keys, an array of
+     offsets into a blob of utf-8 names, and the blob. It's mmapped, so opening is instant and
+     processes reading the same file share the memory. Reads like the dict it replaces.
+
+     Changes (store[id] = name, store.pop(id)) are appended to path + '.log' and kept in a dict on top
+     of the file, which gets the log replayed when it's opened. compact writes them into the file."""
+  def __init__(self, path):
+    self.path = path
+    self.log_path = path + LOG_SUFFIX
+    self._log = None
+    self._open()
+
+  def _open(self):
+    with open(self.path, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = HEADER.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError('%s is not an id name store' % self.path)
+    view = memoryview(self._mm)
+    start = HEADER.size
+    self._keys = view[start:start + 8 * count].cast('q')
+    start += 8 * count
+    self._offsets = view[start:start + 8 * (count + 1)].cast('Q')
+    self._blob = start + 8 * (count + 1)
+    self._count = count
+    self._read_log()
+
+  def _read_log(self):
+    # key -> name, or None for removed ids
+    self._overlay = {}
+    self._log_size = 0
+    if not os.path.isfile(self.log_path):
+      return
+    with open(self.log_path, 'rb') as f:
+      data = f.read()
+    pos = 0
+    while pos + LOG_ENTRY.size <= len(data):
+      key, size = LOG_ENTRY.unpack_from(data, pos)
+      end = pos + LOG_ENTRY.size + max(size, 0)
+      if end > len(data):
+        break
+      self._overlay[key] = data[pos + LOG_ENTRY.size:end].decode('utf-8') if size >= 0 else None
+      pos = end
+    # anything after pos is a change that was cut off halfway, the next append goes over it
+    self._log_size = pos
+
+  def __getstate__(self):
+    # worker processes open the file themselves rather than getting a copy
+    return {'path': self.path}
+
+  def __setstate__(self, state):
+    self.__init__(state['path'])
+
+  def _find(self, key):
+    if key is None:
+      return -1
+    i = bisect.bisect_left(self._keys, key)
+    if i < self._count and self._keys[i] == key:
+      return i
+    return -1
+
+  def _name(self, i):
+    return self._mm[self._blob + self._offsets[i]:self._blob + self._offsets[i + 1]].decode('utf-8')
+
+  def get(self, entity_id, default=None):
+    key = encode_key(entity_id)
+    if key in self._overlay:
+      name = self._overlay[key]
+      return default if name is None else name
+    i = self._find(key)
+    if i < 0:
+      return default
+    return self._name(i)
+
+  def __getitem__(self, entity_id):
+    value = self.get(entity_id)
+    if value is None:
+      raise KeyError(entity_id)
+    return value
+
+  def __contains__(self, entity_id):
+    return self.get(entity_id) is not None
+
+  def __len__(self):
+    count = self._count
+    for key, name in self._overlay.items():
+      count += (name is not None) - (self._find(key) >= 0)
+    return count
+
+  def items(self):
+    """(id, name) of everything in the store, in key order."""
+    overlay = sorted(self._overlay.items())
+    base = ((self._keys[i], self._name(i)) for i in range(self._count))
+    last = None
+    for key, name in heapq.merge(overlay, base, key=lambda item: item[0]):
+      # the overlay sorts first for a key that's in both, and wins
+      if key != last and name is not None:
+        yield decode_key(key), name
+      last = key
+
+  def _append(self, key, name):
+    if self._log is None:
+      self._log = open(self.log_path, 'ab')
+      self._log.truncate(self._log_size)
+    data = name.encode('utf-8') if name is not None else b''
+    self._log.write(LOG_ENTRY.pack(key, len(data) if name is not None else -1) + data)
+    self._log_size += LOG_ENTRY.size + len(data)
+    self._overlay[key] = name
+
+  def __setitem__(self, entity_id, name):
+    key = encode_key(entity_id)
+    if key is None:
+      raise KeyError(entity_id)
+    # most revisions don't rename anything, those don't go to the log
+    if self.get(entity_id) != name:
+      self._append(key, name)
+
+  def pop(self, entity_id, default=None):
+    name = self.get(entity_id)
+    if name is None:
+      return default
+    self._append(encode_key(entity_id), None)
+    return name
+
+  @property
+  def changes(self):
+    """Number of ids changed in the log."""
+    return len(self._overlay)
+
+  def flush(self):
+    """Makes the changes so far survive a crash, call it when the database changes they belong to commit."""
+    if self._log is not None:
+      self._log.flush()
+      os.fsync(self._log.fileno())
+
+  def close(self):
+    if self._log is not None:
+      self._log.close()
+      self._log = None
+
+  def compact(self, min_changes=0):
+    """Writes the store file again with the changes from the log and starts a new log, if there are more
+       than min_changes of them. Returns whether it did."""
+    if not self._overlay or len(self._overlay) <= min_changes:
+      return False
+    self.flush()
+    print('compacting', self.path, 'with', len(self._overlay), 'changes', flush=True)
+    # the new file replaces the old one only when it's complete; the mmap keeps reading the old one till then
+    write_store(self.path, self.items())
+    self.close()
+    self._open()
+    return True
+
+
+class StoreWriter():
+  """Collects (id, name) pairs in any order and writes them as an IdNameStore. Memory stays bounded
+     by sorting RUN_SIZE pairs at a time into run files that get merged at the end, straight into files
+     for the keys, offsets and names that make up the store. If an id is added
+     twice the last name wins, like assigning to a dict."""
+  def __init__(self, path, run_size=RUN_SIZE):
+    self.path = path
+    self._run_size = run_size
+    self._tmp = tempfile.mkdtemp(prefix='id_name_store', dir=os.path.dirname(os.path.abspath(path)))
+    self._runs = []
+    self._pending = []
+
+  def add(self, entity_id, name):
+    key = encode_key(entity_id)
+    if key is None:
+      return
+    self._pending.append((key, len(self._pending), name.encode('utf-8')))
+    if len(self._pending) >= self._run_size:
+      self._spill()
+
+  def _spill(self):
+    self._pending.sort()
+    path = os.path.join(self._tmp, 'run%d' % len(self._runs))
+    with open(path, 'wb') as f:
+      for key, _, name in self._pending:
+        f.write(RUN_ENTRY.pack(key, len(name)))
+        f.write(name)
+    self._runs.append(path)
+    self._pending = []
+
+  def _read_run(self, path, run):
+    with open(path, 'rb') as f:
+      while True:
+        head = f.read(RUN_ENTRY.size)
+        if not head:
+          return
+        key, size = RUN_ENTRY.unpack(head)
+        yield key, run, f.read(size)
+
+  def _write_sorted(self, items):
+    """Writes the keys, the offsets and the blob of the sorted (key, name) items to three files in the
+       temp directory, a chunk of keys and offsets at a time. Returns the paths and the number of keys."""
+    paths = [os.path.join(self._tmp, name) for name in ('keys', 'offsets', 'blob')]
+    count = 0
+    size = 0
+    with open(paths[0], 'wb') as keys_file, open(paths[1], 'wb') as offsets_file, open(paths[2], 'wb') as blob:
+      keys = array('q')
+      offsets = array('Q', [0])
+      for key, name in items:
+        blob.write(name)
+        size += len(name)
+        keys.append(key)
+        offsets.append(size)
+        count += 1
+        if len(keys) >= self._run_size:
+          keys.tofile(keys_file)
+          offsets.tofile(offsets_file)
+          keys = array('q')
+          offsets = array('Q')
+      keys.tofile(keys_file)
+      offsets.tofile(offsets_file)
+    return paths, count
+
+  def _merge_runs(self):
+    """The pairs of all runs in key order, with only the last name added for each id."""
+    last = None
+    for key, _, name in heapq.merge(*[self._read_run(path, i) for i, path in enumerate(self._runs)]):
+      if last is not None and key != last[0]:
+        yield last
+      last = key, name
+    if last is not None:
+      yield last
+
+  def close(self):
+    if self._pending or not self._runs:
+      self._spill()
+    paths, count = self._write_sorted(self._merge_runs())
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(HEADER.pack(MAGIC, count))
+      for path in paths:
+        with open(path, 'rb') as part:
+          shutil.copyfileobj(part, f)
+    os.replace(tmp_path, self.path)
+    # changes logged for a store that's been replaced don't apply to this one
+    if os.path.isfile(self.path + LOG_SUFFIX):
+      os.remove(self.path + LOG_SUFFIX)
+    shutil.rmtree(self._tmp)
+    return IdNameStore(self.path)
+
+
+def write_store(path, items):
+  writer = StoreWriter(path)
+  for entity_id, name in items:
+    writer.add(entity_id, name)
+  return writer.close()
+
+
+def load(directory='.'):
+  """Opens the store in directory, converting a properties.json from before there was a store.
+     Returns None if there is neither."""
+  path = os.path.join(directory, STORE_FILE)
+  legacy = os.path.join(directory, LEGACY_FILE)
+  if not os.path.isfile(path) and os.path.isfile(legacy):
+    print('converting', legacy, 'to', path, flush=True)
+    with open(legacy) as f:
+      write_store(path, json.load(f).items())
+  if not os.path.isfile(path):
+    return None
+  return IdNameStore(path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert a properties.json id -> name map into an id name store')
+  parser.add_argument('json', type=str, help='properties.json written by an older import_wikidata')
+  parser.add_argument('store', type=str, help='store file to write')
+
+  args = parser.parse_args()
+  with open(args.json) as f:
+    print(len(write_store(args.store, json.load(f).items())), 'ids written')
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import id_name_store
+from id_name_store import IdNameStore, StoreWriter, write_store
+from import_wikidata import map_value
+
+
+class TestIdNameStore(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'properties.idx')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_lookup(self):
+    store = write_store(self.path, [('Q42', 'Douglas Adams'), ('P31', 'instance of'), ('Q2', 'Earth'),
+                                    ('Q64', 'Berlin'), ('Q100', 'Zürich')])
+    self.assertEqual(len(store), 5)
+    self.assertEqual(store.get('Q42'), 'Douglas Adams')
+    self.assertEqual(store['Q100'], 'Zürich')
+    self.assertEqual(store.get('P31'), 'instance of')
+    self.assertIn('Q2', store)
+    self.assertNotIn('P2', store)
+    self.assertNotIn('Q43', store)
+    self.assertNotIn('', store)
+    self.assertNotIn('L1-F2', store)
+    self.assertIsNone(store.get('Q1'))
+    self.assertEqual(store.get('Q1', 'x'), 'x')
+    self.assertRaises(KeyError, lambda: store['Q1'])
+
+  def test_runs_and_duplicates(self):
+    writer = StoreWriter(self.path, run_size=3)
+    expected = {}
+    for i in range(50, 0, -1):
+      writer.add('Q%d' % (i * 7 % 51), 'item %d' % i)
+      expected['Q%d' % (i * 7 % 51)] = 'item %d' % i
+    writer.add('Q7', 'replaced')
+    expected['Q7'] = 'replaced'
+    store = writer.close()
+    self.assertEqual(len(store), len(expected))
+    for entity_id, name in expected.items():
+      self.assertEqual(store.get(entity_id), name)
+    self.assertEqual(os.listdir(self.dir), ['properties.idx'])
+
+  def test_empty(self):
+    store = write_store(self.path, [])
+    self.assertEqual(len(store), 0)
+    self.assertNotIn('Q1', store)
+
+  def test_pickle_reopens(self):
+    write_store(self.path, [('Q1', 'one')])
+    store = pickle.loads(pickle.dumps(IdNameStore(self.path)))
+    self.assertEqual(store.get('Q1'), 'one')
+
+  def test_converts_legacy_json(self):
+    self.assertIsNone(id_name_store.load(self.dir))
+    with open(os.path.join(self.dir, 'properties.json'), 'w') as f:
+      json.dump({'Q2': 'Earth', 'P625': 'coordinate location'}, f)
+    store = id_name_store.load(self.dir)
+    self.assertEqual(store.get('P625'), 'coordinate location')
+    self.assertTrue(os.path.isfile(self.path))
+
+  def test_log(self):
+    store = write_store(self.path, [('Q1', 'one'), ('Q2', 'two'), ('Q3', 'three')])
+    store['Q4'] = 'four'
+    store['Q1'] = 'uno'
+    store['Q3'] = 'three'
+    self.assertEqual(store.pop('Q2'), 'two')
+    self.assertIsNone(store.pop('Q5'))
+    self.assertEqual(store.changes, 3)
+    self.assertEqual(len(store), 3)
+    self.assertEqual(list(store.items()), [('Q1', 'uno'), ('Q3', 'three'), ('Q4', 'four')])
+    store.flush()
+
+    # a change cut off halfway by a crash is dropped, and written over by the next one
+    with open(self.path + '.log', 'ab') as f:
+      f.write(b'\x05\x00\x00')
+    store = IdNameStore(self.path)
+    self.assertEqual([store.get(entity_id) for entity_id in ('Q1', 'Q2', 'Q3', 'Q4')], ['uno', None, 'three', 'four'])
+    self.assertNotIn('Q2', store)
+    store['Q2'] = 'dos'
+    store.flush()
+    self.assertEqual(IdNameStore(self.path).get('Q2'), 'dos')
+
+    self.assertFalse(store.compact(min_changes=10))
+    self.assertTrue(store.compact())
+    self.assertFalse(os.path.exists(self.path + '.log'))
+    self.assertEqual(store.changes, 0)
+    self.assertEqual(dict(IdNameStore(self.path).items()), {'Q1': 'uno', 'Q2': 'dos', 'Q3': 'three', 'Q4': 'four'})
+
+  def test_new_store_drops_log(self):
+    store = write_store(self.path, [('Q1', 'one')])
+    store['Q1'] = 'uno'
+    store.close()
+    self.assertEqual(write_store(self.path, [('Q1', 'one')]).get('Q1'), 'one')
+
+  def test_map_value(self):
+    store = write_store(self.path, [('Q2', 'Earth'), ('Q405', 'Moon'), ('Q64', 'Berlin')])
+    self.assertEqual(map_value({'type': 'wikibase-entityid', 'value': {'id': 'Q64'}}, store), 'Berlin')
+    coo = {'type': 'globecoordinate',
+           'value': {'latitude': 1, 'longitude': 2, 'globe': 'http://www.wikidata.org/entity/Q405'}}
+    self.assertEqual(map_value(coo, store), {'lat': 1, 'lng': 2, 'globe': 'Q405'})
+
+
+if __name__ == '__main__':
+  unittest.main()
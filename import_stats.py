@@ -6,28 +6,91 @@ import argparse
 import subprocess
 import datetime
 import calendar
+import gzip
 import random
+import re
+import multiprocessing
 import psycopg2
-import requests
-import urllib
+import urllib.parse
+
+import downloader
+import pg_copy
+import redirect_map
+import spill_counter
+from metrics import Cursor, Metrics
+from spill_counter import SpillCounter
 
 # REMOTE_PATH = 'https://dumps.wikimedia.org/other/pagecounts-raw/%(year)04d/%(year)04d-%(month)02d/pagecounts-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
-REMOTE_PATH = 'https://dumps.wikimedia.org/other/pageviews/%(year)04d/%(year)04d-%(month)02d/pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
+BASE_URL = 'https://dumps.wikimedia.org/other/pageviews/'
+# relative to BASE_URL, which can point at a mirror
+REMOTE_PATH = '%(year)04d/%(year)04d-%(month)02d/pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
 LOCAL_PATH = 'pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
+RE_DUMP_FILE = re.compile(r'pageviews-(\d{8}-\d{2})0000\.gz$')
+
+# the counts of every dump file, so a file is only read once, in the dump directory
+PARTIAL_DIR = 'partials'
+PARTIAL_SUFFIX = '.counts'
+FOLDED_SUFFIX = '.folded.counts'
+# rows per COPY of the changed totals
+COPY_BATCH = 100000
+
+# redirect_map.RedirectMap by path, in the processes that count
+_redirect_maps = {}
+
+
+def has_unknown_files(cursor):
+    """Whether wp.wikistats has counts but wp.wikistats_files doesn't say from which files, as left by the
+       import_stats from before there was an incremental update."""
+    cursor.execute("SELECT to_regclass('wp.wikistats'), to_regclass('wp.wikistats_files')")
+    stats, files = cursor.fetchone()
+    if stats is None:
+        return False
+    if files is not None:
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM wp.wikistats_files)')
+        if cursor.fetchone()[0]:
+            return False
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM wp.wikistats)')
+    return cursor.fetchone()[0]
 
 
-def setup_db(connection_string):
+def setup_db(connection_string, incremental=False, folded=False):
+    """Makes the tables, empty unless incremental. folded is whether this run counts with --redirects; the
+       totals of files counted the other way don't add up with it, so then it starts over as well."""
     conn = psycopg2.connect(connection_string)
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE IF EXISTS wp.wikistats')
-    cursor.execute('CREATE TABLE wp.wikistats ('
+    if incremental and has_unknown_files(cursor):
+        # adding to those totals would count every file in the directory on top of what's in there already
+        print('wp.wikistats has no record of the files in it, starting over')
+        incremental = False
+    if not incremental:
+        cursor.execute('DROP TABLE IF EXISTS wp.wikistats')
+        cursor.execute('DROP TABLE IF EXISTS wp.wikistats_files')
+    cursor.execute('CREATE TABLE IF NOT EXISTS wp.wikistats ('
                     '    title TEXT PRIMARY KEY,'
                     '    viewcount INTEGER'
                     ')')
+    # the dump files that are in wp.wikistats, changed in the same transaction
+    cursor.execute('CREATE TABLE IF NOT EXISTS wp.wikistats_files ('
+                    '    file TEXT PRIMARY KEY,'
+                    '    folded BOOLEAN NOT NULL DEFAULT false'
+                    ')')
+    # the files recorded before there was a folded column were counted without redirects
+    cursor.execute('ALTER TABLE wp.wikistats_files ADD COLUMN IF NOT EXISTS folded BOOLEAN NOT NULL DEFAULT false')
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM wp.wikistats_files WHERE folded <> %s)', (folded,))
+    if cursor.fetchone()[0]:
+        print('wp.wikistats was counted', 'without' if folded else 'with', '--redirects, starting over')
+        cursor.execute('TRUNCATE wp.wikistats, wp.wikistats_files')
     return conn, cursor
 
 
-def fetch_dumps(dump_dir, dumps_to_fetch):
+def download_all(jobs, concurrency):
+    failed = downloader.download_all(jobs, concurrency)
+    for url, path, error in failed:
+        print('failed to get', url, error)
+    return failed
+
+
+def fetch_dumps(dump_dir, dumps_to_fetch, base_url=BASE_URL, concurrency=downloader.CONCURRENCY):
     # don't try anything in the last month, it might not be online yet
     last_date = datetime.datetime.today() - datetime.timedelta(30)
     year = last_date.year
@@ -37,64 +100,222 @@ def fetch_dumps(dump_dir, dumps_to_fetch):
         days = 366
     else:
         days = 365
+    jobs = {}
     for i in range(dumps_to_fetch):
         local_path = None
         remote_path = None
-        while not local_path or os.path.isdir(local_path):
+        while not local_path or local_path in jobs or os.path.isdir(local_path):
             random_day = last_date - datetime.timedelta(days=random.randint(1, days))
-            random_hour = random.randint(1, 24)
+            random_hour = random.randint(0, 23)
             d = {'year': random_day.year, 'month': random_day.month, 'day': random_day.day, 'hour': random_hour}
-            remote_path = REMOTE_PATH % d
+            remote_path = base_url + REMOTE_PATH % d
             local_path = os.path.join(dump_dir, LOCAL_PATH % d)
         print('getting', local_path)
-        data = requests.get(remote_path).content
-        with open(local_path, 'wb') as fout:
-            fout.write(data)
+        jobs[local_path] = remote_path
+    return download_all([(url, path, {}) for path, url in jobs.items()], concurrency)
 
 
-def fetch_dumps_days(dump_dir, start_date, days):
+def fetch_dumps_days(dump_dir, start_date, days, base_url=BASE_URL, concurrency=downloader.CONCURRENCY):
     hour = datetime.timedelta(hours=1)
     last_date = datetime.datetime.strptime(start_date, '%Y%m%d') - hour
     print(last_date, last_date - hour)
+    jobs = []
     for i in range(days * 24):
         d = {'year': last_date.year, 'month': last_date.month, 'day': last_date.day, 'hour': last_date.hour}
-        remote_path = REMOTE_PATH % d
+        remote_path = base_url + REMOTE_PATH % d
         local_path = os.path.join(dump_dir, LOCAL_PATH % d)
         print('getting', local_path)
-        data = requests.get(remote_path).content
-        with open(local_path, 'wb') as fout:
-            fout.write(data)
+        jobs.append((remote_path, local_path, {}))
         last_date = last_date - hour
+    return download_all(jobs, concurrency)
 
-def main(dump_dir, cursor, dumps_to_fetch, start_date):
-    if dumps_to_fetch > 0:
-        fetch_dumps_days(dump_dir, start_date, dumps_to_fetch)
 
+def count_lines(lines, redirects=None):
+    """Page views per english title in the lines of an hourly file. With a redirect_map.RedirectMap the views
+       of a redirect count for the article it goes to."""
     c = Counter()
-    for fn in os.listdir(dump_dir):
-        if fn.endswith('.gz'):
-            print(fn)
-            path = os.path.join(dump_dir, fn)
-            for line in subprocess.Popen(['zcat'], stdin=open(path, 'r'), stdout=subprocess.PIPE).stdout:
-                line = line.decode('utf-8')
-                if line.startswith('en '):
-                    bits = line.split(' ')
-                    _, wikipedia_id, count, size = bits
-                    if not ':' in wikipedia_id:
-                        try:
-                            title = urllib.parse.unquote(wikipedia_id).replace('_', ' ')
-                        except UnicodeDecodeError:
-                            continue
-                        c[title] += int(count)
-    for k, v in c.items():
-        try:
-            cursor.execute("INSERT INTO wp.wikistats (title, viewcount) VALUES (%s, %s)", (k, v))
-        except:
-            print(k, v)
-            raise
+    for line in lines:
+        line = line.decode('utf-8')
+        if line.startswith('en '):
+            bits = line.split(' ')
+            _, wikipedia_id, count, size = bits
+            if not ':' in wikipedia_id:
+                try:
+                    title = urllib.parse.unquote(wikipedia_id).replace('_', ' ')
+                except UnicodeDecodeError:
+                    continue
+                if redirects is not None:
+                    title = redirects.fold(title)
+                c[title] += int(count)
+    return c
+
+
+def count_file(path, redirects=None):
+    """(path, count_lines of the file) for one hourly file. Raises ValueError if it doesn't decompress, rather
+       than give the counts of the part that did."""
+    with open(path, 'rb') as f:
+        zcat = subprocess.Popen(['zcat'], stdin=f, stdout=subprocess.PIPE)
+    c = count_lines(zcat.stdout, redirects)
+    if zcat.wait() != 0:
+        raise ValueError('%s is corrupt or not gzipped (zcat exited with %d), delete it and download it again'
+                         % (path, zcat.returncode))
+    return path, c
+
+
+def partial_path(dump_dir, fn, folded=False):
+    # counts with redirects folded are kept apart, the two don't add up
+    return os.path.join(dump_dir, PARTIAL_DIR, fn + (FOLDED_SUFFIX if folded else PARTIAL_SUFFIX))
+
+
+def read_partial(path):
+    with gzip.open(path, 'rb') as f:
+        yield from spill_counter.read_run(f)
+
+
+def write_partial(partial, counts):
+    with gzip.open(partial + '.tmp', 'wb', compresslevel=1) as f:
+        spill_counter.write_run(f, sorted(counts.items()))
+    os.replace(partial + '.tmp', partial)
+
+
+def open_redirects(path, cache_size):
+    # one map per process, so its cache lasts from one file to the next
+    if path not in _redirect_maps:
+        _redirect_maps[path] = redirect_map.RedirectMap(path, cache_size)
+    return _redirect_maps[path]
+
+
+def make_partial(job):
+    """Counts the dump file of job, a (path, partial path, (redirect map path, cache size) or None), into its
+       partial file unless that's there already."""
+    path, partial, redirects = job
+    if not os.path.isfile(partial):
+        _, counts = count_file(path, open_redirects(*redirects) if redirects else None)
+        write_partial(partial, counts)
+    return path, partial
+
+
+def make_partials(jobs, workers=1):
+    """Yields (path, partial path) for every job of make_partial, done workers at a time in a process pool.
+       The counts of a file can be added to the total in any order, so they come back as they're done."""
+    if workers <= 1:
+        for job in jobs:
+            yield make_partial(job)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(make_partial, jobs):
+            yield result
+
+
+def dump_time(fn):
+    match = RE_DUMP_FILE.match(fn)
+    return datetime.datetime.strptime(match.group(1), '%Y%m%d-%H') if match else None
+
+
+def select_files(files, applied, start_date=None, window_days=None):
+    """Which of the dump files to add to the totals and which of the applied ones to take out of them, to end
+       up with the files from window_days before start_date (or the newest file) on. Without a window that's
+       all of them; the same goes for .gz files with a name that has no time."""
+    times = {fn: dump_time(fn) for fn in set(files) | set(applied)}
+    cutoff = None
+    if window_days:
+        if start_date:
+            end = datetime.datetime.strptime(start_date, '%Y%m%d')
+        else:
+            end = max([t for t in times.values() if t], default=None)
+            end = end and end + datetime.timedelta(hours=1)
+        cutoff = end and end - datetime.timedelta(days=window_days)
+
+    def inside(fn):
+        return cutoff is None or times[fn] is None or times[fn] >= cutoff
+    return (sorted(fn for fn in files if fn not in applied and inside(fn)),
+            sorted(fn for fn in applied if not inside(fn)))
+
+
+def aggregate(dump_dir, added, evicted, workers=1, memory=None, redirects=None, metrics=None):
+    """The change in views per title from adding the files added and taking out the files evicted, with the
+       counts of each file from its partial, which gets made first if it isn't there. With a RedirectMap the
+       titles are folded while counting."""
+    metrics = metrics or Metrics('import_stats')
+    # with a memory limit in MB the counts that don't fit go to sorted files next to the dumps
+    c = SpillCounter(memory, dump_dir) if memory else Counter()
+    os.makedirs(os.path.join(dump_dir, PARTIAL_DIR), exist_ok=True)
+    jobs = []
+    for fn in added + evicted:
+        path = os.path.join(dump_dir, fn)
+        partial = partial_path(dump_dir, fn, redirects is not None)
+        if not os.path.isfile(partial):
+            if not os.path.isfile(path):
+                raise ValueError('no counts left for %s, run again without --incremental' % fn)
+            jobs.append((path, partial, (redirects.path, redirects.cache_size) if redirects is not None else None))
+    # the files as they're counted, in this process or waiting on the workers that do
+    for path, partial in metrics.iterate('count', make_partials(jobs, workers), lambda job: os.path.getsize(job[0])):
+        print('counted', os.path.basename(path))
+    for sign, files in (1, added), (-1, evicted):
+        for fn in files:
+            partial = partial_path(dump_dir, fn, redirects is not None)
+            with metrics.timer('merge', 1, os.path.getsize(partial)):
+                for title, count in read_partial(partial):
+                    c[title] += sign * count
+    return c
+
+
+def upsert(cursor, counts, added, evicted, folded=False):
+    """Adds counts to wp.wikistats, with one COPY and one upsert, and records which files that was and whether
+       their redirects were folded."""
+    cursor.execute('CREATE TEMP TABLE wikistats_delta (title TEXT, viewcount BIGINT)')
+    writer = pg_copy.BinaryCopyWriter(cursor, 'wikistats_delta', ('title', 'viewcount'), ('text', 'int8'), COPY_BATCH)
+    for title, count in counts.items():
+        if count:
+            writer.write((title, count))
+    writer.flush()
+    cursor.execute('INSERT INTO wp.wikistats (title, viewcount) SELECT title, viewcount FROM wikistats_delta '
+                   'ON CONFLICT (title) DO UPDATE SET viewcount = wp.wikistats.viewcount + EXCLUDED.viewcount')
+    # only the titles that changed can have dropped to zero, there's no index on viewcount to find them
+    cursor.execute('DELETE FROM wp.wikistats t USING wikistats_delta d WHERE t.title = d.title AND t.viewcount <= 0')
+    cursor.execute('DROP TABLE wikistats_delta')
+    for fn in evicted:
+        cursor.execute('DELETE FROM wp.wikistats_files WHERE file = %s', (fn,))
+    for fn in added:
+        cursor.execute('INSERT INTO wp.wikistats_files (file, folded) VALUES (%s, %s)', (fn, folded))
+
+
+def remove_partials(dump_dir, files):
+    for fn in files:
+        for folded in False, True:
+            if os.path.isfile(partial_path(dump_dir, fn, folded)):
+                os.remove(partial_path(dump_dir, fn, folded))
+
+
+def main(dump_dir, cursor, dumps_to_fetch, start_date, base_url=BASE_URL, concurrency=downloader.CONCURRENCY,
+         memory=None, workers=1, window_days=None, redirects=None, metrics=None):
+    """Brings wp.wikistats up to date with the dump files in dump_dir, with the views of redirects counted
+       for their articles if there's a RedirectMap. Returns the files that left the window, their partials can
+       go once this is committed.
+
+       The metrics have the time spent downloading, counting files (count), adding up their partials (merge),
+       making rows for COPY (load) and waiting on postgres (db)."""
+    metrics = metrics or Metrics('import_stats')
+    if dumps_to_fetch > 0:
+        with metrics.timer('download'):
+            fetch_dumps_days(dump_dir, start_date, dumps_to_fetch, base_url, concurrency)
+
+    cursor.execute('SELECT file FROM wp.wikistats_files')
+    applied = set(row[0] for row in cursor.fetchall())
+    files = [fn for fn in os.listdir(dump_dir) if fn.endswith('.gz')]
+    added, evicted = select_files(files, applied, start_date, window_days)
+    print(len(added), 'files to add,', len(evicted), 'to take out,', len(applied) - len(evicted), 'already in')
+
+    c = aggregate(dump_dir, added, evicted, workers, memory, redirects, metrics)
+    with metrics.timer('load'):
+        upsert(Cursor(cursor, metrics), c, added, evicted, redirects is not None)
+    if memory:
+        c.close()
 
+    cursor.execute('SELECT title, viewcount FROM wp.wikistats ORDER BY viewcount DESC LIMIT 25')
     import pprint
-    pprint.pprint(c.most_common(25))
+    pprint.pprint(cursor.fetchall())
+    return evicted
 
 
 if __name__ == '__main__':
@@ -104,14 +325,43 @@ if __name__ == '__main__':
             help='randomly fetch this amount of dumps from the last year')
     parser.add_argument('start_date', type=str, help='YYYYMMDD formatted date to load stats to (last date)')
     parser.add_argument('dumps', type=str, help='directory where the downloaded page counts are stored')
+    parser.add_argument('--base_url', type=str, default=BASE_URL,
+            help='where the page view dumps are, a mirror of %s' % BASE_URL)
+    parser.add_argument('--concurrency', type=int, default=downloader.CONCURRENCY,
+            help='dumps downloaded at the same time')
+    parser.add_argument('--workers', type=int, default=1,
+            help='processes counting files at the same time')
+    parser.add_argument('--incremental', action='store_true',
+            help='only add the files that aren\'t in wp.wikistats yet, instead of starting over')
+    parser.add_argument('--window_days', type=int, default=None,
+            help='only count the files of this many days before start_date, the older ones are taken out again')
+    parser.add_argument('--redirects', type=str, nargs=2, metavar=('PAGE_DUMP', 'REDIRECT_DUMP'), default=None,
+            help='page.sql.gz and redirect.sql.gz of a wikipedia dump, to count the views of redirects for their '
+                 'articles. An --incremental run that changes this starts over')
+    parser.add_argument('--redirect_cache', type=int, default=redirect_map.CACHE_SIZE,
+            help='redirect lookups each counting process remembers')
+    parser.add_argument('--memory', type=int, default=None,
+            help='MB to use for counting, what doesn\'t fit is spilled to disk. By default everything is in memory')
+    parser.add_argument('--metrics_json', type=str, default=None,
+            help='append the throughput of every stage to this file as json lines')
+    parser.add_argument('--metrics_textfile', type=str, default=None,
+            help='keep the same in this .prom file for the textfile collector of the node exporter')
+    parser.add_argument('--metrics_interval', type=int, default=None,
+            help='seconds between writes of the metrics, a minute by default')
 
     args = parser.parse_args()
-    conn, cursor = setup_db(args.postgres)
+    stats_metrics = Metrics('import_stats', args.metrics_json, args.metrics_textfile, args.metrics_interval)
+    conn, cursor = setup_db(args.postgres, args.incremental, args.redirects is not None)
 
     if not os.path.isdir(args.dumps):
         os.makedirs(args.dumps)
 
-    main(args.dumps, cursor, args.dumps_to_fetch, args.start_date)
+    evicted = main(args.dumps, cursor, args.dumps_to_fetch, args.start_date, args.base_url, args.concurrency,
+                   args.memory, args.workers, args.window_days,
+                   redirect_map.load(*args.redirects, cache_size=args.redirect_cache) if args.redirects else None,
+                   stats_metrics)
 
-    conn.commit()
+    stats_metrics.commit(conn)
+    remove_partials(args.dumps, evicted)
+    stats_metrics.close()
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+import import_stats
+import redirect_map
+
+
+class FakeCursor():
+    # hands out the given results one query at a time
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+class TestImportStats(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        hours = [
+            'en Main_Page 10 0\nen Z%C3%BCrich 3 0\nen Talk:Main_Page 1 0\nde Z%C3%BCrich 7 0\n',
+            'en Main_Page 5 0\nen Berlin 2 0\nen.m Berlin 4 0\n',
+            'en Z%C3%BCrich 1 0\nen Berlin 1 0\n',
+        ]
+        for hour, text in enumerate(hours):
+            with gzip.open(os.path.join(self.dir, 'pageviews-20240101-%02d0000.gz' % hour), 'wt') as f:
+                f.write(text)
+        self.expected = {'Main Page': 15, 'Zürich': 4, 'Berlin': 3}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_count_file(self):
+        path, counts = import_stats.count_file(os.path.join(self.dir, 'pageviews-20240101-000000.gz'))
+        self.assertEqual(counts, Counter({'Main Page': 10, 'Zürich': 3}))
+
+    def test_select_files(self):
+        files = ['pageviews-20240101-230000.gz', 'pageviews-20240102-000000.gz', 'pageviews-20240103-050000.gz',
+                 'other.gz']
+        self.assertEqual(import_stats.select_files(files, set()), (sorted(files), []))
+        applied = {'pageviews-20231231-230000.gz', 'pageviews-20240101-230000.gz', 'other.gz'}
+        # the day before the newest file
+        self.assertEqual(import_stats.select_files(files, applied, window_days=1),
+                         (['pageviews-20240103-050000.gz'],
+                          ['pageviews-20231231-230000.gz', 'pageviews-20240101-230000.gz']))
+        self.assertEqual(import_stats.select_files(files, applied, '20240103', 2),
+                         (['pageviews-20240102-000000.gz', 'pageviews-20240103-050000.gz'],
+                          ['pageviews-20231231-230000.gz']))
+
+    def test_aggregate(self):
+        files = sorted(fn for fn in os.listdir(self.dir) if fn.endswith('.gz'))
+        for workers, memory in (1, None), (2, None), (2, 1):
+            counts = import_stats.aggregate(self.dir, files, [], workers, memory)
+            self.assertEqual(dict(counts.items()), self.expected)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'partials'))), [fn + '.counts' for fn in files])
+
+        # once counted, a file is taken out again from its partial, even when the dump is gone
+        os.remove(os.path.join(self.dir, files[0]))
+        counts = import_stats.aggregate(self.dir, [], files[:1], 1)
+        self.assertEqual(counts, Counter({'Main Page': -10, 'Zürich': -3}))
+        import_stats.remove_partials(self.dir, files[:1])
+        self.assertRaises(ValueError, import_stats.aggregate, self.dir, [], files[:1], 1)
+
+    def test_corrupt_file(self):
+        # like the error pages the downloader used to save, no partial is made so it's counted once it's fixed
+        fn = 'pageviews-20240101-030000.gz'
+        with open(os.path.join(self.dir, fn), 'w') as f:
+            f.write('<html><body>404 Not Found</body></html>\n')
+        self.assertRaises(ValueError, import_stats.aggregate, self.dir, [fn], [], 1)
+        self.assertFalse(os.path.exists(import_stats.partial_path(self.dir, fn)))
+
+    def test_fold_redirects(self):
+        redirects = redirect_map.write_map(os.path.join(self.dir, 'redirects.idx'),
+                                           {redirect_map.title_hash('Zürich'): 'Zurich'})
+        files = sorted(fn for fn in os.listdir(self.dir) if fn.endswith('.gz'))
+        counts = import_stats.aggregate(self.dir, files, [], 2, None, redirects)
+        self.assertEqual(dict(counts), {'Main Page': 15, 'Zurich': 4, 'Berlin': 3})
+        # kept apart from the unfolded counts
+        counts = import_stats.aggregate(self.dir, files, [], 1)
+        self.assertEqual(dict(counts), self.expected)
+
+    def test_has_unknown_files(self):
+        self.assertFalse(import_stats.has_unknown_files(FakeCursor((None, None))))
+        # counts from the import_stats without wp.wikistats_files, or with it empty
+        self.assertTrue(import_stats.has_unknown_files(FakeCursor(('wp.wikistats', None), (True,))))
+        self.assertTrue(import_stats.has_unknown_files(FakeCursor(('wp.wikistats', 'wp.wikistats_files'), (False,),
+                                                                  (True,))))
+        self.assertFalse(import_stats.has_unknown_files(FakeCursor(('wp.wikistats', 'wp.wikistats_files'), (True,))))
+        self.assertFalse(import_stats.has_unknown_files(FakeCursor(('wp.wikistats', None), (False,))))
+
+
+if __name__ == '__main__':
+    unittest.main()
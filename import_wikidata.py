@@ -3,63 +3,122 @@
 from collections import defaultdict
 
 import argparse
+import functools
+import gzip
+import marshal
 import subprocess
-import json
+import multiprocessing
 import os
 import re
+import struct
 
 import psycopg2
 from psycopg2 import extras
 
+import id_name_store
+import json_decoder
+import pg_copy
+import pipeline
+import post_import
+import staging
+from checkpoint import Checkpoint, skip_bytes
+from metrics import Cursor, Metrics, Reader
+
 DATE_PARSE_RE = re.compile(
     r'([-+]?[0-9]+)-([0-9][0-9])-([0-9][0-9])T([0-9][0-9]):([0-9][0-9]):([0-9][0-9])Z?')
 
 
-def setup_db(connection_string):
+TABLE = 'import.wikidata'
+STAGING = staging.staging_name(TABLE)
+
+# length of the marshalled record that follows in a spill file
+SPILL_RECORD = struct.Struct('<I')
+# lines sent to a worker at a time, entities run to tens of kb
+WORKER_BATCH = 64
+# rows per COPY, a row with all the labels and sitelinks is easily tens of kb
+COPY_BATCH = 1000
+
+COLUMNS = ('wikipedia_id', 'title', 'wikidata_id', 'labels', 'sitelinks', 'description', 'properties')
+COLUMN_TYPES = ('text', 'text', 'text', 'jsonb', 'jsonb', 'text', 'jsonb')
+INSERT_SQL = ('INSERT INTO ' + STAGING + ' (' + ', '.join(COLUMNS) + ') VALUES (' +
+              ', '.join(['%s'] * len(COLUMNS)) + ')')
+
+KEYS = [
+    ('wikidata_pkey', 'PRIMARY KEY', 'wikipedia_id'),
+    ('wd_wikidata_id_unique', 'UNIQUE', 'wikidata_id'),
+]
+INDEXES = [
+    ('wd_wikidata_wikidata_id', 'CREATE INDEX %s ON %s(wikidata_id)'),
+    ('wd_wikidata_properties', 'CREATE INDEX %s ON %s USING gin(properties)'),
+    ('wd_wikidata_properties_located_admin_btree',
+     '''CREATE INDEX %s
+        ON %s USING btree
+        ((properties ->> 'located in the administrative territorial entity'::text)
+        COLLATE pg_catalog."default" ASC NULLS LAST) TABLESPACE pg_default;'''),
+    ('wd_wikidata_properties_located_admin_gin',
+     '''CREATE INDEX %s
+        ON %s USING gin
+        ((properties -> 'located in the administrative territorial entity'::text))
+        TABLESPACE pg_default;'''),
+    ('wd_wikidata_wikipedia_id',
+     '''CREATE INDEX %s
+        ON %s USING btree
+        (wikipedia_id COLLATE pg_catalog."default" ASC NULLS LAST)
+        TABLESPACE pg_default;'''),
+    ('wd_wikidata_labels', 'CREATE INDEX %s ON %s USING gin(labels)'),
+    ('wd_wikidata_sitelinks', 'CREATE INDEX %s ON %s USING gin(sitelinks)'),
+]
+
+
+def setup_db(connection_string, resume=False):
+  """We load into import.wikidata_staging and only replace import.wikidata once it's complete.
+     When resuming we keep loading into the staging table that is there."""
   conn = psycopg2.connect(connection_string)
   cursor = conn.cursor()
+  if not resume:
+    create_tables(conn, cursor)
+  return conn, cursor
+
+
+def create_tables(conn, cursor):
   cursor.execute('CREATE SCHEMA IF NOT EXISTS import;')
-  cursor.execute('DROP TABLE IF EXISTS import.wikidata;')
-  cursor.execute('CREATE TABLE import.wikidata ('
-                 '    wikipedia_id TEXT PRIMARY KEY,'
-                 '    title TEXT,'
-                 '    wikidata_id TEXT,'
-                 '    description TEXT,'
-                 '    labels JSONB,'
-                 '    sitelinks JSONB,'
-                 '    properties JSONB, '
-                 '    CONSTRAINT wd_wikidata_id_unique UNIQUE (wikidata_id) '
-                 ');')
+  staging.create_staging(cursor, TABLE,
+                         '    wikipedia_id TEXT NOT NULL,'
+                         '    title TEXT,'
+                         '    wikidata_id TEXT,'
+                         '    description TEXT,'
+                         '    labels JSONB,'
+                         '    sitelinks JSONB,'
+                         '    properties JSONB ')
   cursor.execute('DROP TABLE IF EXISTS import.id2name;')
   cursor.execute('CREATE TABLE import.id2name ('
                  '    id TEXT PRIMARY KEY,'
                  '    title TEXT,'
                  '    CONSTRAINT id2name_wikidata_id UNIQUE (id)'
                  ');')
-
   conn.commit()
-  return conn, cursor
 
 
 def parse_wikidata(line):
 
-    line = line.decode("utf-8").strip()
-    if line and line[0] == '{':
-      if line[-1] == ',':
+    line = line.strip()
+    if line[:1] == b'{':
+      if line[-1:] == b',':
         line = line[:-1]
-      return json.loads(line)
+      return json_decoder.loads_entity(line)
 
 
-def map_value(value, id_name_map):
+def premap_value(value):
+  """map_value without the lookups in id_name_map. Returns (type, value) with entity ids and the globe
+     left for resolve_value, or None if there's nothing to map."""
   if not value or not 'type' in value or not 'value' in value:
     return None
   typ = value['type']
   value = value['value']
   if typ == 'string':
-    return value
+    return typ, value
   elif typ == 'wikibase-entityid':
-    entitiy_id = value['id']
-    return id_name_map.get(entitiy_id)
+    return typ, value['id']
   elif typ == 'time':
     time_split = DATE_PARSE_RE.match(value['time'])
     if not time_split:
@@ -69,133 +128,420 @@ def map_value(value, id_name_map):
       day = 1
     if month == 0:
       month = 1
-    return '%04d-%02d-%02dT%02d:%02d:%02d' % (year, month, day, hour, minute, second)
+    return typ, '%04d-%02d-%02dT%02d:%02d:%02d' % (year, month, day, hour, minute, second)
   elif typ == 'quantity':
-    return float(value['amount'])
+    return typ, float(value['amount'])
   elif typ == 'monolingualtext':
-    return value['text']
+    return typ, value['text']
   elif typ == 'globecoordinate':
     lat = value.get('latitude')
     lng = value.get('longitude')
     if lat or lng:
       res = {'lat': lat, 'lng': lng}
       globe = value.get('globe', '').rsplit('/', 1)[-1]
-      if globe != 'Q2' and globe in id_name_map:
+      if globe != 'Q2':
         res['globe'] = globe
       if value.get('altitude'):
         res['altitude'] = value['altitude']
-      return res
+      return typ, res
 
   return None
 
 
-def main(dump, cursor, conn):
+def resolve_value(typ, value, id_name_map):
+  if typ == 'wikibase-entityid':
+    return id_name_map.get(value)
+  if typ == 'globecoordinate' and 'globe' in value and not value['globe'] in id_name_map:
+    return {k: v for k, v in value.items() if k != 'globe'}
+  return value
+
+
+def map_value(value, id_name_map):
+  mapped = premap_value(value)
+  if not mapped:
+    return None
+  return resolve_value(*mapped, id_name_map)
+
+
+def entity_name(d):
+  """What other entities call this one: its english wikipedia title or else its english label."""
+  if d.get('sitelinks') and d['sitelinks'].get('enwiki'):
+    return d['sitelinks']['enwiki']['title']
+  elif d['labels'].get('en'):
+    return d['labels']['en']['value']
+  return None
+
+
+def preparse_entity(d):
+  """Everything we need to load an entity that doesn't depend on the names of other entities, or None if
+     it doesn't get loaded. The claims are kept as (property id, [(rank, type, value)]) until resolve_entity."""
+  wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
+  title = d['labels'].get('en', {}).get('value')
+  if not wikipedia_id or not title:
+    return None
+  labels = [d['labels'][x]['value'] for x in d.get('labels', {})]
+  sitelinks = [d.get('sitelinks')[x]['title']
+               for x in d.get('sitelinks', {})]
+  description = d['descriptions'].get('en', {}).get('value')
+  wikidata_id = d['id']
+  properties = {}
+  properties['sitelinks'] = d.get('sitelinks')
+  properties['labels'] = d.get('labels')
+
+  claims = []
+  for prop_id, prop_claims in d['claims'].items():
+    values = []
+    for claim in prop_claims:
+      mainsnak = claim.get('mainsnak')
+      if mainsnak:
+        mapped = premap_value(mainsnak.get('datavalue'))
+        if mapped:
+          values.append((claim['rank'], mapped[0], mapped[1]))
+    claims.append((prop_id, values))
+  return wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims
+
+
+def resolve_entity(entity, id_name_map):
+  """Turns a preparsed entity into the values of its row.
+
+     Properties are mapped in a way where we create lists as values for wiki entities if there is more
+     than one value. For other types, we always pick one value. If there is a preferred value, we'll
+     pick that one.
+     Mostly this does what you want. For filtering on colors for flags it alllows for the query:
+       SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
+     However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
+     and also ["Blue"].
+  """
+  wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, claims = entity
+  for prop_id, values in claims:
+    prop_name = id_name_map.get(prop_id)
+    if prop_name:
+      ranks = defaultdict(list)
+      for rank, typ, value in values:
+        data_value = resolve_value(typ, value, id_name_map)
+        if data_value:
+          lst = ranks[rank]
+          if typ != 'wikibase-entityid':
+            del lst[:]
+          lst.append(data_value)
+      for r in 'preferred', 'normal', 'depricated':
+        value = ranks[r]
+        if value:
+          if len(value) == 1:
+            value = value[0]
+          else:
+            value = sorted(value)
+          properties[prop_name] = value
+          break
+  return wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties
+
+
+def entity_row(d, id_name_map):
+  """(lastrevid, row) for an entity, row is None when the entity isn't loaded."""
+  entity = preparse_entity(d)
+  return int(d.get('lastrevid', 0)), entity and resolve_entity(entity, id_name_map)
+
+
+def read_lines(dump, position=0, metrics=None):
+  """Yields (offset of the line in the decompressed dump, line) starting at position."""
+  stream = Reader(subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout,
+                  metrics or Metrics('import_wikidata'))
+  skip_bytes(stream, position)
+  for line in stream:
+    yield position, line
+    position += len(line)
+
+
+def read_entities(dump, position=0, metrics=None):
+  """Yields (offset of the line in the decompressed dump, entity) starting at position."""
+  metrics = metrics or Metrics('import_wikidata')
+  for line_start, line in read_lines(dump, position, metrics):
+    with metrics.timer('parse', 1, len(line)):
+      d = parse_wikidata(line)
+    if d:
+      yield line_start, d
+
+
+# the id -> name store of a worker process, set by init_worker
+_worker_names = None
+
+
+def init_worker(id_name_map, json_backend):
+  global _worker_names
+  _worker_names = id_name_map
+  json_decoder.use(json_backend)
+
+
+def decode_batch(lines):
+  # runs in the worker processes; None for the lines that aren't entities
+  results = []
+  for _, line in lines:
+    d = parse_wikidata(line)
+    results.append(d and entity_row(d, _worker_names))
+  return results
+
+
+def iter_entity_rows(dump, id_name_map, position=0, workers=1, metrics=None):
+  """Yields (offset, lastrevid, row) for every entity from position on, decoding them in workers processes.
+     The store is pickled as just its path, so each worker maps the same file rather than getting a copy."""
+  metrics = metrics or Metrics('import_wikidata')
+  if workers <= 1:
+    for line_start, d in read_entities(dump, position, metrics):
+      with metrics.timer('transform', 1):
+        row = entity_row(d, id_name_map)
+      yield (line_start,) + row
+    return
+
+  with multiprocessing.Pool(workers, initializer=init_worker, initargs=(id_name_map, json_decoder.backend())) as pool:
+    batches = pipeline.batched(read_lines(dump, position, metrics), WORKER_BATCH)
+    # the time spent waiting on the workers, which parse and transform
+    for batch, results in metrics.iterate('workers', pipeline.ordered_imap(pool, decode_batch, batches, workers * 4)):
+      for (line_start, _), result in zip(batch, results):
+        if result:
+          yield (line_start,) + result
+
+
+def write_spill(dump, spill, writer, metrics=None):
+  """The one pass over the dump when we have a spill file: the names go to the id_name_store writer and the
+     entities we load go to the spill file preparsed, with the max revision id so far. A last record without
+     an entity has the max revision id of the whole dump."""
+  metrics = metrics or Metrics('import_wikidata')
+  c = 0
+  skip = 0
+  maxrevid = 0
+  with gzip.open(spill + '.tmp', 'wb', compresslevel=1) as out:
+    for _, d in read_entities(dump, metrics=metrics):
+      c += 1
+      if c % 1000 == 0:
+        print(c, skip)
+      with metrics.timer('spill', 1):
+        maxrevid = max(int(d.get('lastrevid', 0)), maxrevid)
+        name = entity_name(d)
+        if name is None:
+          skip += 1
+          continue
+        writer.add(d['id'], name)
+        entity = preparse_entity(d)
+        if entity:
+          record = marshal.dumps((maxrevid, entity))
+          out.write(SPILL_RECORD.pack(len(record)))
+          out.write(record)
+    record = marshal.dumps((maxrevid, None))
+    out.write(SPILL_RECORD.pack(len(record)))
+    out.write(record)
+  os.replace(spill + '.tmp', spill)
+
+
+def read_spill(spill, position=0):
+  """Yields (offset, max revision id, entity) from a spill file, starting at position."""
+  with gzip.open(spill, 'rb') as f:
+    skip_bytes(f, position)
+    while True:
+      head = f.read(SPILL_RECORD.size)
+      if not head:
+        return
+      size, = SPILL_RECORD.unpack(head)
+      maxrevid, entity = marshal.loads(f.read(size))
+      yield position, maxrevid, entity
+      position += SPILL_RECORD.size + size
+
+
+class InsertSink():
+  def __init__(self, cursor):
+    self._cursor = cursor
+
+  def write(self, row):
+    wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties = row
+    self._cursor.execute(INSERT_SQL, (wikipedia_id, title, wikidata_id, extras.Json(labels), extras.Json(sitelinks),
+                                      description, extras.Json(properties)))
+
+  def flush(self):
+    pass
+
+
+def make_sink(loader, cursor, batch_size=COPY_BATCH):
+  if loader == 'insert':
+    return InsertSink(cursor)
+  return pg_copy.BinaryCopyWriter(cursor, STAGING, COLUMNS, COLUMN_TYPES, batch_size)
+
+
+def main(dump, cursor, conn, checkpoint=None, resume_state=None, spill=None, workers=1, loader='copy',
+         batch_size=COPY_BATCH, metrics=None):
   """We do two scans:
-     - first collect the id -> name / wikipedia title
+     - first collect the id -> name / wikipedia title into properties.idx, an id_name_store that is
+       mmapped rather than held in a dict (that took 5Gb)
      - then store the actual objects with a json property.
-     The first step takes quite a bit of memory (5Gb) - could possibly be done using a temporary table in postgres.
+     The second step saves its position to the checkpoint on every commit; the first one is only done
+     once anyway as its result is kept in properties.idx.
+     Decompressing the dump is the slow part of both, so with a spill file the first scan also keeps the
+     entities we load, preparsed, and the second scan reads those instead of the dump.
+     Otherwise the second scan can decode and map the entities in worker processes, the inserts and the
+     dedup stay here so the result doesn't depend on the number of workers.
+
+     The metrics have the time spent waiting on bzcat (decompress), decoding the json (parse), the first scan
+     apart from that (names or spill), mapping the values (transform), making rows for COPY (load) and waiting
+     on postgres (db).
   """
-  maxrevid = 0
-  id_name_map = {}
-  if os.path.isfile('properties.json'):
-      print('loading properties from file')
-      id_name_map = json.load(open('properties.json'))
+  metrics = metrics or Metrics('import_wikidata')
+  id_name_map = id_name_store.load()
+  if resume_state and resume_state.get('spill'):
+    spill = resume_state['spill']
+    spilled = read_spill(spill, resume_state['position'])
+  elif id_name_map is None and spill:
+    writer = id_name_store.StoreWriter(id_name_store.STORE_FILE)
+    write_spill(dump, spill, writer, metrics)
+    id_name_map = writer.close()
+    spilled = read_spill(spill)
   else:
-    c = 0
-    skip = 0
-    for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-        d = parse_wikidata(line)
-        if not d:
-            print('Failed to parse', line[0])
+    if id_name_map is not None:
+      print('loading properties from file')
+    else:
+      writer = id_name_store.StoreWriter(id_name_store.STORE_FILE)
+      c = 0
+      skip = 0
+      for line in Reader(subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout, metrics):
+        with metrics.timer('names', 1, len(line)):
+          d = parse_wikidata(line)
+          if not d:
+              print('Failed to parse', line[0])
+              continue
+          c += 1
+          if c % 1000 == 0:
+            print(c, skip)
+          value = entity_name(d)
+          if value is None:
+            skip += 1
             continue
-        c += 1
-        if c % 1000 == 0:
-          print(c, skip)
-        if d.get('sitelinks') and d['sitelinks'].get('enwiki'):
-          value = d['sitelinks']['enwiki']['title']
-        elif d['labels'].get('en'):
-          value = id_name_map[d['id']] = d['labels']['en']['value']
-        else:
-          skip += 1
-          continue
-        id_name_map[d['id']] = value
+          writer.add(d['id'], value)
 
-    json.dump(id_name_map, open('properties.json', 'w'))
+      # the store is only put in place once it's complete, so a crash doesn't leave half of it for the next run
+      id_name_map = writer.close()
+    spill = None
+    position = resume_state['position'] if resume_state else 0
+    rows = iter_entity_rows(dump, id_name_map, position, workers, metrics)
+  if spill:
+    rows = metrics.iterate('transform', ((position, maxrevid, entity and resolve_entity(entity, id_name_map))
+                                         for position, maxrevid, entity in metrics.iterate('read_spill', spilled)))
 
+  sink = make_sink(loader, Cursor(cursor, metrics), batch_size)
   wp_ids = set()
   c = 0
   rec = 0
   dupes = 0
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-    d = parse_wikidata(line)
-    if not d:
-        continue
-    lastrevid = int(d.get('lastrevid', 0))
-    maxrevid = max(lastrevid, maxrevid)
+  maxrevid = 0
+  if resume_state:
+    c, rec, dupes, maxrevid = resume_state['count'], resume_state['rec'], resume_state['dupes'], resume_state['maxrevid']
+    cursor.execute('SELECT wikipedia_id FROM ' + STAGING)
+    wp_ids = set(row[0] for row in cursor)
+    if len(wp_ids) != rec:
+      raise RuntimeError('the staging table has %d rows, the checkpoint %d' % (len(wp_ids), rec))
+    print('Resuming after', c, 'entities')
+  for position, lastrevid, row in rows:
     c += 1
     if c % 1000 == 0:
       print(c, rec, dupes)
     if c % 10000 == 0:
-      conn.commit()
-
-    labels = [d['labels'][x]['value'] for x in d.get('labels', {})]
-    sitelinks = [d.get('sitelinks')[x]['title']
-                 for x in d.get('sitelinks', {})]
-
-    wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
-    title = d['labels'].get('en', {}).get('value')
-    description = d['descriptions'].get('en', {}).get('value')
-    wikidata_id = d['id']
-    properties = {}
-    properties['sitelinks'] = d.get('sitelinks')
-    properties['labels'] = d.get('labels')
-
-    if wikipedia_id and title:
-      # There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key
-      # but that doesn't fix the underlying dupe
-      if wikipedia_id in wp_ids:
-        dupes += 1
-        continue
-      wp_ids.add(wikipedia_id)
-      # Properties are mapped in a way where we create lists as values for wiki entities if there is more
-      # than one value. For other types, we always pick one value. If there is a preferred value, we'll
-      # pick that one.
-      # Mostly this does what you want. For filtering on colors for flags it alllows for the query:
-      #   SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
-      # However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
-      # and also ["Blue"].
-      for prop_id, claims in d['claims'].items():
-        prop_name = id_name_map.get(prop_id)
-        if prop_name:
-          ranks = defaultdict(list)
-          for claim in claims:
-            mainsnak = claim.get('mainsnak')
-            if mainsnak:
-              data_value = map_value(mainsnak.get('datavalue'), id_name_map)
-              if data_value:
-                lst = ranks[claim['rank']]
-                if mainsnak['datavalue'].get('type') != 'wikibase-entityid':
-                  del lst[:]
-                lst.append(data_value)
-          for r in 'preferred', 'normal', 'depricated':
-            value = ranks[r]
-            if value:
-              if len(value) == 1:
-                value = value[0]
-              else:
-                value = sorted(value)
-              properties[prop_name] = value
-              break
-
-      rec += 1
-      cursor.execute('INSERT INTO import.wikidata (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                     (wikipedia_id, title, wikidata_id, extras.Json(labels), extras.Json(sitelinks), description, extras.Json(properties)))
+      with metrics.timer('load'):
+        sink.flush()
+      metrics.commit(conn)
+      if checkpoint:
+        # everything before this entity is committed
+        checkpoint.save(position=position, count=c - 1, rec=rec, dupes=dupes, maxrevid=maxrevid, spill=spill)
+    maxrevid = max(lastrevid, maxrevid)
+    if not row:
+      continue
+
+    # There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key
+    # but that doesn't fix the underlying dupe
+    wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties = row
+    if wikipedia_id in wp_ids:
+      dupes += 1
+      continue
+    wp_ids.add(wikipedia_id)
+
+    rec += 1
+    with metrics.timer('load', 1):
+      sink.write((wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties))
+  with metrics.timer('load'):
+    sink.flush()
 
   # save max rev id as it's going to be used by update script
   with open('maxrevid.txt', 'w') as f:
       f.write(str(maxrevid))
 
 
+def fill_geo(cursor, source):
+  cursor.execute('INSERT into %s (wikidata_id, geometry) ' % staging.staging_name('import.geo') +
+                 'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((properties->\'coordinate location\'->>\'lng\')::DECIMAL, '
+                 '(properties->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
+                 'FROM %s WHERE properties->\'coordinate location\' IS NOT NULL;' % source
+                 )
+
+
+def fill_labels(cursor, source):
+  # the staging table has no unique constraint yet, so the ON CONFLICT DO NOTHING became a DISTINCT
+  cursor.execute('INSERT INTO %s (wikidata_id, label) ' % staging.staging_name('import.labels') +
+                 'SELECT DISTINCT wikidata_id, label FROM '
+                 '(SELECT wikidata_id, jsonb_array_elements_text(labels) AS label FROM %s) labels;' % source
+                 )
+
+
+def fill_instance(cursor, source):
+  cursor.execute('INSERT INTO %s (wikidata_id, instance_of) ' % staging.staging_name('import.instance') +
+                 'SELECT wikidata_id, lower(properties->>\'instance of\')::jsonb '
+                 'FROM %s WHERE jsonb_typeof(properties->\'instance of\') = \'array\';' % source
+                 )
+  cursor.execute('INSERT INTO %s (wikidata_id, instance_of) ' % staging.staging_name('import.instance') +
+                 'SELECT wikidata_id, jsonb_build_array(lower(properties->>\'instance of\')) '
+                 'FROM %s WHERE jsonb_typeof(properties->\'instance of\') = \'string\';' % source
+                 )
+
+
+# tables derived from import.wikidata, as (table, columns, fill, indexes, keys). fill takes the cursor and
+# the table to read from and fills the staging table of the derived one.
+DERIVED = [
+    ('import.geo',
+     '    wikidata_id TEXT,'
+     '    geometry geometry(POINT, 4326)',
+     fill_geo,
+     [('wd_geo_geometry', 'CREATE INDEX %s ON %s USING gist (geometry) TABLESPACE pg_default;')],
+     [('wd_geo_unique', 'UNIQUE', 'wikidata_id')]),
+    ('import.labels',
+     '    wikidata_id TEXT,'
+     '    label TEXT',
+     fill_labels,
+     [('wd_wikidata_labels_trgm',
+       'CREATE INDEX %s ON %s USING gist (label COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')],
+     [('wd_label_unique', 'UNIQUE', 'wikidata_id, label')]),
+    ('import.instance',
+     '    wikidata_id TEXT,'
+     '    instance_of TEXT',
+     fill_instance,
+     [('wd_wikidata_instance',
+       'CREATE INDEX %s ON %s USING gist (instance_of COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')],
+     [('wd_instance_unique', 'UNIQUE', 'wikidata_id')]),
+]
+
+
+def create_derived(cursor, table, columns, fill):
+  staging.create_staging(cursor, table, columns)
+  fill(cursor, STAGING)
+
+
+def post_import_steps():
+  """The keys and indexes of import.wikidata and the derived tables. Those are filled from the staging table
+     once it's logged, so they get built while its indexes are, and all four tables are swapped in together."""
+  steps = post_import.staged_steps(TABLE, INDEXES, KEYS)
+  tables = [(TABLE, INDEXES, KEYS)]
+  for table, columns, fill, indexes, keys in DERIVED:
+    steps.append(post_import.Step('fill ' + table,
+                                  functools.partial(create_derived, table=table, columns=columns, fill=fill),
+                                  (post_import.logged_step(TABLE),)))
+    steps += post_import.staged_steps(table, indexes, keys, after=['fill ' + table])
+    tables.append((table, indexes, keys))
+  return steps + post_import.swap_steps(tables, steps)
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
       description='Import wikidata into postgress')
@@ -203,75 +549,57 @@ if __name__ == '__main__':
                       help='postgres connection string')
   parser.add_argument('dump', type=str,
                       help='BZipped wikipedia dump')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue from the last checkpoint of an import of this dump that didn\'t finish')
+  parser.add_argument('--json', type=str, choices=json_decoder.BACKENDS, default=None,
+                      help='json library to decode the entities with, by default the fastest one installed')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='decode and map the entities in this many processes')
+  parser.add_argument('--loader', choices=('copy', 'insert'), default='copy',
+                      help='load the rows with binary COPY in batches or with an INSERT per row')
+  parser.add_argument('--batch_size', type=int, default=COPY_BATCH,
+                      help='rows per COPY batch')
+  parser.add_argument('--connections', type=int, default=post_import.CONNECTIONS,
+                      help='connections to build the indexes and derived tables on at the same time')
+  parser.add_argument('--maintenance_work_mem', type=str, default=post_import.MAINTENANCE_WORK_MEM,
+                      help='maintenance_work_mem of each of those connections')
+  parser.add_argument('--parallel_maintenance_workers', type=int, default=post_import.PARALLEL_MAINTENANCE_WORKERS,
+                      help='max_parallel_maintenance_workers of each of those connections')
+  parser.add_argument('--spill', type=str, default=None,
+                      help='decompress the dump only once, keeping the entities to load in this file until '
+                           'all names are known')
+  parser.add_argument('--metrics_json', type=str, default=None,
+                      help='append the throughput of every stage to this file as json lines')
+  parser.add_argument('--metrics_textfile', type=str, default=None,
+                      help='keep the same in this .prom file for the textfile collector of the node exporter')
+  parser.add_argument('--metrics_interval', type=int, default=None,
+                      help='seconds between writes of the metrics, a minute by default')
 
   args = parser.parse_args()
-  conn, cursor = setup_db(args.postgres)
-
-  main(args.dump, cursor, conn)
-
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_wikidata_id ON import.wikidata(wikidata_id)')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_properties ON import.wikidata USING gin(properties)')
-  cursor.execute('''CREATE INDEX wd_wikidata_properties_located_admin_btree
-                    ON wd.wikidata USING btree
-                    ((properties ->> 'located in the administrative territorial entity'::text)
-                    COLLATE pg_catalog."default" ASC NULLS LAST) TABLESPACE pg_default;''')
-  cursor.execute('''CREATE INDEX wd_wikidata_properties_located_admin_gin
-                    ON wd.wikidata USING gin
-                    ((properties -> 'located in the administrative territorial entity'::text))
-                    TABLESPACE pg_default;''')
-  cursor.execute('''CREATE INDEX wd_wikidata_wikipedia_id
-                    ON wd.wikidata USING btree
-                    (wikipedia_id COLLATE pg_catalog."default" ASC NULLS LAST)
-                    TABLESPACE pg_default;''')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_labels ON import.wikidata USING gin(labels)')
-  cursor.execute(
-      'CREATE INDEX wd_wikidata_sitelinks ON import.wikidata USING gin(sitelinks)')
-  conn.commit()
-  cursor.execute('DROP TABLE IF EXISTS import.geo')
-  cursor.execute('CREATE TABLE import.geo ('
-                 '    wikidata_id TEXT,'
-                 '    geometry geometry(POINT, 4326),'
-                 '    CONSTRAINT wd_geo_unique UNIQUE (wikidata_id)'
-                 ')')
-  cursor.execute('INSERT into import.geo (wikidata_id, geometry) '
-                 'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((properties->\'coordinate location\'->>\'lng\')::DECIMAL, '
-                 '(properties->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
-                 'FROM import.wikidata WHERE properties->\'coordinate location\' IS NOT NULL;'
-                 )
-  cursor.execute(
-      'CREATE INDEX wd_geo_geometry ON import.geo USING gist (geometry) TABLESPACE pg_default;')
-  conn.commit()
-  cursor.execute('DROP TABLE IF EXISTS import.labels')
-  cursor.execute('CREATE TABLE import.labels ('
-                 '    wikidata_id TEXT,'
-                 '    label TEXT,'
-                 '    CONSTRAINT wd_label_unique UNIQUE (wikidata_id, label)'
-                 ')'
-                 )
-  cursor.execute('INSERT INTO import.labels (wikidata_id, label) SELECT wikidata_id, jsonb_array_elements_text(labels) '
-                 'FROM import.wikidata ON CONFLICT DO NOTHING;'
-                 )
-  cursor.execute('CREATE INDEX wd_wikidata_labels_trgm ON import.labels USING gist (label COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')
-  conn.commit()
+  import_metrics = Metrics('import_wikidata', args.metrics_json, args.metrics_textfile, args.metrics_interval)
+  print('decoding json with', json_decoder.use(args.json))
+  checkpoint = Checkpoint(args.dump)
+  state = checkpoint.load() if args.resume else None
+  if args.resume and not state:
+    print('No checkpoint to resume from, starting from the beginning')
+  conn, cursor = setup_db(args.postgres, resume=state is not None)
+  if state and staging.staging_rows(cursor, TABLE) != state['rec']:
+    # postgres restarted and emptied the unlogged staging table, what the checkpoint skips is gone
+    print('The staging table no longer has the', state['rec'], 'rows of the checkpoint, starting over')
+    create_tables(conn, cursor)
+    state = None
 
-  cursor.execute('DROP TABLE IF EXISTS import.instance')
-  cursor.execute('CREATE TABLE import.instance ('
-                 '    wikidata_id TEXT,'
-                 '    instance_of TEXT,'
-                 '    CONSTRAINT wd_instance_unique UNIQUE (wikidata_id)'
-                 ');'
-                 )
-  cursor.execute('INSERT INTO import.instance (wikidata_id, instance_of) '
-                 'SELECT wikidata_id, lower(properties->>\'instance of\')::jsonb '
-                 'FROM import.wikidata WHERE jsonb_typeof(properties->\'instance of\') = \'array\';'
-                 )
-  cursor.execute('INSERT INTO import.instance (wikidata_id, instance_of) '
-                 'SELECT wikidata_id, jsonb_build_array(lower(properties->>\'instance of\')) '
-                 'FROM import.wikidata WHERE jsonb_typeof(properties->\'instance of\') = \'string\';'
-                 )
-  cursor.execute('CREATE INDEX wd_wikidata_instance ON import.instance USING gist (instance_of COLLATE pg_catalog."default" gist_trgm_ops) TABLESPACE pg_default;')
+  main(args.dump, cursor, conn, checkpoint, state, args.spill, args.workers, args.loader, args.batch_size,
+       import_metrics)
+  import_metrics.commit(conn)
+  conn.close()
 
-  conn.commit()
+  with import_metrics.timer('post_import'):
+    post_import.run(functools.partial(post_import.connect, args.postgres, args.maintenance_work_mem,
+                                      args.parallel_maintenance_workers),
+                    post_import_steps(), args.connections)
+  checkpoint.clear()
+  for spill in args.spill, state and state.get('spill'):
+    if spill and os.path.isfile(spill):
+      os.remove(spill)
+  import_metrics.close()
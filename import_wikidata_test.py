@@ -1,8 +1,42 @@
 #!/usr/bin/env python
 
+import bz2
 import json
+import os
+import shutil
+import tempfile
 import unittest
-from import_wikidata import parse_wikidata, map_value
+
+import id_name_store
+from import_wikidata import (parse_wikidata, map_value, preparse_entity, resolve_entity, write_spill, read_spill,
+                             iter_entity_rows)
+
+
+def entity(wikidata_id, title, lastrevid, claims):
+  return {'id': wikidata_id, 'lastrevid': lastrevid,
+          'labels': {'en': {'language': 'en', 'value': title}},
+          'descriptions': {},
+          'sitelinks': {'enwiki': {'site': 'enwiki', 'title': title}} if claims is not None else {},
+          'claims': claims or {}}
+
+
+def claim(datavalue, rank='normal'):
+  return {'mainsnak': {'datavalue': datavalue}, 'rank': rank}
+
+
+ENTITIES = [
+  entity('P31', 'instance of', 5, None),
+  entity('Q64', 'Berlin', 9, {
+    'P31': [claim({'type': 'wikibase-entityid', 'value': {'id': 'Q515'}}),
+            claim({'type': 'wikibase-entityid', 'value': {'id': 'Q5119'}})],
+    'P625': [claim({'type': 'globecoordinate', 'value': {'latitude': 52, 'longitude': 13,
+                    'globe': 'http://www.wikidata.org/entity/Q405'}})],
+    'P1082': [claim({'type': 'quantity', 'value': {'amount': '+1'}}),
+              claim({'type': 'quantity', 'value': {'amount': '+2'}}, 'preferred')]}),
+  entity('Q515', 'city', 7, {}),
+  entity('P625', 'coordinate location', 3, None),
+  entity('P1082', 'population', 4, None),
+]
 
 class TestImportWikidata(unittest.TestCase):
   def test_parse_wikidata(self):
@@ -35,5 +69,51 @@ class TestImportWikidata(unittest.TestCase):
             'type': 'time'}
     self.assertEqual(map_value(time, {}), '2001-12-01T00:00:00')
 
+  def test_resolve_entity(self):
+    names = {d['id']: d['labels']['en']['value'] for d in ENTITIES}
+    self.assertIsNone(preparse_entity(ENTITIES[0]))
+    row = resolve_entity(preparse_entity(ENTITIES[1]), names)
+    self.assertEqual(row[:6], ('Berlin', 'Berlin', 'Q64', ['Berlin'], ['Berlin'], None))
+    self.assertEqual(row[6]['instance of'], 'city')
+    self.assertEqual(row[6]['coordinate location'], {'lat': 52, 'lng': 13})
+    self.assertEqual(row[6]['population'], 2.0)
+
+  def write_dump(self, tmp):
+    dump = os.path.join(tmp, 'latest-all.json.bz2')
+    with bz2.open(dump, 'wt') as f:
+      f.write('[\n' + ',\n'.join(json.dumps(d) for d in ENTITIES) + '\n]\n')
+    return dump
+
+  def test_workers_match_single_process(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      dump = self.write_dump(tmp)
+      names = id_name_store.write_store(os.path.join(tmp, 'properties.idx'),
+                                        ((d['id'], d['labels']['en']['value']) for d in ENTITIES))
+      expected = list(iter_entity_rows(dump, names))
+      self.assertEqual([row and row[0] for _, _, row in expected], [None, 'Berlin', 'city', None, None])
+      self.assertEqual(list(iter_entity_rows(dump, names, workers=2)), expected)
+      self.assertEqual(list(iter_entity_rows(dump, names, expected[2][0], workers=2)), expected[2:])
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_spill(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      dump = self.write_dump(tmp)
+      writer = id_name_store.StoreWriter(os.path.join(tmp, 'properties.idx'))
+      spill = os.path.join(tmp, 'spill')
+      write_spill(dump, spill, writer)
+      names = writer.close()
+      self.assertEqual(names.get('P1082'), 'population')
+
+      records = list(read_spill(spill))
+      self.assertEqual([(maxrevid, e and e[2]) for _, maxrevid, e in records],
+                       [(9, 'Q64'), (9, 'Q515'), (9, None)])
+      self.assertEqual(resolve_entity(records[0][2], names), resolve_entity(preparse_entity(ENTITIES[1]), names))
+      self.assertEqual(list(read_spill(spill, records[1][0])), records[1:])
+    finally:
+      shutil.rmtree(tmp)
+
 if __name__ == '__main__':
   unittest.main()
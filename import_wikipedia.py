@@ -1,6 +1,11 @@
 #!/bin/python3
 
 import argparse
+import bz2
+import functools
+import io
+import multiprocessing
+import os
 import subprocess
 import xml.sax
 
@@ -9,31 +14,84 @@ import psycopg2
 import re
 from progressbar import ProgressBar, Bar, SimpleProgress, Percentage, RotatingMarker, AdaptiveETA, UnknownLength
 
+import page_extractor
+import pg_copy
+import pipeline
+import post_import
+import staging
+import wikitext_scan
+from checkpoint import Checkpoint, skip_bytes
+from metrics import Cursor, Metrics, Reader
+
 CAT_PREFIX = 'Category:'
 INFOBOX_PREFIX = 'infobox '
 
 RE_GENERAL = re.compile('(.+?)(\ (in|of|by)\ )(.+)')
 
-def setup_db(connection_string):
+COMMIT_EVERY = 100000
+# pages per task handed to a worker process
+WORKER_BATCH = 256
+# bz2 streams (of about 100 pages each) per task when reading a multistream dump
+STREAMS_PER_TASK = 10
+# rows per COPY
+COPY_BATCH = 10000
+
+TABLE = 'import.wikipedia'
+STAGING = staging.staging_name(TABLE)
+COLUMNS = ('id', 'title', 'infobox', 'wikitext', 'templates', 'categories', 'general')
+INSERT_SQL = ('INSERT INTO %s (%s) ' % (STAGING, ', '.join(COLUMNS)) +
+              'VALUES (%s, %s, %s, %s, %s, %s, %s)')
+
+KEYS = [('wikipedia_pkey', 'PRIMARY KEY', 'title')]
+INDEXES = [
+    ('wp_wikipedia_infobox', 'CREATE INDEX %s ON %s(infobox)'),
+    ('wp_wikipedia_templates', 'CREATE INDEX %s ON %s USING gin(templates)'),
+    ('wp_wikipedia_categories', 'CREATE INDEX %s ON %s USING gin(categories)'),
+    ('wp_wikipedia_general', 'CREATE INDEX %s ON %s USING gin(general)'),
+]
+
+def setup_db(connection_string, resume=False):
+  """We load into import.wikipedia_staging and only replace import.wikipedia once it's complete.
+     When resuming we keep loading into the staging table that is there."""
   conn = psycopg2.connect(connection_string)
   cursor = conn.cursor()
+  if not resume:
+    create_tables(conn, cursor)
+  return conn, cursor
+
+
+def create_tables(conn, cursor):
   cursor.execute('CREATE SCHEMA IF NOT EXISTS import;')
-  cursor.execute('DROP TABLE IF EXISTS import.wikipedia')
-  cursor.execute('CREATE TABLE import.wikipedia ('
-                 '    id integer,'
-                 '    title TEXT PRIMARY KEY,'
-                 '    infobox TEXT,'
-                 '    wikitext TEXT,'
-                 '    templates TEXT[] NOT NULL DEFAULT \'{}\','
-                 '    categories TEXT[] NOT NULL DEFAULT \'{}\','
-                 '    general TEXT[] NOT NULL DEFAULT \'{}\''
-                 ')')
+  staging.create_staging(cursor, TABLE,
+                         '    id integer,'
+                         '    title TEXT NOT NULL,'
+                         '    infobox TEXT,'
+                         '    wikitext TEXT,'
+                         '    templates TEXT[] NOT NULL DEFAULT \'{}\','
+                         '    categories TEXT[] NOT NULL DEFAULT \'{}\','
+                         '    general TEXT[] NOT NULL DEFAULT \'{}\'')
+  conn.commit()
 
-  return conn, cursor
+
+def remove_duplicates(cursor):
+  # even though we shouldn't get dupes, sometimes wikidumps are faulty. The staging table has no
+  # primary key to stop them, so keep the first one loaded for every title like before.
+  cursor.execute('DELETE FROM %s WHERE ctid IN ('
+                 '  SELECT ctid FROM ('
+                 '    SELECT ctid, row_number() OVER (PARTITION BY title ORDER BY ctid) AS n FROM %s'
+                 '  ) dupes WHERE n > 1)' % (STAGING, STAGING))
+
+
+def post_import_steps():
+  """Deduplicate, then the primary key and the indexes side by side, then the swap."""
+  steps = [post_import.Step('remove duplicates', remove_duplicates, ())]
+  steps += post_import.staged_steps(TABLE, INDEXES, KEYS, after=['remove duplicates'])
+  return steps + post_import.swap_steps([(TABLE, INDEXES, KEYS)], steps)
 
 
 def make_tags(iterable):
-  return list(set(x.strip().lower() for x in iterable if x and len(x) < 256))
+  # sorted so that rows don't depend on the hash seed of the process that analyzed them
+  return sorted(set(x.strip().lower() for x in iterable if x and len(x) < 256))
 
 
 def strip_template_name(name):
@@ -47,24 +105,70 @@ def extact_general(category):
   return None
 
 
-class WikiXmlHandler(xml.sax.handler.ContentHandler):
-  def __init__(self, cursor, conn):
-    xml.sax.handler.ContentHandler.__init__(self)
-    self._db_cursor = cursor
-    self._db_conn = conn
-    self._count = 0
-    self._pbar = ProgressBar(widgets=[Bar(),SimpleProgress(), AdaptiveETA()], maxval=UnknownLength)
-    self.reset()
+def make_analysis(title, templates, template_names, links):
+  template_names = make_tags(template_names)
+  infobox = None
+  for template in template_names:
+    if template.startswith(INFOBOX_PREFIX):
+      infobox = template[len(INFOBOX_PREFIX):]
+      break
+  if len(infobox or '') > 1024 or len(title) > 1024:
+    print('Too long')
+    raise mwparserfromhell.parser.ParserError('too long')
+  categories = make_tags(l[len(CAT_PREFIX):] for l in links if l.startswith(CAT_PREFIX))
+  general = make_tags(extact_general(x) for x in categories)
+  return infobox, make_tags(templates), categories, general
+
+
+def analyze_text(title, text):
+  """Returns (infobox, templates, categories, general) for a page or None if it can't be parsed."""
+  try:
+    wikicode = mwparserfromhell.parse(text)
+    templates = wikicode.filter_templates()
+    return make_analysis(title, templates, (strip_template_name(template.name) for template in templates),
+                         (l.title for l in wikicode.filter_wikilinks()))
+  except mwparserfromhell.parser.ParserError:
+    print('mwparser error for:', title)
+    return None
+
+
+def analyze_text_fast(title, text):
+  """Same as analyze_text, but from a single scan over the text instead of a full mwparserfromhell parse."""
+  try:
+    return make_analysis(title, *wikitext_scan.scan(text))
+  except mwparserfromhell.parser.ParserError:
+    print('mwparser error for:', title)
+    return None
 
 
-  def pstart(self):
-      self._pbar.start()
+ANALYZERS = {'mwparser': analyze_text, 'fast': analyze_text_fast}
 
 
-  def pstop(self):
-      self._pbar.finish()
+def make_row(page, analysis):
+  if analysis is None:
+    return None
+  page_id, title, text = page[:3]
+  infobox, templates, categories, general = analysis
+  return page_id, title, infobox, text, templates, categories, general
 
 
+def analyze_page(page, analyzer=analyze_text):
+  return make_row(page, analyzer(page[1], page[2]))
+
+
+def analyze_batch(pages, analyzer=analyze_text):
+  # runs in the worker processes; the text stays with the reader so we don't ship it back
+  return [analyzer(page[1], page[2]) for page in pages]
+
+
+class WikiXmlHandler(xml.sax.handler.ContentHandler):
+  """Collects an (id, title, text, end) tuple for every page in self.pages. SAX doesn't tell us where
+     in the dump a page ends, so end is None."""
+  def __init__(self):
+    xml.sax.handler.ContentHandler.__init__(self)
+    self.pages = []
+    self.reset()
+
   def reset(self):
     self._buffer = []
     self._state = None
@@ -81,31 +185,7 @@ class WikiXmlHandler(xml.sax.handler.ContentHandler):
       self._buffer = []
 
     if name == 'page':
-      try:
-        wikicode = mwparserfromhell.parse(self._values['text'])
-        templates = wikicode.filter_templates()
-        template_names = make_tags(strip_template_name(template.name) for template in templates)
-        infobox = None
-        for template in template_names:
-          if template.startswith(INFOBOX_PREFIX):
-            infobox = template[len(INFOBOX_PREFIX):]
-            break
-        if len(infobox or '') > 1024 or len(self._values['title']) > 1024:
-          print('Too long')
-          raise mwparserfromhell.parser.ParserError('too long')
-        categories = make_tags(l.title[len(CAT_PREFIX):] for l in wikicode.filter_wikilinks() if l.title.startswith(CAT_PREFIX))
-        general = make_tags(extact_general(x) for x in categories)
-        # even though we shouldn't get dupes, sometimes wikidumps are faulty:
-        # print(self._values['title'], self._values['id'], infobox, templates, categories, general)
-        self._db_cursor.execute('INSERT INTO import.wikipedia (id, title, infobox, wikitext, templates, categories, general) VALUES (%s, %s, %s, %s, %s, %s, %s)  ON CONFLICT DO NOTHING',
-                                (self._values['id'], self._values['title'], infobox, self._values['text'], make_tags(templates), categories, general))
-        self._pbar.update(self._count)
-        self._count += 1
-        if self._count % 100000 == 0:
-          # print(self._count)
-          self._db_conn.commit()
-      except mwparserfromhell.parser.ParserError:
-        print('mwparser error for:', self._values['title'])
+      self.pages.append((int(self._values['id']), self._values['title'], self._values['text'], None))
       self.reset()
 
   def characters(self, content):
@@ -113,19 +193,184 @@ class WikiXmlHandler(xml.sax.handler.ContentHandler):
       self._buffer.append(content)
 
 
-def main(dump, cursor, conn):
-  parser = xml.sax.make_parser()
-  xmlHandler = WikiXmlHandler(cursor, conn)
-  parser.setContentHandler(xmlHandler)
-
-  xmlHandler.pstart()
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
-    try:
-      parser.feed(line)
-    except StopIteration:
-      break
+def extract_pages(stream, buffer_size=page_extractor.BUFFER_SIZE, offset=0):
+  """Yields (id, title, text, end) for every page, end being the offset in the dump after the page."""
+  for record in page_extractor.iter_pages(stream, buffer_size, offset):
+    yield record.id, record.title, record.text, record.end
 
-  xmlHandler.pstop()
+
+def read_pages(lines):
+  """The xml.sax reader, fed line by line. Slower than extract_pages, but a real xml parser."""
+  parser = xml.sax.make_parser()
+  handler = WikiXmlHandler()
+  parser.setContentHandler(handler)
+  for line in lines:
+    parser.feed(line)
+    if handler.pages:
+      yield from handler.pages
+      handler.pages = []
+
+
+def iter_rows(pages, workers=1, analyzer=analyze_text):
+  """Yields (position, row) for every page, row is None when the page couldn't be parsed."""
+  if workers <= 1:
+    for page in pages:
+      yield page[3], analyze_page(page, analyzer)
+    return
+
+  with multiprocessing.Pool(workers) as pool:
+    batches = pipeline.batched(pages, WORKER_BATCH)
+    func = functools.partial(analyze_batch, analyzer=analyzer)
+    for batch, analyses in pipeline.ordered_imap(pool, func, batches, workers * 4):
+      for page, analysis in zip(batch, analyses):
+        yield page[3], make_row(page, analysis)
+
+
+def read_stream_offsets(index):
+  """The distinct stream offsets, in order, from a pages-articles-multistream-index.txt.bz2.
+     Lines look like offset:page_id:title."""
+  offsets = []
+  with bz2.open(index, 'rt', encoding='utf-8') as f:
+    for line in f:
+      offset = int(line.split(':', 1)[0])
+      if not offsets or offsets[-1] != offset:
+        offsets.append(offset)
+  return offsets
+
+
+def stream_ranges(offsets, size, streams_per_task=STREAMS_PER_TASK):
+  """Splits the dump into byte ranges of whole streams. Everything before the first offset is the
+     siteinfo header, the range of the last stream runs to the end of the file and picks up the footer."""
+  bounds = offsets + [size]
+  for i in range(0, len(offsets), streams_per_task):
+    yield bounds[i], bounds[min(i + streams_per_task, len(offsets))]
+
+
+def read_range(dump, start, end):
+  with open(dump, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+  return list(extract_pages(io.BytesIO(bz2.decompress(data))))
+
+
+def analyze_range(task, analyzer=analyze_text):
+  dump, start, end = task
+  # only the end of the range is a position we can resume from
+  rows = [(None, analyze_page(page, analyzer)) for page in read_range(dump, start, end)]
+  rows.append((end, None))
+  return rows
+
+
+def iter_multistream_rows(dump, index, workers=1, analyzer=analyze_text, position=0):
+  offsets = [offset for offset in read_stream_offsets(index) if offset >= position]
+  tasks = ((dump, start, end) for start, end in stream_ranges(offsets, os.path.getsize(dump)))
+  if workers <= 1:
+    for task in tasks:
+      yield from analyze_range(task, analyzer)
+    return
+
+  with multiprocessing.Pool(workers) as pool:
+    func = functools.partial(analyze_range, analyzer=analyzer)
+    for _, rows in pipeline.ordered_imap(pool, func, tasks, workers * 4):
+      yield from rows
+
+
+class InsertSink():
+  def __init__(self, cursor):
+    self._cursor = cursor
+
+  def write(self, row):
+    self._cursor.execute(INSERT_SQL, row)
+
+  def flush(self):
+    pass
+
+
+class CopySink():
+  def __init__(self, cursor, batch_size=COPY_BATCH):
+    self._cursor = cursor
+    self._batch_size = batch_size
+    self._rows = []
+
+  def write(self, row):
+    self._rows.append(row)
+    if len(self._rows) >= self._batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self._rows:
+      return
+    pg_copy.copy_rows(self._cursor, STAGING, COLUMNS, self._rows)
+    self._rows = []
+
+
+def load_rows(rows, sink, conn, checkpoint=None, count=0, metrics=None, **state):
+  """Writes the (position, row) pairs from iter_rows and commits every COMMIT_EVERY rows. After each
+     commit the position is saved in the checkpoint, with count and state; with a checkpoint the commit
+     waits for a row that has a position."""
+  metrics = metrics or Metrics('import_wikipedia')
+  pbar = ProgressBar(widgets=[Bar(), SimpleProgress(), AdaptiveETA()], maxval=UnknownLength)
+  pbar.start()
+  committed = count
+  for position, row in rows:
+    if row is not None:
+      with metrics.timer('load', 1):
+        sink.write(row)
+      pbar.update(count)
+      count += 1
+    if count - committed >= COMMIT_EVERY and (position is not None or checkpoint is None):
+      with metrics.timer('load'):
+        sink.flush()
+      metrics.commit(conn)
+      committed = count
+      if checkpoint:
+        checkpoint.save(position=position, count=count, **state)
+  with metrics.timer('load'):
+    sink.flush()
+  pbar.finish()
+  return count
+
+
+def make_sink(loader, cursor, batch_size=COPY_BATCH):
+  if loader == 'insert':
+    return InsertSink(cursor)
+  return CopySink(cursor, batch_size)
+
+
+def main(dump, cursor, conn, workers=1, loader='copy', batch_size=COPY_BATCH, index=None, reader='fast',
+         analyzer='mwparser', checkpoint=None, resume_state=None, metrics=None):
+  """The reader (bzcat + page extractor) and the writer run in this process. With workers > 1 the wikitext
+     analysis, which is most of the cost per page, runs in a pool of processes in between.
+     Given the index of a multistream dump, the workers also decompress and parse their own
+     byte ranges of the dump, so bzcat is no longer the bottleneck.
+
+     Positions in the checkpoint are offsets in the decompressed dump, or of the next bz2 stream in a
+     multistream dump, so a resume can skip straight there.
+
+     The metrics have the time spent waiting on bzcat (decompress), in the page reader (parse), analyzing or
+     waiting on the workers that do (analyze), making rows for COPY (load) and waiting on postgres (db).
+     With an index the workers decompress and parse as well, so that's all in analyze.
+  """
+  metrics = metrics or Metrics('import_wikipedia')
+  position = resume_state['position'] if resume_state else 0
+  count = resume_state['count'] if resume_state else 0
+  if index:
+    rows = iter_multistream_rows(dump, index, workers, ANALYZERS[analyzer], position)
+  else:
+    if reader == 'sax' and position:
+      raise ValueError('xml.sax has to read the dump from the start, it can\'t resume at %d' % position)
+    stream = Reader(subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout, metrics)
+    # one bz2 stream, so we do have to decompress everything up to the checkpoint
+    skip_bytes(stream, position)
+    if reader == 'sax':
+      # xml.sax doesn't tell where a page ends, so there are no positions to checkpoint
+      checkpoint = None
+      pages = read_pages(stream)
+    else:
+      pages = extract_pages(stream, offset=position)
+    rows = iter_rows(metrics.iterate('parse', pages), workers, ANALYZERS[analyzer])
+  return load_rows(metrics.iterate('analyze', rows), make_sink(loader, Cursor(cursor, metrics), batch_size), conn,
+                   checkpoint, count, metrics, multistream=bool(index))
 
 
 if __name__ == '__main__':
@@ -134,19 +379,66 @@ if __name__ == '__main__':
                       help='postgres connection string')
   parser.add_argument('dump', type=str,
                       help='BZipped wikipedia dump')
+  parser.add_argument('--index', type=str, default=None,
+                      help='multistream-index.txt.bz2 of a pages-articles-multistream dump')
+  parser.add_argument('--reader', choices=('fast', 'sax'), default='fast',
+                      help='page extractor or xml.sax to read the dump')
+  parser.add_argument('--analyzer', choices=sorted(ANALYZERS), default='mwparser',
+                      help='full mwparserfromhell parse or a quicker single scan of the wikitext')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of processes parsing wikitext')
+  parser.add_argument('--loader', choices=('copy', 'insert'), default='copy',
+                      help='load rows with batched COPY or with one INSERT per row')
+  parser.add_argument('--batch_size', type=int, default=COPY_BATCH,
+                      help='rows per COPY batch')
+  parser.add_argument('--connections', type=int, default=post_import.CONNECTIONS,
+                      help='connections to build the indexes on at the same time')
+  parser.add_argument('--maintenance_work_mem', type=str, default=post_import.MAINTENANCE_WORK_MEM,
+                      help='maintenance_work_mem of each of those connections')
+  parser.add_argument('--parallel_maintenance_workers', type=int, default=post_import.PARALLEL_MAINTENANCE_WORKERS,
+                      help='max_parallel_maintenance_workers of each of those connections')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue from the last checkpoint of an import of this dump that didn\'t finish')
+  parser.add_argument('--metrics_json', type=str, default=None,
+                      help='append the throughput of every stage to this file as json lines')
+  parser.add_argument('--metrics_textfile', type=str, default=None,
+                      help='keep the same in this .prom file for the textfile collector of the node exporter')
+  parser.add_argument('--metrics_interval', type=int, default=None,
+                      help='seconds between writes of the metrics, a minute by default')
 
   args = parser.parse_args()
+  import_metrics = Metrics('import_wikipedia', args.metrics_json, args.metrics_textfile, args.metrics_interval)
+  checkpoint = Checkpoint(args.dump)
+  state = None
+  if args.resume:
+    state = checkpoint.load()
+    if state and state['multistream'] != bool(args.index):
+      print('Checkpoint was made', 'with' if state['multistream'] else 'without', '--index, ignoring it')
+      state = None
+    if state and args.reader == 'sax' and not args.index:
+      print('The sax reader can only start at the beginning of the dump, ignoring the checkpoint')
+      state = None
+    if state:
+      print('Resuming after', state['count'], 'pages')
+    else:
+      print('No checkpoint to resume from, starting from the beginning')
   print('Setup db')
-  conn, cursor = setup_db(args.postgres)
+  conn, cursor = setup_db(args.postgres, resume=state is not None)
+  if state and staging.staging_rows(cursor, TABLE) != state['count']:
+    # postgres restarted and emptied the unlogged staging table, what the checkpoint skips is gone
+    print('The staging table no longer has the', state['count'], 'pages of the checkpoint, starting over')
+    create_tables(conn, cursor)
+    state = None
 
   print('Parsing...')
-  main(args.dump, cursor, conn)
+  main(args.dump, cursor, conn, args.workers, args.loader, args.batch_size, args.index, args.reader,
+       args.analyzer, checkpoint, state, import_metrics)
+  import_metrics.commit(conn)
+  conn.close()
   print('Create indexes')
-  conn.commit()
-  cursor.execute('CREATE INDEX wp_wikipedia_infobox ON import.wikipedia(infobox)')
-  cursor.execute('CREATE INDEX wp_wikipedia_templates ON import.wikipedia USING gin(templates)')
-  cursor.execute('CREATE INDEX wp_wikipedia_categories ON import.wikipedia USING gin(categories)')
-  cursor.execute('CREATE INDEX wp_wikipedia_general ON import.wikipedia USING gin(general)')
-
-  conn.commit()
-
+  with import_metrics.timer('post_import'):
+    post_import.run(functools.partial(post_import.connect, args.postgres, args.maintenance_work_mem,
+                                      args.parallel_maintenance_workers),
+                    post_import_steps(), args.connections)
+  checkpoint.clear()
+  import_metrics.close()
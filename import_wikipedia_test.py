@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import bz2
+import os
+import tempfile
 import unittest
-import xml
+from unittest import mock
 
 import re
-from import_wikipedia import WikiXmlHandler, extact_general
+import import_wikipedia
+from import_wikipedia import (InsertSink, analyze_page, extact_general, iter_multistream_rows, iter_rows,
+                              load_rows, read_pages)
 
 DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.mediawiki.org/xml/export-0.10/ http://www.mediawiki.org/xml/export-0.10.xsd" version="0.10" xml:lang="en">
   <siteinfo>
@@ -69,6 +74,29 @@ DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi
 </mediawiki>"""
 
 
+RE_PAGE = re.compile(r'  <page>.*?</page>\n', re.S)
+RE_PAGE_ID = re.compile(r'<id>(\d+)</id>')
+RE_TITLE = re.compile(r'<title>(.*?)</title>')
+
+
+def write_multistream(dump_path, index_path):
+  """Writes DUMP the way the multistream dumps are laid out: the header, one bz2 stream per page, the footer."""
+  pages = RE_PAGE.findall(DUMP)
+  header = DUMP[:DUMP.index(pages[0])]
+  footer = DUMP[DUMP.index(pages[-1]) + len(pages[-1]):]
+  offset = 0
+  index = []
+  with open(dump_path, 'wb') as fout:
+    for i, chunk in enumerate([header] + pages + [footer]):
+      if 0 < i <= len(pages):
+        index.append('%d:%s:%s\n' % (offset, RE_PAGE_ID.search(chunk).group(1), RE_TITLE.search(chunk).group(1)))
+      data = bz2.compress(chunk.encode('utf-8'))
+      fout.write(data)
+      offset += len(data)
+  with bz2.open(index_path, 'wt') as fout:
+    fout.write(''.join(index))
+
+
 RE_PAR = re.compile('\(([^\)]+)\)')
 
 class FakeCursor():
@@ -81,13 +109,28 @@ class FakeCursor():
     self.results.append(dict(zip(fields, params)))
 
 
+class FakeConn():
+  def __init__(self):
+    self.commits = 0
+
+  def commit(self):
+    self.commits += 1
+
+
+class FakeCheckpoint():
+  def __init__(self):
+    self.saved = []
+
+  def save(self, **state):
+    self.saved.append(state)
+
+
 class TestImportWikipedia(unittest.TestCase):
   def test_parse_wikipedia(self):
-    parser = xml.sax.make_parser()
     fc = FakeCursor()
-    parser.setContentHandler(WikiXmlHandler(fc))
-    for line in DUMP.split('\n'):
-      parser.feed(line + '\n')
+    sink = InsertSink(fc)
+    for page in read_pages(line + '\n' for line in DUMP.split('\n')):
+      sink.write(analyze_page(page))
 
     self.assertEqual(len(fc.results), 2)
 
@@ -97,6 +140,42 @@ class TestImportWikipedia(unittest.TestCase):
     self.assertTrue('main article' in fc.results[1]['templates'])
     self.assertTrue('ideas' in fc.results[1]['general'])
 
+  def test_workers_match_single_process(self):
+    pages = list(read_pages(line + '\n' for line in DUMP.split('\n')))
+    self.assertEqual(list(iter_rows(pages, workers=2)), list(iter_rows(pages)))
+
+  def test_multistream_matches_single_stream(self):
+    expected = [row for _, row in iter_rows(read_pages(line + '\n' for line in DUMP.split('\n')))]
+    with tempfile.TemporaryDirectory() as tmp:
+      dump = os.path.join(tmp, 'pages-articles-multistream.xml.bz2')
+      index = os.path.join(tmp, 'pages-articles-multistream-index.txt.bz2')
+      write_multistream(dump, index)
+      for workers in 1, 2:
+        rows = list(iter_multistream_rows(dump, index, workers))
+        self.assertEqual([row for _, row in rows if row], expected)
+        # the end of the last range is the end of the file
+        self.assertEqual(rows[-1], (os.path.getsize(dump), None))
+
+  @mock.patch.object(import_wikipedia, 'COMMIT_EVERY', 2)
+  def test_load_rows_commits(self):
+    # the sax reader has no positions, it still commits as it goes
+    conn = FakeConn()
+    self.assertEqual(load_rows([(None, ('row',))] * 5, InsertSink(FakeCursor()), conn), 5)
+    self.assertEqual(conn.commits, 2)
+
+    # with a checkpoint the commit waits for a position, the end of a multistream range
+    conn = FakeConn()
+    checkpoint = FakeCheckpoint()
+    rows = [(None, ('row',))] * 3 + [(100, None), (None, ('row',)), (200, None)]
+    self.assertEqual(load_rows(rows, InsertSink(FakeCursor()), conn, checkpoint), 4)
+    self.assertEqual(conn.commits, 1)
+    self.assertEqual(checkpoint.saved, [{'position': 100, 'count': 3}])
+
+  def test_sax_doesnt_resume(self):
+    # a checkpoint is from the page extractor, xml.sax can't start in the middle of the document
+    self.assertRaises(ValueError, import_wikipedia.main, 'dump.xml.bz2', None, None, reader='sax',
+                      resume_state={'position': 5000, 'count': 5})
+
   def test_extact_general(self):
     self.assertEqual(extact_general('something something dark'), None)
     self.assertEqual(extact_general('the streets of philadelpha'), 'the streets')
@@ -0,0 +1,151 @@
+#!/bin/python3
+"""json decoding for the wikidata entities, with the fastest library that is installed.
+
+orjson, pysimdjson and ujson are all optional, without any of them this is json from the standard
+library. loads_entity only returns the keys of an entity the importers use; with simdjson the rest
+(aliases, descriptions in other languages) is never turned into python objects at all.
+"""
+
+import json
+
+# the keys of an entity that import_wikidata and wd_updater read
+ENTITY_KEYS = ('id', 'labels', 'descriptions', 'sitelinks', 'claims', 'lastrevid')
+# in order of preference
+BACKENDS = ('orjson', 'simdjson', 'ujson', 'json')
+
+
+def project(d):
+  if type(d) != dict:
+    return d
+  return {key: d[key] for key in ENTITY_KEYS if key in d}
+
+
+def _stdlib():
+  return json.loads
+
+
+def _orjson():
+  import orjson
+
+  def loads(data):
+    try:
+      return orjson.loads(data)
+    except orjson.JSONDecodeError:
+      # orjson doesn't do integers over 64 bits, json does; invalid json fails there too
+      return json.loads(data)
+  return loads
+
+
+def _ujson():
+  import ujson
+
+  def loads(data):
+    try:
+      return ujson.loads(data)
+    except ValueError:
+      return json.loads(data)
+  return loads
+
+
+def _simdjson_parser():
+  import simdjson
+  return simdjson.Parser()
+
+
+def _simdjson():
+  parser = _simdjson_parser()
+
+  def loads(data):
+    try:
+      return parser.parse(data, True)
+    except (ValueError, RuntimeError):
+      return json.loads(data)
+  return loads
+
+
+def _simdjson_entity():
+  parser = _simdjson_parser()
+
+  def materialize(value):
+    if hasattr(value, 'as_dict'):
+      return value.as_dict()
+    if hasattr(value, 'as_list'):
+      return value.as_list()
+    return value
+
+  def loads_entity(data):
+    try:
+      doc = parser.parse(data)
+    except (ValueError, RuntimeError):
+      return project(json.loads(data))
+    if not hasattr(doc, 'as_dict'):
+      return materialize(doc)
+    d = {}
+    for key in ENTITY_KEYS:
+      if key in doc:
+        if key == 'descriptions':
+          # only the english one is used
+          value = doc[key]
+          d[key] = {'en': value['en'].as_dict()} if 'en' in value else {}
+          del value
+        else:
+          d[key] = materialize(doc[key])
+    # the parser can only be reused once nothing refers to its last document
+    del doc
+    return d
+
+  return loads_entity
+
+
+LOADERS = {'orjson': _orjson, 'simdjson': _simdjson, 'ujson': _ujson, 'json': _stdlib}
+
+
+class Decoder():
+  def __init__(self, name):
+    self.name = name
+    self.loads = LOADERS[name]()
+    if name == 'simdjson':
+      self.loads_entity = _simdjson_entity()
+    else:
+      loads = self.loads
+      self.loads_entity = lambda data: project(loads(data))
+
+
+def available():
+  names = []
+  for name in BACKENDS:
+    try:
+      Decoder(name)
+    except ImportError:
+      continue
+    names.append(name)
+  return names
+
+
+def get_decoder(name=None):
+  """The decoder called name, or the first one of BACKENDS that is installed."""
+  if name:
+    return Decoder(name)
+  return Decoder(available()[0])
+
+
+_decoder = get_decoder()
+
+
+def use(name):
+  """Switches the module level loads and loads_entity to another backend."""
+  global _decoder
+  _decoder = get_decoder(name)
+  return _decoder.name
+
+
+def backend():
+  return _decoder.name
+
+
+def loads(data):
+  return _decoder.loads(data)
+
+
+def loads_entity(data):
+  return _decoder.loads_entity(data)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+
+import json_decoder
+from json_decoder import Decoder
+
+ENTITY = {'type': 'item', 'id': 'Q64', 'lastrevid': 7,
+          'labels': {'en': {'language': 'en', 'value': 'Berlin'}, 'de': {'language': 'de', 'value': 'Berlin'}},
+          'descriptions': {'en': {'language': 'en', 'value': 'capital of Germany'}, 'fr': {'language': 'fr', 'value': 'capitale'}},
+          'aliases': {'en': [{'language': 'en', 'value': 'Berlin, Germany'}]},
+          'sitelinks': {'enwiki': {'site': 'enwiki', 'title': 'Berlin', 'badges': []}},
+          'claims': {'P625': [{'mainsnak': {'datavalue': {'type': 'globecoordinate',
+                                                          'value': {'latitude': 52.516666666667, 'longitude': 13.383333333333}}},
+                               'rank': 'normal'}]}}
+
+
+class TestJsonDecoder(unittest.TestCase):
+  def test_backends_agree(self):
+    data = json.dumps(ENTITY).encode('utf-8')
+    for name in json_decoder.available():
+      decoder = Decoder(name)
+      self.assertEqual(decoder.loads(data), ENTITY, name)
+      self.assertEqual(decoder.loads(data.decode('utf-8')), ENTITY, name)
+      entity = decoder.loads_entity(data)
+      self.assertEqual(sorted(entity), sorted(json_decoder.ENTITY_KEYS), name)
+      for key in 'id', 'lastrevid', 'labels', 'sitelinks', 'claims':
+        self.assertEqual(entity[key], ENTITY[key], name)
+      self.assertEqual(entity['descriptions']['en'], ENTITY['descriptions']['en'], name)
+
+  def test_not_an_entity(self):
+    for name in json_decoder.available():
+      decoder = Decoder(name)
+      self.assertEqual(decoder.loads_entity(b'[1, 2]'), [1, 2], name)
+      self.assertEqual(decoder.loads_entity(b'{"id": "Q1", "n": 123456789012345678901234567890}'), {'id': 'Q1'}, name)
+      self.assertRaises(ValueError, decoder.loads_entity, b'{"id": ')
+      self.assertRaises(ValueError, decoder.loads, b'{"id": ')
+
+  def test_use(self):
+    previous = json_decoder.backend()
+    try:
+      self.assertEqual(json_decoder.use('json'), 'json')
+      self.assertEqual(json_decoder.loads_entity(b'{"id": "Q1", "aliases": {}}'), {'id': 'Q1'})
+    finally:
+      json_decoder.use(previous)
+    self.assertEqual(json_decoder.backend(), json_decoder.available()[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
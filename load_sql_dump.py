@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""Loads the MySQL dumps of a wikipedia dump (page.sql.gz, pagelinks.sql.gz, ...) into the import.* tables of
+wp_schema.sql. The dump is read as it's unzipped and the rows of its INSERT statements go straight into one
+COPY, so nothing is written to disk and memory only holds one statement, about a MB, at a time.
+
+The columns come from the CREATE TABLE in the dump. Only the ones the postgres table has too are loaded, so a
+dump that gained or lost columns since wp_schema.sql was written still loads, as long as the columns it lost
+can be NULL or have a default; the rest are listed.
+"""
+
+import argparse
+import gzip
+import re
+import time
+
+import psycopg2
+
+import pg_copy
+
+SCHEMA = 'import'
+# bytes handed to COPY at a time
+COPY_CHUNK = 1024 * 1024
+
+RE_CREATE = re.compile(r'CREATE TABLE `([^`]+)`')
+RE_COLUMN = re.compile(r'\s+`([^`]+)`')
+RE_INSERT = re.compile(r'INSERT INTO `([^`]+)` VALUES ')
+# a tuple of values; a quoted string goes as a whole so it can hold parentheses and quotes
+RE_TUPLE = re.compile(r"\(((?:'(?:[^'\\]|\\.)*'|[^'()])*)\)")
+RE_FIELD = re.compile(r"'((?:[^'\\]|\\.)*)'|([^,]+)")
+# a mysql escape, or a character COPY needs escaped
+RE_ESCAPE = re.compile(r'\\(.)|([\t\n\r])', re.DOTALL)
+RE_NEEDS_ESCAPE = re.compile(r'[\\\t\n\r]')
+# the COPY text for the mysql escapes, anything else (\' or \") is just the character; postgres text can't hold \0
+COPY_ESCAPES = {'0': '', 'n': '\\n', 'r': '\\r', 't': '\\t', 'b': '\\b', 'Z': '\x1a', '\\': '\\\\',
+                '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+# and for python str
+RE_MYSQL_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+MYSQL_ESCAPES = {'0': '\0', 'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'Z': '\x1a'}
+
+
+def _escape(match):
+  if match.group(1) is None:
+    return COPY_ESCAPES[match.group(2)]
+  return COPY_ESCAPES.get(match.group(1), match.group(1))
+
+
+def copy_text(text):
+  """A string as mysqldump quotes it (without the quotes) as COPY text."""
+  if not RE_NEEDS_ESCAPE.search(text):
+    return text
+  return RE_ESCAPE.sub(_escape, text)
+
+
+def mysql_text(text):
+  """A string as mysqldump quotes it (without the quotes) as python str."""
+  if '\\' not in text:
+    return text
+  return RE_MYSQL_ESCAPE.sub(lambda m: MYSQL_ESCAPES.get(m.group(1), m.group(1)), text)
+
+
+def parse_values(statement):
+  """The rows of an INSERT INTO ... VALUES (...),(...); line as lists of COPY text fields. The values go from
+     one text format to the other without becoming python values in between."""
+  for values in RE_TUPLE.findall(statement, statement.index(' VALUES ')):
+    # a quoted value is in the first group, anything else in the second; '' has both empty
+    yield [copy_text(quoted) if quoted or not bare else pg_copy.NULL if bare == 'NULL' else bare
+           for quoted, bare in RE_FIELD.findall(values)]
+
+
+def read_header(lines):
+  """Reads lines up to the first INSERT. Returns (table, columns, first INSERT line or None)."""
+  table = None
+  columns = []
+  in_create = False
+  for line in lines:
+    if line.startswith('INSERT INTO'):
+      return RE_INSERT.match(line).group(1), columns, line
+    match = RE_CREATE.match(line)
+    if match:
+      table = match.group(1)
+      columns = []
+      in_create = True
+    elif in_create:
+      match = RE_COLUMN.match(line)
+      if match:
+        columns.append(match.group(1))
+      elif line.startswith(')'):
+        in_create = False
+  return table, columns, None
+
+
+class RowFile():
+  """A file to give copy_expert that reads lines of COPY text as they're produced."""
+  def __init__(self, lines):
+    self._lines = lines
+    self._buffer = b''
+    self.count = 0
+
+  def read(self, size=-1):
+    pieces = [self._buffer]
+    length = len(self._buffer)
+    while size < 0 or length < size:
+      line = next(self._lines, None)
+      if line is None:
+        break
+      piece = line.encode('utf-8')
+      pieces.append(piece)
+      length += len(piece)
+      self.count += 1
+    data = b''.join(pieces)
+    if size < 0:
+      size = len(data)
+    self._buffer = data[size:]
+    return data[:size]
+
+
+def table_columns(cursor, table):
+  """(name, required) for the columns of table, required when it's NOT NULL without a default."""
+  schema, name = table.split('.', 1)
+  cursor.execute('SELECT column_name, is_nullable = \'NO\' AND column_default IS NULL FROM information_schema.columns '
+                 'WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position', (schema, name))
+  return cursor.fetchall()
+
+
+def statements(lines, first, table):
+  """first and the lines after it that are INSERTs into table."""
+  line = first
+  while line is not None:
+    match = RE_INSERT.match(line)
+    if match and match.group(1) == table:
+      yield line
+    line = next(lines, None)
+
+
+def copy_lines(lines, first, table, indexes):
+  """A line of COPY text with the values at indexes, or all of them for None, for every row of the INSERTs into
+     table in first and the rest of lines."""
+  for statement in statements(lines, first, table):
+    for row in parse_values(statement):
+      if indexes is not None:
+        row = [row[i] for i in indexes]
+      yield '\t'.join(row) + '\n'
+
+
+def dump_rows(path, columns):
+  """The values of columns for every row of the dump in path as tuples of str, or None for NULL. For reading a
+     dump in python rather than loading it."""
+  with open_dump(path) as f:
+    lines = iter(f)
+    source, names, first = read_header(lines)
+    indexes = [names.index(column) for column in columns]
+    for statement in statements(lines, first, source):
+      for values in RE_TUPLE.findall(statement, statement.index(' VALUES ')):
+        row = [mysql_text(quoted) if quoted or not bare else None if bare == 'NULL' else bare
+               for quoted, bare in RE_FIELD.findall(values)]
+        yield tuple(row[i] for i in indexes)
+
+
+def open_dump(path):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+  return open(path, encoding='utf-8', errors='replace')
+
+
+def load(path, cursor, schema=SCHEMA, table=None):
+  """COPYs the rows of the dump in path into schema.<the table in the dump>, or table, after emptying it.
+     Returns the number of rows."""
+  with open_dump(path) as f:
+    lines = iter(f)
+    source, columns, first = read_header(lines)
+    if source is None:
+      raise ValueError('%s has no CREATE TABLE or INSERT' % path)
+    target = table or '%s.%s' % (schema, source)
+    target_columns = table_columns(cursor, target)
+    if not target_columns:
+      raise ValueError('there is no table %s' % target)
+    existing = set(column for column, _ in target_columns)
+    # COPY would only fail on them at the first row, after the table is emptied
+    required = [column for column, is_required in target_columns if is_required and column not in columns]
+    if required:
+      raise ValueError('%s has no %s, which %s needs a value for; give %s a default in wp_schema.sql' % (
+          path, ', '.join(required), target, 'it' if len(required) == 1 else 'them'))
+    keep = [column for column in columns if column in existing]
+    print('%s -> %s: %s' % (path, target, ', '.join(keep)), flush=True)
+    if set(columns) - existing:
+      print('  not in %s: %s' % (target, ', '.join(column for column in columns if column not in existing)), flush=True)
+    if existing - set(columns):
+      print('  not in the dump: %s' % ', '.join(sorted(existing - set(columns))), flush=True)
+
+    cursor.execute('TRUNCATE %s' % target)
+    indexes = None if keep == columns else [columns.index(column) for column in keep]
+    data = RowFile(copy_lines(lines, first, source, indexes))
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (target, ', '.join('"%s"' % column for column in keep)), data,
+                       COPY_CHUNK)
+    return data.count
+
+
+def connection_string(db):
+  """What psql takes as a database, a name or a connection string, for psycopg2."""
+  return db if '=' in db or '://' in db else 'dbname=' + db
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Load the MySQL dumps of a wikipedia dump into postgres')
+  parser.add_argument('postgres', type=str, help='postgres connection string or database name')
+  parser.add_argument('dumps', type=str, nargs='+', help='.sql.gz files, page.sql.gz, redirect.sql.gz and so on')
+  parser.add_argument('--schema', type=str, default=SCHEMA, help='schema with the tables of wp_schema.sql')
+
+  args = parser.parse_args()
+  conn = psycopg2.connect(connection_string(args.postgres))
+  cursor = conn.cursor()
+  for dump in args.dumps:
+    start = time.perf_counter()
+    count = load(dump, cursor, args.schema)
+    conn.commit()
+    print('%d rows in %.1fs' % (count, time.perf_counter() - start), flush=True)
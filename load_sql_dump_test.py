@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import load_sql_dump
+from load_sql_dump import parse_values, read_header, RowFile
+
+DUMP = r"""-- MySQL dump 10.19  Distrib 10.3.38-MariaDB, for debian-linux-gnu (x86_64)
+/*!40101 SET NAMES utf8mb4 */;
+DROP TABLE IF EXISTS `redirect`;
+CREATE TABLE `redirect` (
+  `rd_from` int(8) unsigned NOT NULL DEFAULT 0,
+  `rd_namespace` int(11) NOT NULL DEFAULT 0,
+  `rd_title` varbinary(255) NOT NULL DEFAULT '',
+  `rd_interwiki` varbinary(32) DEFAULT NULL,
+  `rd_fragment` varbinary(255) DEFAULT NULL,
+  `rd_new_column` int(11) DEFAULT NULL,
+  PRIMARY KEY (`rd_from`),
+  KEY `rd_ns_title` (`rd_namespace`,`rd_title`,`rd_from`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+/*!40000 ALTER TABLE `redirect` DISABLE KEYS */;
+INSERT INTO `redirect` VALUES (10,0,'Computer_accessibility','',NULL,1),(13,0,'History_of_Afghanistan','','',NULL);
+INSERT INTO `redirect` VALUES (19,0,'Rock\'n\'roll_(\"music\")','','Tabs\tand\\backslash),(',2),(20,4,'Ärger','',NULL,3);
+/*!40000 ALTER TABLE `redirect` ENABLE KEYS */;
+"""
+
+
+class FakeCursor():
+  def __init__(self, columns, required=()):
+    self.columns = columns
+    self.required = required
+    self.sql = []
+    self.copied = b''
+
+  def execute(self, sql, params=None):
+    self.sql.append(sql)
+
+  def fetchall(self):
+    return [(column, column in self.required) for column in self.columns]
+
+  def copy_expert(self, sql, f, size=8192):
+    self.sql.append(sql)
+    while True:
+      data = f.read(size)
+      if not data:
+        return
+      self.copied += data
+
+
+class TestLoadSqlDump(unittest.TestCase):
+  def test_parse_values(self):
+    line = DUMP.splitlines()[15]
+    # straight from mysql to COPY text
+    self.assertEqual(list(parse_values(line)), [
+      ['19', '0', 'Rock\'n\'roll_("music")', '', 'Tabs\\tand\\\\backslash),(', '2'],
+      ['20', '4', 'Ärger', '', '\\N', '3']])
+    self.assertEqual(list(parse_values("INSERT INTO `t` VALUES ('a\\0b\\\\\\'\tc','',-1.5e3);\n")),
+                     [['ab\\\\\'\\tc', '', '-1.5e3']])
+
+  def test_read_header(self):
+    lines = iter(DUMP.splitlines(True))
+    table, columns, first = read_header(lines)
+    self.assertEqual(table, 'redirect')
+    self.assertEqual(columns, ['rd_from', 'rd_namespace', 'rd_title', 'rd_interwiki', 'rd_fragment', 'rd_new_column'])
+    self.assertTrue(first.startswith('INSERT INTO `redirect` VALUES (10,'))
+
+  def test_row_file(self):
+    f = RowFile(iter(['1\tä\n', '2\t\\N\n']))
+    self.assertEqual([f.read(3), f.read(100), f.read(100)], [b'1\t\xc3', b'\xa4\n2\t\\N\n', b''])
+    self.assertEqual(f.count, 2)
+
+  def test_load(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'enwiki-20240101-redirect.sql.gz')
+      with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(DUMP)
+      # the table has a column the dump doesn't and the other way round
+      cursor = FakeCursor(['rd_from', 'rd_namespace', 'rd_title', 'rd_interwiki', 'rd_fragment', 'rd_old_column'])
+      self.assertEqual(load_sql_dump.load(path, cursor), 4)
+      self.assertEqual(cursor.sql[1:], [
+        'TRUNCATE import.redirect',
+        'COPY import.redirect ("rd_from", "rd_namespace", "rd_title", "rd_interwiki", "rd_fragment") FROM STDIN'])
+      self.assertEqual(cursor.copied.decode('utf-8').splitlines(), [
+        '10\t0\tComputer_accessibility\t\t\\N',
+        '13\t0\tHistory_of_Afghanistan\t\t',
+        '19\t0\tRock\'n\'roll_("music")\t\tTabs\\tand\\\\backslash),(',
+        '20\t4\tÄrger\t\t\\N'])
+
+      # a column that can't be left out stops it before the table is emptied
+      cursor = FakeCursor(['rd_from', 'rd_title', 'rd_old_column'], required=['rd_old_column'])
+      self.assertRaises(ValueError, load_sql_dump.load, path, cursor)
+      self.assertEqual(len(cursor.sql), 1)
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_connection_string(self):
+    self.assertEqual(load_sql_dump.connection_string('wiki'), 'dbname=wiki')
+    self.assertEqual(load_sql_dump.connection_string('host=x dbname=wiki'), 'host=x dbname=wiki')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,265 @@
+#!/bin/python3
+
+"""Throughput and latency of the stages of an import, written every so often as a json line and as a
+Prometheus textfile for the textfile collector of the node exporter.
+
+A stage is anything that takes time: waiting on bzcat, parsing, analyzing, waiting on postgres, committing.
+Each one counts the items and bytes that went through it, the seconds spent in it and its longest single call.
+Timed sections nest and a stage doesn't get the time of the stages inside it, so a stage that pulls its input
+from another one, or that writes through the cursor, only gets its own time. The seconds of the stages add up
+to the wall time of the import and the biggest one is the bottleneck.
+
+A timed section costs a couple of microseconds, so time pages, entities or batches rather than lines of a few
+bytes.
+"""
+
+import json
+import os
+import time
+
+# seconds between two writes of the metrics
+INTERVAL = 60
+PREFIX = 'wiki_import'
+
+# (name, type, Stage attribute, help) of what goes in the textfile for every stage
+TEXTFILE_METRICS = [
+    ('stage_items_total', 'counter', 'items', 'Items, pages or entities or rows, through the stage'),
+    ('stage_bytes_total', 'counter', 'bytes', 'Bytes through the stage'),
+    ('stage_seconds_total', 'counter', 'seconds', 'Seconds spent in the stage, not counting the stages inside it'),
+    ('stage_calls_total', 'counter', 'calls', 'Timed calls of the stage'),
+    ('stage_max_seconds', 'gauge', 'max_seconds', 'Longest single call of the stage'),
+]
+
+_END = object()
+
+
+class Stage():
+  __slots__ = ('items', 'bytes', 'seconds', 'calls', 'max_seconds')
+
+  def __init__(self):
+    self.items = 0
+    self.bytes = 0
+    self.seconds = 0.0
+    self.calls = 0
+    self.max_seconds = 0.0
+
+  def add(self, items=1, size=0):
+    self.items += items
+    self.bytes += size
+
+
+class _Section():
+  # a class rather than contextlib.contextmanager, that costs a few microseconds more
+  __slots__ = ('_metrics', '_stage', '_items', '_size', '_start')
+
+  def __init__(self, metrics, stage, items, size):
+    self._metrics = metrics
+    self._stage = stage
+    self._items = items
+    self._size = size
+
+  def __enter__(self):
+    self._start = self._metrics.start()
+    return self._stage
+
+  def __exit__(self, *exc):
+    self._metrics.stop(self._stage, self._start, self._items, self._size)
+    return False
+
+
+class Metrics():
+  """The stages of one import. Without json_path and textfile it only counts, close() prints the totals."""
+  def __init__(self, importer=None, json_path=None, textfile=None, interval=None):
+    self.importer = importer
+    self.json_path = json_path
+    self.textfile = textfile
+    self.interval = interval or INTERVAL
+    self.stages = {}
+    # the time spent in the sections inside each of the sections that are running
+    self._inner = []
+    self._started = time.time()
+    self._start = self._last = time.perf_counter()
+    self._next = self._start + self.interval
+    self._previous = {}
+
+  def stage(self, name):
+    stage = self.stages.get(name)
+    if stage is None:
+      stage = self.stages[name] = Stage()
+    return stage
+
+  def start(self):
+    self._inner.append(0.0)
+    return time.perf_counter()
+
+  def stop(self, stage, start, items=0, size=0):
+    now = time.perf_counter()
+    elapsed = now - start
+    own = elapsed - self._inner.pop()
+    if self._inner:
+      self._inner[-1] += elapsed
+    stage.seconds += own
+    stage.calls += 1
+    stage.items += items
+    stage.bytes += size
+    if own > stage.max_seconds:
+      stage.max_seconds = own
+    if now >= self._next:
+      self.emit(now)
+
+  def timer(self, name, items=0, size=0):
+    """Times a with block as a call of stage name. It gives the stage, to add items found out inside."""
+    return _Section(self, self.stage(name), items, size)
+
+  def iterate(self, name, iterable, size=None):
+    """Yields the items of iterable, timing how long each takes to come out of it as stage name. size, if
+       given, is a function giving the bytes of an item."""
+    stage = self.stage(name)
+    it = iter(iterable)
+    while True:
+      start = self.start()
+      try:
+        item = next(it, _END)
+      except BaseException:
+        self.stop(stage, start)
+        raise
+      if item is _END:
+        self.stop(stage, start)
+        return
+      self.stop(stage, start, 1, size(item) if size is not None else 0)
+      yield item
+
+  def commit(self, conn):
+    with self.timer('commit', 1):
+      conn.commit()
+
+  def snapshot(self, now=None):
+    """Totals of every stage, with the items and bytes per second since the last snapshot and the share of
+       that time spent in the stage."""
+    now = now or time.perf_counter()
+    since = max(now - self._last, 1e-9)
+    stages = {}
+    for name, stage in self.stages.items():
+      items, size, seconds = self._previous.get(name, (0, 0, 0.0))
+      stages[name] = {'items': stage.items, 'bytes': stage.bytes, 'seconds': round(stage.seconds, 3),
+                      'calls': stage.calls, 'max_seconds': round(stage.max_seconds, 3),
+                      'items_per_s': round((stage.items - items) / since, 1),
+                      'bytes_per_s': round((stage.bytes - size) / since),
+                      'busy': round((stage.seconds - seconds) / since, 3)}
+      self._previous[name] = stage.items, stage.bytes, stage.seconds
+    self._last = now
+    return {'time': round(time.time(), 3), 'importer': self.importer, 'elapsed': round(now - self._start, 3),
+            'stages': stages}
+
+  def textfile_lines(self):
+    labels = {name: '{importer="%s",stage="%s"}' % (self.importer, name) for name in sorted(self.stages)}
+    lines = []
+    for metric, kind, attribute, description in TEXTFILE_METRICS:
+      lines.append('# HELP %s_%s %s.\n' % (PREFIX, metric, description))
+      lines.append('# TYPE %s_%s %s\n' % (PREFIX, metric, kind))
+      for name in sorted(self.stages):
+        lines.append('%s_%s%s %r\n' % (PREFIX, metric, labels[name], getattr(self.stages[name], attribute)))
+    lines.append('# HELP %s_start_time_seconds When the import started.\n' % PREFIX)
+    lines.append('# TYPE %s_start_time_seconds gauge\n' % PREFIX)
+    lines.append('%s_start_time_seconds{importer="%s"} %r\n' % (PREFIX, self.importer, self._started))
+    lines.append('# HELP %s_last_update_seconds When these metrics were written.\n' % PREFIX)
+    lines.append('# TYPE %s_last_update_seconds gauge\n' % PREFIX)
+    lines.append('%s_last_update_seconds{importer="%s"} %r\n' % (PREFIX, self.importer, time.time()))
+    return lines
+
+  def emit(self, now=None, **extra):
+    """Appends a snapshot to the json lines file and replaces the textfile, in one go so the collector never
+       reads half of it."""
+    now = now or time.perf_counter()
+    self._next = now + self.interval
+    if self.json_path:
+      snapshot = self.snapshot(now)
+      snapshot.update(extra)
+      with open(self.json_path, 'a') as f:
+        f.write(json.dumps(snapshot) + '\n')
+    if self.textfile:
+      with open(self.textfile + '.tmp', 'w') as f:
+        f.writelines(self.textfile_lines())
+      os.replace(self.textfile + '.tmp', self.textfile)
+
+  def summary(self):
+    elapsed = time.perf_counter() - self._start
+    lines = ['%s: %.1fs' % (self.importer, elapsed)]
+    for name, stage in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+      seconds = stage.seconds or 1e-9
+      lines.append('  %-12s %9.1fs %5.1f%% %12d items %10.0f/s %9.1f MB %8.1f MB/s %8.3fs max' % (
+          name, stage.seconds, stage.seconds / elapsed * 100, stage.items, stage.items / seconds,
+          stage.bytes / 1e6, stage.bytes / seconds / 1e6, stage.max_seconds))
+    return '\n'.join(lines)
+
+  def close(self):
+    """The last write of the metrics, and the totals on stdout."""
+    self.emit(done=True)
+    print(self.summary(), flush=True)
+
+
+class Reader():
+  """A binary stream, the output of bzcat or zcat, whose reads are timed and counted as stage name. Iterating
+     over it gives lines like the stream would, a line is an item."""
+  def __init__(self, stream, metrics, name='decompress'):
+    self._stream = stream
+    self._metrics = metrics
+    self._stage = metrics.stage(name)
+
+  def read(self, size=-1):
+    start = self._metrics.start()
+    data = self._stream.read(size)
+    self._metrics.stop(self._stage, start, 0, len(data))
+    return data
+
+  def readline(self):
+    start = self._metrics.start()
+    line = self._stream.readline()
+    self._metrics.stop(self._stage, start, 1 if line else 0, len(line))
+    return line
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration
+    return line
+
+
+class Cursor():
+  """A psycopg2 cursor whose calls to the server are timed as stage name, the time spent waiting on postgres.
+     Everything else goes straight to the cursor."""
+  def __init__(self, cursor, metrics, name='db'):
+    self._cursor = cursor
+    self._metrics = metrics
+    self._stage = metrics.stage(name)
+
+  def _timed(self, method, *args):
+    start = self._metrics.start()
+    try:
+      return method(*args)
+    finally:
+      self._metrics.stop(self._stage, start, 1)
+
+  def execute(self, *args):
+    return self._timed(self._cursor.execute, *args)
+
+  def executemany(self, *args):
+    return self._timed(self._cursor.executemany, *args)
+
+  def copy_expert(self, *args):
+    return self._timed(self._cursor.copy_expert, *args)
+
+  def fetchone(self):
+    return self._timed(self._cursor.fetchone)
+
+  def fetchall(self):
+    return self._timed(self._cursor.fetchall)
+
+  def __iter__(self):
+    return iter(self._cursor)
+
+  def __getattr__(self, name):
+    return getattr(self._cursor, name)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import import_stats
+import metrics
+from metrics import Cursor, Metrics, Reader
+
+
+class FakeClock():
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class FakeCursor():
+  def __init__(self, clock):
+    self.clock = clock
+    self.sql = []
+    self.rowcount = 7
+
+  def execute(self, sql, params=None):
+    self.clock.now += 2
+    self.sql.append(sql)
+
+
+class TestMetrics(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    patcher = mock.patch.object(metrics.time, 'perf_counter', self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dir)
+
+  def test_nested(self):
+    m = Metrics('test')
+
+    def pages():
+      for page in 'ab':
+        with m.timer('decompress', 0, 10):
+          self.clock.now += 1
+        self.clock.now += 0.5
+        yield page
+
+    def analyze(pages):
+      for page in pages:
+        self.clock.now += 3
+        yield page
+
+    for page in m.iterate('analyze', analyze(m.iterate('parse', pages()))):
+      # not in any stage
+      self.clock.now += 100
+      with m.timer('load', 1):
+        self.clock.now += 0.25
+        Cursor(FakeCursor(self.clock), m).execute('COPY')
+
+    # each stage only has its own time
+    self.assertEqual({name: (stage.items, stage.bytes, stage.seconds, stage.calls)
+                      for name, stage in m.stages.items()},
+                     {'decompress': (0, 20, 2, 2), 'parse': (2, 0, 1, 3), 'analyze': (2, 0, 6, 3),
+                      'load': (2, 0, 0.5, 2), 'db': (2, 0, 4, 2)})
+    self.assertEqual(m.stages['analyze'].max_seconds, 3)
+
+  def test_exception(self):
+    m = Metrics('test')
+    with self.assertRaises(ValueError):
+      with m.timer('outer'):
+        with m.timer('inner', 1):
+          self.clock.now += 1
+          raise ValueError()
+    self.assertEqual(m._inner, [])
+    self.assertEqual(m.stages['inner'].seconds, 1)
+    self.assertEqual(m.stages['outer'].seconds, 0)
+
+  def test_emit(self):
+    json_path = os.path.join(self.dir, 'metrics.jsonl')
+    textfile = os.path.join(self.dir, 'import.prom')
+    m = Metrics('import_wikidata', json_path, textfile, interval=10)
+    for _ in range(4):
+      with m.timer('parse', 5, 100):
+        self.clock.now += 4
+    # written every 10 seconds, from the call that passes it
+    with open(json_path) as f:
+      lines = [json.loads(line) for line in f]
+    self.assertEqual(len(lines), 1)
+    self.assertEqual(lines[0]['importer'], 'import_wikidata')
+    self.assertEqual(lines[0]['elapsed'], 12)
+    self.assertEqual(lines[0]['stages']['parse'], {
+      'items': 15, 'bytes': 300, 'seconds': 12, 'calls': 3, 'max_seconds': 4, 'items_per_s': 1.2,
+      'bytes_per_s': 25, 'busy': 1})
+
+    m.close()
+    with open(json_path) as f:
+      lines = [json.loads(line) for line in f]
+    # the rates are for the time since the one before
+    self.assertEqual(lines[-1]['stages']['parse']['items_per_s'], 1.2)
+    self.assertTrue(lines[-1]['done'])
+    self.assertEqual(sorted(os.listdir(self.dir)), ['import.prom', 'metrics.jsonl'])
+    with open(textfile) as f:
+      text = f.read()
+    self.assertIn('# TYPE wiki_import_stage_items_total counter\n'
+                  'wiki_import_stage_items_total{importer="import_wikidata",stage="parse"} 20\n', text)
+    self.assertIn('wiki_import_stage_seconds_total{importer="import_wikidata",stage="parse"} 16.0\n', text)
+
+  def test_reader(self):
+    m = Metrics('test')
+    stream = Reader(io.BytesIO(b'one\ntwo\nthree'), m)
+    self.assertEqual(stream.read(2), b'on')
+    self.assertEqual(list(stream), [b'e\n', b'two\n', b'three'])
+    self.assertEqual(stream.read(), b'')
+    self.assertEqual((m.stages['decompress'].items, m.stages['decompress'].bytes), (3, 13))
+
+  def test_cursor(self):
+    m = Metrics('test')
+    cursor = Cursor(FakeCursor(self.clock), m)
+    cursor.execute('SELECT 1')
+    self.assertEqual(cursor.rowcount, 7)
+    self.assertEqual(cursor.sql, ['SELECT 1'])
+    self.assertEqual(m.stages['db'].seconds, 2)
+
+  def test_import_stats(self):
+    for hour in range(2):
+      with gzip.open(os.path.join(self.dir, 'pageviews-20240101-%02d0000.gz' % hour), 'wt') as f:
+        f.write('en Main_Page 10 0\nen Berlin 2 0\n')
+    m = Metrics('import_stats')
+    files = sorted(fn for fn in os.listdir(self.dir) if fn.endswith('.gz'))
+    counts = import_stats.aggregate(self.dir, files, [], metrics=m)
+    self.assertEqual(dict(counts), {'Main Page': 20, 'Berlin': 4})
+    self.assertEqual(m.stages['count'].items, 2)
+    self.assertEqual(m.stages['merge'].items, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+#!/bin/python3
+
+import collections
+import html
+
+# 4MB reads from the decompressor
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# a record per <revision>; end is the offset in the stream just past the </page> it belongs to
+PageRecord = collections.namedtuple('PageRecord', 'id ns title revision_id text end')
+
+
+def _unescape(data):
+  if b'\r' in data:
+    # what an xml parser does with line endings
+    data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+  if b'&' not in data:
+    return data.decode('utf-8')
+  if b'&#' in data:
+    return html.unescape(data.decode('utf-8'))
+  # the dumps only use these named entities, replacing them is a lot quicker than html.unescape
+  return (data.replace(b'&lt;', b'<').replace(b'&gt;', b'>').replace(b'&quot;', b'"').replace(b'&apos;', b"'")
+          .replace(b'&amp;', b'&').decode('utf-8'))
+
+
+def _element(page, tag, pos, end=None):
+  """Returns (content, position after the closing tag) of the first <tag> at or after pos."""
+  start = page.find(b'<' + tag + b'>', pos, end)
+  if start < 0:
+    return None, pos
+  start += len(tag) + 2
+  stop = page.find(b'</' + tag + b'>', start)
+  return page[start:stop], stop + len(tag) + 3
+
+
+def _text(revision):
+  start = revision.find(b'<text')
+  if start < 0:
+    return ''
+  start = revision.find(b'>', start) + 1
+  if revision[start - 2:start] == b'/>':
+    return ''
+  return _unescape(revision[start:revision.find(b'</text>', start)])
+
+
+def parse_page(page, end):
+  title, pos = _element(page, b'title', 0)
+  ns, pos = _element(page, b'ns', pos)
+  page_id, pos = _element(page, b'id', pos)
+  title = _unescape(title)
+  ns = int(ns) if ns is not None else None
+  page_id = int(page_id)
+  while True:
+    start = page.find(b'<revision>', pos)
+    if start < 0:
+      return
+    stop = page.find(b'</revision>', start)
+    revision = page[start:stop]
+    revision_id, _ = _element(revision, b'id', 0)
+    yield PageRecord(page_id, ns, title, int(revision_id), _text(revision), end)
+    pos = stop
+
+
+def iter_pages(stream, buffer_size=BUFFER_SIZE, offset=0):
+  """Yields a PageRecord for every revision of every <page> in a binary xml stream.
+
+     Only looks for the handful of elements we use, so it doesn't care about anything outside of
+     <page> and can start anywhere in a dump. offset is the position of the stream in the dump, it
+     is added to PageRecord.end.
+  """
+  buf = b''
+  pos = 0
+  scan = 0
+  eof = False
+  while True:
+    start = buf.find(b'<page>', pos)
+    end = buf.find(b'</page>', max(start, scan)) if start >= 0 else -1
+    if end >= 0:
+      end += len(b'</page>')
+      yield from parse_page(buf[start:end], offset + end)
+      pos = scan = end
+      continue
+    if eof:
+      return
+    # keep the unfinished page around, or the tail in case a <page> tag got cut in half
+    keep = start if start >= 0 else max(pos, len(buf) - len(b'<page>'))
+    # no need to search the part of the page we've already seen for </page> again
+    scan = max(len(buf) - len(b'</page>'), keep) - keep
+    offset += keep
+    chunk = stream.read(buffer_size)
+    eof = not chunk
+    buf = buf[keep:] + chunk
+    pos = 0
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import io
+import unittest
+
+from import_wikipedia import read_pages
+from import_wikipedia_test import DUMP
+from page_extractor import iter_pages
+
+INCR = b"""<mediawiki xml:lang="en">
+  <page>
+    <title>Q42</title>
+    <ns>0</ns>
+    <id>138</id>
+    <revision>
+      <id>1001</id>
+      <contributor><id>7</id></contributor>
+      <text bytes="19" xml:space="preserve">{&quot;id&quot;:&quot;Q42&quot;}</text>
+    </revision>
+    <revision>
+      <id>1002</id>
+      <text bytes="0" deleted="deleted" />
+    </revision>
+  </page>
+  <page>
+    <title>Q&amp;A</title>
+    <ns>0</ns>
+    <id>139</id>
+    <revision>
+      <id>1003</id>
+      <text xml:space="preserve">line\r\none &amp;lt; &#233;</text>
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+
+class TestPageExtractor(unittest.TestCase):
+  def test_matches_sax(self):
+    expected = [page[:3] for page in read_pages(line + '\n' for line in DUMP.split('\n'))]
+    for buffer_size in 7, 64, 4096:
+      records = list(iter_pages(io.BytesIO(DUMP.encode('utf-8')), buffer_size))
+      self.assertEqual([(r.id, r.title, r.text) for r in records], expected)
+      self.assertEqual([r.revision_id for r in records], [631144794, 734566960])
+
+  def test_revisions(self):
+    records = list(iter_pages(io.BytesIO(INCR), 16, offset=100))
+    self.assertEqual([(r.id, r.revision_id) for r in records], [(138, 1001), (138, 1002), (139, 1003)])
+    self.assertEqual(records[0].text, '{"id":"Q42"}')
+    self.assertEqual(records[1].text, '')
+    self.assertEqual(records[2].title, 'Q&A')
+    self.assertEqual(records[2].text, 'line\none &lt; \xe9')
+    # end points just past </page>, offset included
+    self.assertEqual(INCR[records[0].end - 100 - len(b'</page>'):records[0].end - 100], b'</page>')
+    self.assertEqual(records[0].end, records[1].end)
+
+  def test_resume_mid_dump(self):
+    records = list(iter_pages(io.BytesIO(INCR)))
+    rest = list(iter_pages(io.BytesIO(INCR[records[0].end:]), 16, offset=records[0].end))
+    self.assertEqual(rest, records[2:])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,92 @@
+#!/bin/python3
+
+"""Helpers to stream rows into postgres with COPY ... FROM STDIN instead of one INSERT per row."""
+
+import io
+import json
+import struct
+
+NULL = '\\N'
+
+_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+_ARRAY_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+
+def array_literal(values):
+  """Postgres array literal for a list of strings: every element is quoted, so commas, braces and
+     spaces in elements need no further care."""
+  return '{' + ','.join('NULL' if v is None else '"' + v.translate(_ARRAY_ESCAPES) + '"' for v in values) + '}'
+
+
+def copy_value(value):
+  if value is None:
+    return NULL
+  if isinstance(value, (list, tuple)):
+    value = array_literal(value)
+  return str(value).translate(_TEXT_ESCAPES)
+
+
+def format_row(values):
+  return '\t'.join(copy_value(value) for value in values) + '\n'
+
+
+def copy_rows(cursor, table, columns, rows):
+  data = io.StringIO(''.join(format_row(row) for row in rows))
+  cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), data)
+
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\0' + struct.pack('>ii', 0, 0)
+BINARY_TRAILER = struct.pack('>h', -1)
+# the binary jsonb format is a version byte followed by the json text
+JSONB_VERSION = b'\x01'
+_NULL_FIELD = struct.pack('>i', -1)
+_JSON_DUMPS = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def binary_field(value, typ):
+  if value is None:
+    return _NULL_FIELD
+  if typ == 'jsonb':
+    data = JSONB_VERSION + _JSON_DUMPS(value).encode('utf-8')
+  elif typ == 'bool':
+    data = b'\x01' if value else b'\x00'
+  elif typ == 'int8':
+    data = struct.pack('>q', value)
+  else:
+    data = value.encode('utf-8')
+  return struct.pack('>i', len(data)) + data
+
+
+def binary_row(values, types):
+  """One tuple of the COPY binary format. types has 'text', 'jsonb', 'bool' or 'int8' for every value; text
+     goes as is and jsonb as json, so nothing needs escaping."""
+  return struct.pack('>h', len(values)) + b''.join(binary_field(v, typ) for v, typ in zip(values, types))
+
+
+class BinaryCopyWriter():
+  """Buffers rows in the COPY binary format and sends them with one COPY ... FROM STDIN every batch_size
+     rows. flush before committing, rows still in the buffer aren't in the database yet."""
+  def __init__(self, cursor, table, columns, types, batch_size):
+    self._cursor = cursor
+    self._sql = 'COPY %s (%s) FROM STDIN (FORMAT binary)' % (table, ', '.join(columns))
+    self._types = types
+    self._batch_size = batch_size
+    self._buffer = io.BytesIO()
+    self._rows = 0
+
+  def write(self, row):
+    if not self._rows:
+      self._buffer.write(BINARY_HEADER)
+    self._buffer.write(binary_row(row, self._types))
+    self._rows += 1
+    if self._rows >= self._batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self._rows:
+      return
+    self._buffer.write(BINARY_TRAILER)
+    self._buffer.seek(0)
+    self._cursor.copy_expert(self._sql, self._buffer)
+    self._buffer = io.BytesIO()
+    self._rows = 0
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import struct
+import unittest
+from pg_copy import array_literal, copy_rows, format_row, binary_row, BinaryCopyWriter, BINARY_HEADER, BINARY_TRAILER
+
+
+class FakeCursor():
+  def __init__(self):
+    self.copies = []
+
+  def copy_expert(self, sql, f):
+    self.copies.append((sql, f.read()))
+
+
+class TestPgCopy(unittest.TestCase):
+  def test_format_row(self):
+    self.assertEqual(format_row((12, 'Anarchism', None)), '12\tAnarchism\t\\N\n')
+    self.assertEqual(format_row(('a\tb\nc\\d\re',)), 'a\\tb\\nc\\\\d\\re\n')
+
+  def test_array_literal(self):
+    self.assertEqual(array_literal([]), '{}')
+    self.assertEqual(array_literal(['cities', 'a, b', '{{redr}}']), '{"cities","a, b","{{redr}}"}')
+    self.assertEqual(array_literal(['say "hi"', 'back\\slash']), '{"say \\"hi\\"","back\\\\slash"}')
+    # the array literal gets escaped once more as a COPY value
+    self.assertEqual(format_row((['back\\slash'],)), '{"back\\\\\\\\slash"}\n')
+
+  def test_copy_rows(self):
+    fc = FakeCursor()
+    copy_rows(fc, 'import.wikipedia', ('id', 'title'), [(1, 'a'), (2, 'b')])
+    self.assertEqual(fc.copies, [('COPY import.wikipedia (id, title) FROM STDIN', '1\ta\n2\tb\n')])
+
+  def test_binary_row(self):
+    row = binary_row(('Q\\1\t', {'a': ['é', None]}, None), ('text', 'jsonb', 'text'))
+    text = 'Q\\1\t'.encode('utf-8')
+    jsonb = b'\x01{"a":["\xc3\xa9",null]}'
+    self.assertEqual(row, struct.pack('>hi', 3, len(text)) + text + struct.pack('>i', len(jsonb)) + jsonb +
+                     struct.pack('>i', -1))
+    self.assertEqual(binary_row((True, -5), ('bool', 'int8')), struct.pack('>hib', 2, 1, 1) + struct.pack('>iq', 8, -5))
+
+  def test_binary_copy_writer(self):
+    fc = FakeCursor()
+    writer = BinaryCopyWriter(fc, 'import.wikidata', ('id', 'data'), ('text', 'jsonb'), 2)
+    for i in range(3):
+      writer.write(('Q%d' % i, [i]))
+    writer.flush()
+    writer.flush()
+    rows = [binary_row(('Q%d' % i, [i]), ('text', 'jsonb')) for i in range(3)]
+    sql = 'COPY import.wikidata (id, data) FROM STDIN (FORMAT binary)'
+    self.assertEqual(fc.copies, [(sql, BINARY_HEADER + rows[0] + rows[1] + BINARY_TRAILER),
+                                 (sql, BINARY_HEADER + rows[2] + BINARY_TRAILER)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+#!/bin/python3
+
+import collections
+import itertools
+import queue
+import threading
+
+
+def batched(iterable, size):
+  it = iter(iterable)
+  while True:
+    batch = list(itertools.islice(it, size))
+    if not batch:
+      return
+    yield batch
+
+
+def ordered_imap(pool, func, batches, max_pending):
+  """Like pool.imap, but yields (batch, result) and keeps at most max_pending tasks in flight.
+
+     Pool.imap consumes its input as fast as it can, which for a dump means reading it into memory
+     while the writer is still busy. Results come back in input order so the output stays the same
+     as a single process run.
+  """
+  pending = collections.deque()
+  for batch in batches:
+    pending.append((batch, pool.apply_async(func, (batch,))))
+    if len(pending) >= max_pending:
+      batch, result = pending.popleft()
+      yield batch, result.get()
+  while pending:
+    batch, result = pending.popleft()
+    yield batch, result.get()
+
+
+_DONE = object()
+
+
+def prefetch(iterable, ahead=1):
+  """Yields the items of iterable, which is run in a background thread that stays at most ahead items in
+     front of the consumer: while the consumer works on an item, the next ahead are made. Good for overlapping
+     downloads with the processing of what was downloaded before. An exception in the thread is raised here
+     when its turn comes.
+  """
+  if ahead <= 0:
+    yield from iterable
+    return
+  items = queue.Queue()
+  # one for every item the thread may start on, given back when the consumer takes one
+  slots = threading.Semaphore(ahead)
+
+  def produce():
+    try:
+      it = iter(iterable)
+      while True:
+        slots.acquire()
+        item = next(it, _DONE)
+        if item is _DONE:
+          break
+        items.put((item, None))
+    except Exception as e:
+      items.put((_DONE, e))
+      return
+    items.put((_DONE, None))
+
+  threading.Thread(target=produce, daemon=True).start()
+  while True:
+    item, error = items.get()
+    if item is _DONE:
+      if error:
+        raise error
+      return
+    slots.release()
+    yield item
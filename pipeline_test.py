@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+
+import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+  def test_prefetch(self):
+    self.assertEqual(list(pipeline.prefetch(range(10), 2)), list(range(10)))
+    self.assertEqual(list(pipeline.prefetch([], 1)), [])
+
+  def test_prefetch_runs_ahead(self):
+    # the second item is produced while the consumer still holds the first one
+    second = threading.Event()
+
+    def produce():
+      yield 1
+      second.set()
+      yield 2
+    items = pipeline.prefetch(produce(), 1)
+    self.assertEqual(next(items), 1)
+    self.assertTrue(second.wait(5))
+    self.assertEqual(list(items), [2])
+
+  def test_prefetch_stays_ahead(self):
+    # with one ahead the third item isn't started before the consumer takes the second
+    started = [threading.Event() for _ in range(3)]
+
+    def produce():
+      for i, event in enumerate(started):
+        event.set()
+        yield i
+    items = pipeline.prefetch(produce(), 1)
+    self.assertEqual(next(items), 0)
+    self.assertTrue(started[1].wait(5))
+    self.assertFalse(started[2].wait(0.2))
+    self.assertEqual(next(items), 1)
+    self.assertTrue(started[2].wait(5))
+    self.assertEqual(list(items), [2])
+    self.assertEqual(list(pipeline.prefetch(range(3), 0)), [0, 1, 2])
+
+  def test_prefetch_error(self):
+    def produce():
+      yield 1
+      raise IOError('connection reset')
+    items = pipeline.prefetch(produce(), 1)
+    self.assertEqual(next(items), 1)
+    self.assertRaises(IOError, next, items)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+#!/bin/python3
+
+"""The indexes and derived tables built after a load, as steps that run in parallel on several connections.
+
+A step is a name, a function that takes a cursor and the names of the steps it has to wait for. Every step
+runs in its own transaction on one of the connections as soon as the steps it needs are done. Index builds
+on the same table only take a SHARE lock, so they can run at the same time; with a couple of parallel
+maintenance workers each, they keep a big machine busy instead of one core.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import queue
+import threading
+import time
+
+import psycopg2
+
+import staging
+
+CONNECTIONS = 4
+MAINTENANCE_WORK_MEM = '1GB'
+PARALLEL_MAINTENANCE_WORKERS = 2
+
+Step = collections.namedtuple('Step', 'name run after')
+
+_log_lock = threading.Lock()
+
+
+def log_time(name, elapsed):
+  with _log_lock:
+    print('%-50s %8.1fs' % (name, elapsed), flush=True)
+
+
+def logged_step(table):
+  return 'set logged ' + table
+
+
+def staged_steps(table, indexes, keys=(), after=()):
+  """Steps that get a staging table (see staging.py) ready for swap_steps: make it logged, then build its
+     keys and indexes side by side."""
+  logged = logged_step(table)
+  steps = [Step(logged, functools.partial(staging.set_logged, table=table), tuple(after))]
+  for key in keys:
+    steps.append(Step(key[0], functools.partial(staging.build_key, table=table, key=key), (logged,)))
+  for index in indexes:
+    steps.append(Step(index[0], functools.partial(staging.build_index, table=table, index=index), (logged,)))
+  return steps
+
+
+def swap_steps(tables, steps):
+  """One step after all of steps that swaps in the staging tables of tables, a list of (table, indexes, keys),
+     in one transaction."""
+  def swap(cursor):
+    for table, indexes, keys in tables:
+      staging.swap_in(cursor, table, indexes, keys)
+  return [Step('swap in ' + ', '.join(table for table, _, _ in tables), swap, tuple(step.name for step in steps))]
+
+
+def connect(connection_string, maintenance_work_mem=MAINTENANCE_WORK_MEM,
+            parallel_workers=PARALLEL_MAINTENANCE_WORKERS):
+  conn = psycopg2.connect(connection_string)
+  cursor = conn.cursor()
+  if maintenance_work_mem:
+    cursor.execute('SET maintenance_work_mem = %s', (maintenance_work_mem,))
+  if parallel_workers is not None:
+    cursor.execute('SET max_parallel_maintenance_workers = %s', (parallel_workers,))
+  conn.commit()
+  return conn
+
+
+def check(steps):
+  names = set()
+  for step in steps:
+    if step.name in names:
+      raise ValueError('two steps called %s' % step.name)
+    names.add(step.name)
+  for step in steps:
+    missing = set(step.after) - names
+    if missing:
+      raise ValueError('%s waits for steps that don\'t exist: %s' % (step.name, ', '.join(sorted(missing))))
+
+
+def run(connect_fn, steps, connections=CONNECTIONS):
+  """Runs steps with at most connections of them at the same time, each on a connection from connect_fn.
+     If a step fails, the steps already running finish and then the error is raised."""
+  check(steps)
+  idle = queue.Queue()
+  opened = []
+  for _ in range(min(connections, len(steps))):
+    conn = connect_fn()
+    opened.append(conn)
+    idle.put(conn)
+
+  def execute(step):
+    conn = idle.get()
+    try:
+      start = time.perf_counter()
+      step.run(conn.cursor())
+      conn.commit()
+      log_time(step.name, time.perf_counter() - start)
+    except:
+      conn.rollback()
+      raise
+    finally:
+      idle.put(conn)
+
+  start = time.perf_counter()
+  pending = list(steps)
+  done = set()
+  running = {}
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(opened))) as executor:
+      while pending or running:
+        for step in [step for step in pending if done.issuperset(step.after)]:
+          pending.remove(step)
+          running[executor.submit(execute, step)] = step
+        if not running:
+          raise ValueError('steps that wait for each other: %s' % ', '.join(step.name for step in pending))
+        finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+          step = running.pop(future)
+          future.result()
+          done.add(step.name)
+  finally:
+    for conn in opened:
+      conn.close()
+  log_time('post import', time.perf_counter() - start)
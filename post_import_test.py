@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+
+import post_import
+from post_import import Step
+
+
+class FakeConnection():
+  def __init__(self, log):
+    self.log = log
+    self.closed = False
+
+  def cursor(self):
+    return self
+
+  def execute(self, sql, params=None):
+    self.log.append(sql)
+
+  def commit(self):
+    pass
+
+  def rollback(self):
+    self.log.append('rollback')
+
+  def close(self):
+    self.closed = True
+
+
+class TestPostImport(unittest.TestCase):
+  def setUp(self):
+    self.log = []
+    self.connections = []
+
+  def connect(self):
+    conn = FakeConnection(self.log)
+    self.connections.append(conn)
+    return conn
+
+  def step(self, name, after=()):
+    return Step(name, lambda cursor: cursor.execute(name), after)
+
+  def test_staged_table(self):
+    steps = post_import.staged_steps('import.t', [('t_a', 'CREATE INDEX %s ON %s(a)')],
+                                     [('t_pkey', 'PRIMARY KEY', 'id')], after=['fill'])
+    steps = [self.step('fill')] + steps
+    steps += post_import.swap_steps([('import.t', [('t_a', '')], [('t_pkey', 'PRIMARY KEY', 'id')])], steps)
+    post_import.run(self.connect, steps, 2)
+    self.assertEqual(self.log[:2], ['fill', 'ALTER TABLE import.t_staging SET LOGGED'])
+    self.assertEqual(sorted(self.log[2:4]), ['CREATE INDEX t_a_staging ON import.t_staging(a)',
+                                             'CREATE UNIQUE INDEX t_pkey_staging ON import.t_staging (id)'])
+    self.assertEqual(self.log[4:], ['DROP TABLE IF EXISTS import.t',
+                                    'ALTER TABLE import.t_staging RENAME TO t',
+                                    'ALTER TABLE import.t ADD CONSTRAINT t_pkey PRIMARY KEY USING INDEX t_pkey_staging',
+                                    'ALTER INDEX import.t_a_staging RENAME TO t_a'])
+    self.assertEqual(len(self.connections), 2)
+    self.assertTrue(all(conn.closed for conn in self.connections))
+
+  def test_runs_in_parallel(self):
+    # both steps wait for the other one to have started, which only works if they run at the same time
+    started = [threading.Event(), threading.Event()]
+
+    def wait_for_other(i, cursor):
+      started[i].set()
+      if not started[1 - i].wait(5):
+        raise RuntimeError('ran alone')
+    steps = [Step('a', lambda cursor: wait_for_other(0, cursor), ()),
+             Step('b', lambda cursor: wait_for_other(1, cursor), ())]
+    post_import.run(self.connect, steps, 2)
+
+  def test_failure(self):
+    def fail(cursor):
+      raise RuntimeError('no space left')
+    steps = [Step('a', fail, ()), self.step('b', ['a'])]
+    self.assertRaises(RuntimeError, post_import.run, self.connect, steps, 2)
+    self.assertEqual(self.log, ['rollback'])
+    self.assertTrue(all(conn.closed for conn in self.connections))
+
+  def test_bad_dependencies(self):
+    self.assertRaises(ValueError, post_import.run, self.connect, [self.step('a', ['b'])])
+    self.assertRaises(ValueError, post_import.run, self.connect, [self.step('a', ['b']), self.step('b', ['a'])])
+    self.assertRaises(ValueError, post_import.run, self.connect, [self.step('a'), self.step('a')])
+
+
+if __name__ == '__main__':
+  unittest.main()
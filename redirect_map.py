@@ -0,0 +1,164 @@
+#!/bin/python3
+
+"""Redirect title -> article title for the main namespace, built from the page and redirect dumps.
+
+The map is a file that's mmapped: the sorted 64 bit hashes of the redirect titles, for each the index of its
+target, and the target titles. Opening it costs nothing and it doesn't hold millions of python strings; a
+lookup hashes the title and bisects. Two titles with the same hash are a 1 in 10^12 chance per lookup, which is
+fine for view counts. Redirects to redirects are followed when the file is made, so a lookup is one hop.
+
+Titles are the way import_stats has them, with spaces rather than underscores.
+"""
+
+import argparse
+import bisect
+import functools
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+
+import load_sql_dump
+
+MAGIC = b'REDIRS1\0'
+HEADER = struct.Struct('<8sQQ')
+# titles looked up over and over, the main page and whatever is in the news, are remembered. An entry is a
+# couple of hundred bytes and every process that counts has its own cache, so keep it to the hot titles
+CACHE_SIZE = 50000
+# a redirect to a redirect to ... is followed this far
+MAX_HOPS = 5
+
+CACHE_FILE = 'redirects.idx'
+
+
+def title_hash(title):
+    return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def dump_title(title):
+    return title.replace('_', ' ')
+
+
+class RedirectMap():
+    """Reads a file made by write_map. get(title) is the article a redirect goes to, or None."""
+    def __init__(self, path, cache_size=CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, targets = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a redirect map' % path)
+        view = memoryview(self._mm)
+        start = HEADER.size
+        self._keys = view[start:start + 8 * count].cast('Q')
+        start += 8 * count
+        self._targets = view[start:start + 4 * count].cast('I')
+        start += 4 * count
+        self._offsets = view[start:start + 8 * (targets + 1)].cast('Q')
+        self._blob = start + 8 * (targets + 1)
+        self._count = count
+        self.get = functools.lru_cache(cache_size)(self._get)
+
+    def __getstate__(self):
+        # worker processes map the file themselves
+        return {'path': self.path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['cache_size'])
+
+    def __len__(self):
+        return self._count
+
+    def _target(self, i):
+        return self._mm[self._blob + self._offsets[i]:self._blob + self._offsets[i + 1]].decode('utf-8')
+
+    def _get(self, title):
+        key = title_hash(title)
+        i = bisect.bisect_left(self._keys, key)
+        if i < self._count and self._keys[i] == key:
+            return self._target(self._targets[i])
+        return None
+
+    def fold(self, title):
+        """The title views of title count for: the article it redirects to, or itself."""
+        return self.get(title) or title
+
+
+def read_redirects(page_dump, redirect_dump):
+    """{title_hash(redirect title): target title} for the main namespace from the dumps, not following chains
+       yet. Keyed by the hash already, that's all the map keeps and it's a lot smaller than the titles."""
+    targets = {}
+    for page_id, namespace, title, interwiki in load_sql_dump.dump_rows(
+            redirect_dump, ('rd_from', 'rd_namespace', 'rd_title', 'rd_interwiki')):
+        if namespace == '0' and not interwiki:
+            targets[int(page_id)] = dump_title(title)
+    redirects = {}
+    for page_id, namespace, title in load_sql_dump.dump_rows(page_dump, ('page_id', 'page_namespace', 'page_title')):
+        if namespace == '0':
+            target = targets.get(int(page_id))
+            if target is not None:
+                redirects[title_hash(dump_title(title))] = target
+    return redirects
+
+
+def resolve(redirects):
+    """Follows redirects to redirects, up to MAX_HOPS; loops end where they started."""
+    resolved = {}
+    for key, target in redirects.items():
+        seen = {key}
+        for _ in range(MAX_HOPS):
+            target_key = title_hash(target)
+            if target_key not in redirects or target_key in seen:
+                break
+            seen.add(target_key)
+            target = redirects[target_key]
+        if title_hash(target) != key:
+            resolved[key] = target
+    return resolved
+
+
+def write_map(path, redirects, cache_size=CACHE_SIZE):
+    """Writes {title_hash(redirect title): target title} as a RedirectMap."""
+    keys = array('Q', sorted(redirects))
+    indexes = array('I')
+    offsets = array('Q', [0])
+    target_index = {}
+    blob = bytearray()
+    for key in keys:
+        target = redirects[key]
+        if target not in target_index:
+            target_index[target] = len(target_index)
+            blob += target.encode('utf-8')
+            offsets.append(len(blob))
+        indexes.append(target_index[target])
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(target_index)))
+        keys.tofile(f)
+        indexes.tofile(f)
+        offsets.tofile(f)
+        f.write(blob)
+    os.replace(path + '.tmp', path)
+    return RedirectMap(path, cache_size)
+
+
+def load(page_dump, redirect_dump, path=None, cache_size=CACHE_SIZE):
+    """The map for the dumps, from path (redirects.idx next to the page dump by default) unless the dumps are
+       newer, otherwise it's made and written there first."""
+    path = path or os.path.join(os.path.dirname(page_dump), CACHE_FILE)
+    if os.path.isfile(path) and os.path.getmtime(path) >= max(os.path.getmtime(page_dump),
+                                                              os.path.getmtime(redirect_dump)):
+        return RedirectMap(path, cache_size)
+    print('making', path, 'from', page_dump, 'and', redirect_dump, flush=True)
+    return write_map(path, resolve(read_redirects(page_dump, redirect_dump)), cache_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make the redirect map import_stats folds titles with')
+    parser.add_argument('page_dump', type=str, help='enwiki-<date>-page.sql.gz')
+    parser.add_argument('redirect_dump', type=str, help='enwiki-<date>-redirect.sql.gz')
+    parser.add_argument('--out', type=str, default=None, help='where to write it, redirects.idx next to the dumps by default')
+
+    args = parser.parse_args()
+    print(len(load(args.page_dump, args.redirect_dump, args.out)), 'redirects')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+import redirect_map
+
+PAGE_DUMP = """CREATE TABLE `page` (
+  `page_id` int(8) unsigned NOT NULL AUTO_INCREMENT,
+  `page_namespace` int(11) NOT NULL DEFAULT 0,
+  `page_title` varbinary(255) NOT NULL DEFAULT '',
+  `page_is_redirect` tinyint(1) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`page_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+INSERT INTO `page` VALUES (1,0,'Douglas_Adams',0),(2,0,'Douglas_Noël_Adams',1),(3,0,'D._Adams',1),(4,0,'Adams,_D.',1);
+INSERT INTO `page` VALUES (5,0,'Loop_A',1),(6,0,'Loop_B',1),(7,1,'Douglas_Adams',1),(8,0,'Elsewhere',1),(9,0,'Rock\\'n\\'roll',1);
+"""
+
+REDIRECT_DUMP = """CREATE TABLE `redirect` (
+  `rd_from` int(8) unsigned NOT NULL DEFAULT 0,
+  `rd_namespace` int(11) NOT NULL DEFAULT 0,
+  `rd_title` varbinary(255) NOT NULL DEFAULT '',
+  `rd_interwiki` varbinary(32) DEFAULT NULL,
+  `rd_fragment` varbinary(255) DEFAULT NULL,
+  PRIMARY KEY (`rd_from`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+INSERT INTO `redirect` VALUES (2,0,'Douglas_Adams','',NULL),(3,0,'Douglas_Noël_Adams','',NULL),(4,0,'D._Adams','','Early_life');
+INSERT INTO `redirect` VALUES (5,0,'Loop_B','',NULL),(6,0,'Loop_A','',NULL),(7,0,'Douglas_Adams','',NULL),(8,0,'Somewhere','wikt',NULL),(9,0,'Rock_and_roll','',NULL);
+"""
+
+
+class TestRedirectMap(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.page_dump = os.path.join(self.dir, 'enwiki-20240101-page.sql.gz')
+        self.redirect_dump = os.path.join(self.dir, 'enwiki-20240101-redirect.sql.gz')
+        for path, text in (self.page_dump, PAGE_DUMP), (self.redirect_dump, REDIRECT_DUMP):
+            with gzip.open(path, 'wt', encoding='utf-8') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fold(self):
+        redirects = redirect_map.load(self.page_dump, self.redirect_dump)
+        self.assertEqual(redirects.fold('Douglas Noël Adams'), 'Douglas Adams')
+        # chains are followed
+        self.assertEqual(redirects.fold('D. Adams'), 'Douglas Adams')
+        self.assertEqual(redirects.fold('Adams, D.'), 'Douglas Adams')
+        self.assertEqual(redirects.fold("Rock'n'roll"), 'Rock and roll')
+        # articles, loops, other wikis and other namespaces stay
+        for title in 'Douglas Adams', 'Loop A', 'Elsewhere', 'Talk:Douglas Adams', 'Unknown':
+            self.assertEqual(redirects.fold(title), title)
+        self.assertEqual(len(redirects), 4)
+
+        redirects = pickle.loads(pickle.dumps(redirect_map.RedirectMap(redirects.path, 10)))
+        self.assertEqual(redirects.cache_size, 10)
+        self.assertEqual(redirects.get('D. Adams'), 'Douglas Adams')
+        self.assertIsNone(redirects.get('Douglas Adams'))
+
+    def test_cached(self):
+        path = os.path.join(self.dir, 'redirects.idx')
+        redirect_map.load(self.page_dump, self.redirect_dump)
+        made = os.path.getmtime(path)
+        redirect_map.load(self.page_dump, self.redirect_dump)
+        self.assertEqual(os.path.getmtime(path), made)
+
+        # newer dumps make it again
+        later = time.time() + 10
+        os.utime(self.redirect_dump, (later, later))
+        redirect_map.load(self.page_dump, self.redirect_dump)
+        self.assertGreater(os.path.getmtime(path), made)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/bin/python3
+
+"""A Counter for more keys than fit in memory.
+
+Counts are added up in a dict until that dict is estimated to use more than the memory budget, then it is
+written out sorted by key as a run file and emptied. items() merges the runs and what's still in memory,
+adding up the counts of the same key, so a key comes out once with the same total a Counter would have.
+"""
+
+import heapq
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+# a run entry: count and the length of the utf-8 key that follows
+RUN_ENTRY = struct.Struct('<qI')
+# what a dict entry costs besides its key: the slot, the hash table growing and the int
+ENTRY_OVERHEAD = 100
+READ_BUFFER = 1024 * 1024
+
+
+def write_run(f, items):
+    """Writes (key, count) pairs to the binary file f; spill files and the per-file counts of import_stats."""
+    for key, count in items:
+        data = key.encode('utf-8', 'surrogatepass')
+        f.write(RUN_ENTRY.pack(count, len(data)))
+        f.write(data)
+
+
+def read_run(f):
+    while True:
+        head = f.read(RUN_ENTRY.size)
+        if not head:
+            return
+        count, size = RUN_ENTRY.unpack(head)
+        yield f.read(size).decode('utf-8', 'surrogatepass'), count
+
+
+class SpillCounter():
+    """Like a Counter with str keys, but using about memory_mb of memory for the counts and the disk in
+       directory (a temporary directory by default) for the rest. close it, or use it in a with, to remove
+       the run files."""
+    def __init__(self, memory_mb, directory=None):
+        self._budget = memory_mb * 1024 * 1024
+        self._tmp = tempfile.mkdtemp(prefix='spill_counter', dir=directory)
+        self._counts = {}
+        self._bytes = 0
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __setitem__(self, key, count):
+        # only for c[key] += n, which gets c[key] first; that is the count in memory, not the total
+        if key not in self._counts:
+            self._bytes += sys.getsizeof(key) + ENTRY_OVERHEAD
+        self._counts[key] = count
+        if self._bytes > self._budget:
+            self._spill()
+
+    def __getitem__(self, key):
+        return self._counts.get(key, 0)
+
+    def add(self, key, count=1):
+        self[key] = self[key] + count
+
+    def _spill(self):
+        path = os.path.join(self._tmp, 'run%d' % len(self.runs))
+        with open(path, 'wb') as f:
+            write_run(f, ((key, self._counts[key]) for key in sorted(self._counts)))
+        self.runs.append(path)
+        self._counts = {}
+        self._bytes = 0
+
+    def _read_run(self, path):
+        with open(path, 'rb', buffering=READ_BUFFER) as f:
+            yield from read_run(f)
+
+    def items(self):
+        """(key, total) for every key, sorted by key."""
+        in_memory = ((key, self._counts[key]) for key in sorted(self._counts))
+        merged = heapq.merge(in_memory, *[self._read_run(path) for path in self.runs], key=lambda item: item[0])
+        last = None
+        total = 0
+        for key, count in merged:
+            if key != last:
+                if last is not None:
+                    yield last, total
+                last = key
+                total = 0
+            total += count
+        if last is not None:
+            yield last, total
+
+    def most_common(self, n):
+        return heapq.nlargest(n, self.items(), key=lambda item: item[1])
+
+    def close(self):
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        self._counts = {}
+        self.runs = []
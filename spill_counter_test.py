@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from collections import Counter
+
+from spill_counter import SpillCounter
+
+
+class TestSpillCounter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def counts(self, n, seed=1):
+        r = random.Random(seed)
+        for i in range(n):
+            yield 'Title %d ü\ud800' % r.randint(0, n // 3), r.randint(1, 10)
+
+    def test_same_as_counter(self):
+        expected = Counter()
+        with SpillCounter(0.05, self.dir) as c:
+            for title, count in self.counts(20000):
+                c[title] += count
+                expected[title] += count
+            c.add('', 2)
+            expected[''] += 2
+            self.assertGreater(len(c.runs), 5)
+            self.assertEqual(list(c.items()), sorted(expected.items()))
+            self.assertEqual(c.most_common(3), expected.most_common(3))
+        self.assertEqual(len(os.listdir(self.dir)), 0)
+
+    def test_memory_stays_in_budget(self):
+        tracemalloc.start()
+        try:
+            with SpillCounter(1, self.dir) as c:
+                for title, count in self.counts(150000):
+                    c[title] += count
+                _, peak = tracemalloc.get_traced_memory()
+                self.assertGreater(len(c.runs), 1)
+        finally:
+            tracemalloc.stop()
+        # the 50000 distinct titles take over 7MB in a Counter
+        self.assertLess(peak, 3 * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/bin/python3
+
+"""Load into an UNLOGGED copy of a table without keys or indexes, index it when the load is done and
+then swap it in, so readers keep the old data until the new data is complete.
+
+indexes are (name, sql) with sql taking the index name and the table, keys are (name, kind, columns)
+like ('wikipedia_pkey', 'PRIMARY KEY', 'title'). Everything gets built under a _staging name and
+renamed on the swap.
+"""
+
+
+def staging_name(name):
+  return name + '_staging'
+
+
+def create_staging(cursor, table, columns):
+  staging = staging_name(table)
+  cursor.execute('DROP TABLE IF EXISTS %s' % staging)
+  cursor.execute('CREATE UNLOGGED TABLE %s (%s)' % (staging, columns))
+  return staging
+
+
+def staging_rows(cursor, table):
+  """Rows in the staging table of table, None if there is none. A crash of the server empties an unlogged
+     table, so before resuming a load check this against the rows the checkpoint counted."""
+  cursor.execute('SELECT to_regclass(%s)', (staging_name(table),))
+  if cursor.fetchone()[0] is None:
+    return None
+  cursor.execute('SELECT count(*) FROM %s' % staging_name(table))
+  return cursor.fetchone()[0]
+
+
+def set_logged(cursor, table):
+  # an unlogged table is emptied when the server crashes, fine while loading but not after the swap
+  cursor.execute('ALTER TABLE %s SET LOGGED' % staging_name(table))
+
+
+def build_key(cursor, table, key):
+  name, kind, columns = key
+  cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (staging_name(name), staging_name(table), columns))
+
+
+def build_index(cursor, table, index):
+  name, sql = index
+  cursor.execute(sql % (staging_name(name), staging_name(table)))
+
+
+def build(cursor, table, indexes, keys=()):
+  set_logged(cursor, table)
+  for key in keys:
+    build_key(cursor, table, key)
+  for index in indexes:
+    build_index(cursor, table, index)
+
+
+def swap_in(cursor, table, indexes, keys=()):
+  """Replaces table with its staging table. Run it in one transaction, readers block on the swap for
+     a moment and then see the new table."""
+  schema, name = table.split('.')
+  cursor.execute('DROP TABLE IF EXISTS %s' % table)
+  cursor.execute('ALTER TABLE %s RENAME TO %s' % (staging_name(table), name))
+  for key, kind, columns in keys:
+    cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s USING INDEX %s' % (table, key, kind, staging_name(key)))
+  for index, _ in indexes:
+    cursor.execute('ALTER INDEX %s.%s RENAME TO %s' % (schema, staging_name(index), index))
@@ -2,13 +2,12 @@
 
 import argparse
 import sys
-import json
 import os
 import sys
 from datetime import date
 from datetime import timedelta
 
-from subprocess import call
+import requests
 
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -17,29 +16,40 @@ if not THIS_DIR:
 if not THIS_DIR.endswith('/'):
     THIS_DIR = THIS_DIR + '/'
 sys.path.append(THIS_DIR)
+import downloader
+import id_name_store
+import pipeline
 import wd_updater as Updater
 
 
-PROPS_FILE = '/properties.json'
 MAXREVID = '/maxrevid.txt'
 
 BASE_URL = 'https://dumps.wikimedia.org/other/incr/wikidatawiki/'
-STATUS_URL = BASE_URL + '%s/status.txt'
-MAXREVID_URL = BASE_URL + '%s/maxrevid.txt'
-DUMP_URL = BASE_URL + '%s/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
+# relative to BASE_URL, which can point at a mirror
+STATUS_URL = '%s/status.txt'
+MAXREVID_URL = '%s/maxrevid.txt'
+MD5SUMS_URL = '%s/wikidatawiki-%s-md5sums.txt'
+DUMP_URL = '%s/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
 
 MAXREVID_FILE = '/wikidatawiki-%s-maxrevid.txt'
 STATUS_FILE = '/wikidatawiki-%s-status.txt'
+MD5SUMS_FILE = '/wikidatawiki-%s-md5sums.txt'
 DUMP_FILE = '/wikidatawiki-%s-pages-meta-hist-incr.xml.bz2'
 
 STATUS_DONE = 'done:all'
+# days downloaded ahead of the one being applied
+PREFETCH_DAYS = 1
 
 
-def download_status(version, dump_path):
+def download_status(version, dump_path, base_url=BASE_URL):
     # save revision id for the future in case dump have to be reloaded
     file_path = dump_path + STATUS_FILE % version
-    params = ['wget', '-nv', '-O', file_path, STATUS_URL % version]
-    call(params)
+    # the status changes while the dump is made, so this one is always fetched again
+    try:
+        downloader.download(base_url + STATUS_URL % version, file_path, refresh=True)
+    except downloader.NotFound:
+        # the dump of the day hasn't been started yet, usually today's
+        return ''
 
     status = ''
     with open(file_path, 'r') as f:
@@ -48,14 +58,10 @@ def download_status(version, dump_path):
     return status.strip()
 
 
-def download_revid(version, dump_path):
+def download_revid(version, dump_path, base_url=BASE_URL):
     # save revision id for the future in case dump have to be reloaded
     file_path = dump_path + MAXREVID_FILE % version
-    if not os.path.isfile(file_path):
-        params = ['wget', '-nv', '-O', file_path, MAXREVID_URL % version]
-        call(params)
-    else:
-        print('File %s already exists, skip downloading' % file_path, flush=True)
+    downloader.download(base_url + MAXREVID_URL % version, file_path)
 
     rev_id = ''
     with open(file_path, 'r') as f:
@@ -64,13 +70,21 @@ def download_revid(version, dump_path):
     return rev_id
 
 
-def download(version, dump_path):
+def download_md5(version, dump_path, base_url=BASE_URL):
+    """The md5 of the dump of version from its md5sums.txt, or None if that isn't there."""
+    file_path = dump_path + MD5SUMS_FILE % version
+    try:
+        downloader.download(base_url + MD5SUMS_URL % (version, version), file_path)
+    except (downloader.DownloadError, requests.RequestException) as e:
+        print('No md5 sums for %s (%s), only checking the size' % (version, e), flush=True)
+        return None
+    return downloader.read_md5sums(file_path).get(os.path.basename(DUMP_FILE % version))
+
+
+def download(version, dump_path, base_url=BASE_URL):
     file_path = dump_path + DUMP_FILE % version
-    if not os.path.isfile(file_path):
-        params = ['wget', '-nv', '-O', file_path, DUMP_URL % (version, version)]
-        call(params)
-    else:
-        print('File %s already exists, skip downloading' % file_path, flush=True)
+    md5 = download_md5(version, dump_path, base_url)
+    downloader.download(base_url + DUMP_URL % (version, version), file_path, md5=md5)
 
 
 def update(version, dump_path, conn_str, schema, id_name_map):
@@ -81,50 +95,66 @@ def update(version, dump_path, conn_str, schema, id_name_map):
     conn, cursor = Updater.setup_db(conn_str)
     Updater.parse(file_path, id_name_map, conn, cursor, schema)
     conn.commit()
+    # the names the update changed, only now that the rows using them are in
+    id_name_map.flush()
+
+
+def fetch_days(days, dump_path, max_rev_id, base_url=BASE_URL):
+    """Yields (date_str, status, rev_id, apply) for every day after downloading what it needs. apply is set
+    when the dump of that day is downloaded and has to be applied, which only depends on the revision ids of
+    the days before, so this can run ahead of the updates."""
+    for date_str in days:
+        # check if dump is ready to use
+        status = download_status(date_str, dump_path, base_url)
+        if status != STATUS_DONE:
+            yield date_str, status, None, False
+            continue
+
+        # check if this dump has any updates
+        rev_id = int(download_revid(date_str, dump_path, base_url))
+        if rev_id > max_rev_id:
+            # download dump
+            download(date_str, dump_path, base_url)
+            max_rev_id = rev_id
+            yield date_str, status, rev_id, True
+        else:
+            yield date_str, status, rev_id, False
 
 
-def main(max_days, max_rev_id, dump_path, conn_str, schema):
-    id_name_map = {}
-    # this file is required for updates
+def main(max_days, max_rev_id, dump_path, conn_str, schema, prefetch_days=PREFETCH_DAYS, base_url=BASE_URL):
+    # this store is required for updates
     # it is created by main WD import script during first time dump import
-    props_path = dump_path + PROPS_FILE
-    if os.path.isfile(props_path):
+    id_name_map = id_name_store.load(dump_path)
+    if id_name_map is not None:
         print('loading properties from file', flush=True)
-        id_name_map = json.load(open(props_path))
     else:
-        print('ERROR: properties.json file is missing', flush=True)
+        print('ERROR: properties.idx file is missing', flush=True)
         exit(-1)
     print('Loading dumps for', max_days, 'days', max_rev_id, dump_path, flush=True)
 
+    days = []
     day = timedelta(days=1)
     start_date = date.today() - timedelta(days=max_days)
     today = date.today()
     while start_date <= today:
-        # check dump status (if it exists and is ready)
-        date_str = start_date.strftime('%Y%m%d')
+        days.append(start_date.strftime('%Y%m%d'))
+        start_date += day
 
-        # check if dump is ready to use
-        status = download_status(date_str, dump_path)
-        if status == STATUS_DONE:
-            # check if this dump has any updates
-            rev_id_str = download_revid(date_str, dump_path)
-            rev_id = int(rev_id_str)
-            if rev_id > max_rev_id:
-                # download dump
-                download(date_str, dump_path)
-
-                # parse and load dump into DB
-                update(date_str, dump_path, conn_str, schema, id_name_map)
-
-                max_rev_id = rev_id
-                write_revid(dump_path, rev_id)
-            else:
-                print('Skip %s dump as DB already contains that revision' % date_str, flush=True)
+    # the downloads for the next days happen in the background while a day is applied, the updates
+    # themselves and maxrevid.txt still go one day after the other
+    for date_str, status, rev_id, apply in pipeline.prefetch(fetch_days(days, dump_path, max_rev_id, base_url), prefetch_days):
+        if apply:
+            # parse and load dump into DB
+            update(date_str, dump_path, conn_str, schema, id_name_map)
+
+            max_rev_id = rev_id
+            write_revid(dump_path, rev_id)
+        elif status == STATUS_DONE:
+            print('Skip %s dump as DB already contains that revision' % date_str, flush=True)
         else:
             print('Skip %s dump as dumping process is not done yet, status: %s' % (date_str, status), flush=True)
 
-        start_date += day
-
+    id_name_map.compact(id_name_store.COMPACT_AFTER)
     return max_rev_id
 
 
@@ -147,9 +177,13 @@ if __name__ == '__main__':
     parser.add_argument('dump_path', type=str, help='Location where to save BZipped wikipedia dumps')
     parser.add_argument('postgres', type=str, help='postgres connection string')
     parser.add_argument('schema', type=str, help='DB schema containing wikidata tables')
+    parser.add_argument('--prefetch_days', type=int, default=PREFETCH_DAYS,
+                        help='days to download ahead while the updates of a day are applied')
+    parser.add_argument('--base_url', type=str, default=BASE_URL,
+                        help='where the incremental dumps are, a mirror of %s' % BASE_URL)
 
     args = parser.parse_args()
 
     max_rev_id = read_revid(args.dump_path)
 
-    main(args.max_days, max_rev_id, args.dump_path, args.postgres, args.schema)
+    main(args.max_days, max_rev_id, args.dump_path, args.postgres, args.schema, args.prefetch_days, args.base_url)
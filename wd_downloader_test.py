@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date, timedelta
+from unittest import mock
+
+import downloader
+import id_name_store
+import wd_downloader
+
+
+class TestWdDownloader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        id_name_store.write_store(os.path.join(self.dir, id_name_store.STORE_FILE), [('P31', 'instance of')])
+        self.days = [(date.today() - timedelta(days=d)).strftime('%Y%m%d') for d in range(4, -1, -1)]
+        self.status = dict(zip(self.days, ['done:all', 'done:all', 'done:all', 'done:all', 'in-progress']))
+        self.revids = dict(zip(self.days, ['90', '120', '110', '130', '140']))
+        self.downloaded = {day: threading.Event() for day in self.days}
+        self.events = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def download(self, version, dump_path, base_url):
+        self.events.append(('download', version))
+        self.downloaded[version].set()
+
+    def update(self, version, dump_path, conn_str, schema, id_name_map):
+        self.events.append(('update', version, wd_downloader.read_revid(self.dir)))
+        if version == self.days[1]:
+            # the next dump to apply, two days on, is downloaded while this one is being applied
+            self.assertTrue(self.downloaded[self.days[3]].wait(5))
+
+    def test_main(self):
+        with mock.patch.object(wd_downloader, 'download_status', lambda version, path, base_url: self.status[version]), \
+                mock.patch.object(wd_downloader, 'download_revid', lambda version, path, base_url: self.revids[version]), \
+                mock.patch.object(wd_downloader, 'download', self.download), \
+                mock.patch.object(wd_downloader, 'update', self.update):
+            self.assertEqual(wd_downloader.main(4, 100, self.dir, 'dsn', 'import', 2), 130)
+
+        self.assertEqual([e for e in self.events if e[0] == 'update'],
+                         [('update', self.days[1], 0), ('update', self.days[3], 120)])
+        self.assertEqual(sorted(e for e in self.events if e[0] == 'download'),
+                         [('download', self.days[1]), ('download', self.days[3])])
+        self.assertEqual(wd_downloader.read_revid(self.dir), 130)
+
+    def test_missing_day(self):
+        # today's directory usually isn't there yet, that day is skipped like one that's still in progress
+        del self.status[self.days[4]]
+
+        def fetch(url, path, **options):
+            version = url.split('/')[-2]
+            if version not in self.status:
+                raise downloader.NotFound(url)
+            with open(path, 'w') as f:
+                f.write(self.status[version] + '\n')
+
+        with mock.patch.object(downloader, 'download', fetch), \
+                mock.patch.object(wd_downloader, 'download_revid', lambda version, path, base_url: self.revids[version]), \
+                mock.patch.object(wd_downloader, 'download', self.download), \
+                mock.patch.object(wd_downloader, 'update', self.update):
+            self.assertEqual(wd_downloader.download_status(self.days[0], self.dir), 'done:all')
+            self.assertEqual(wd_downloader.download_status(self.days[4], self.dir), '')
+            self.assertEqual(wd_downloader.main(4, 100, self.dir, 'dsn', 'import', 2), 130)
+        self.assertEqual(wd_downloader.read_revid(self.dir), 130)
+
+
+if __name__ == '__main__':
+    unittest.main()
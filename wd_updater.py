@@ -1,20 +1,27 @@
 #!/bin/python3
 
 import argparse
+import itertools
 import subprocess
-import xml.sax
 
 from collections import defaultdict
-import mwparserfromhell
 import psycopg2
 from psycopg2 import extras
 import re
-import json
-import os
+
+import id_name_store
+import json_decoder
+from import_wikidata import entity_name
+import page_extractor
+import pg_copy
+from metrics import Cursor, Metrics, Reader
 
 
 DATE_PARSE_RE = re.compile(r'([-+]?[0-9]+)-([0-9][0-9])-([0-9][0-9])T([0-9][0-9]):([0-9][0-9]):([0-9][0-9])Z?')
 
+# revisions applied and committed at a time
+BATCH_SIZE = 1000
+
 
 def setup_db(connection_string):
   conn = psycopg2.connect(connection_string)
@@ -63,8 +70,10 @@ def map_value(value, id_name_map):
 
 
 def parse_props(d, id_name_map):
+  """(wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties) for an entity. Entities
+     we don't keep only get their wikidata_id, everything is None if we can't make sense of it."""
   if type(d) != dict:
-    return None, None, None, None, None, None
+    return None, None, None, None, None, None, None
   wikidata_id = d.get('id')
   labels = None
   title = None
@@ -80,7 +89,7 @@ def parse_props(d, id_name_map):
     sitelinks = [d.get('sitelinks')[x]['title'] for x in d.get('sitelinks', {})]
     wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
   except:
-    return None, None, None, None, None, None
+    return None, None, None, None, None, None, None
 
   description = None
   try:
@@ -118,10 +127,17 @@ def parse_props(d, id_name_map):
 
     return wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties
 
-  return None, None, None, None, None, None
+  return wikidata_id, None, None, None, None, None, None
 
 
 def update_DB(wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties, conn, cursor, schema):
+  # the english wikipedia page moved here from another entity, that one is gone like with delete_one
+  cursor.execute('WITH moved AS (DELETE FROM %s.wikidata ' % schema +
+                 'WHERE wikipedia_id = %s AND wikidata_id <> %s RETURNING wikidata_id), ' +
+                 'geo AS (DELETE FROM %s.geo WHERE wikidata_id IN (SELECT wikidata_id FROM moved)), ' % schema +
+                 'labels AS (DELETE FROM %s.labels WHERE wikidata_id IN (SELECT wikidata_id FROM moved)) ' % schema +
+                 'DELETE FROM %s.instance WHERE wikidata_id IN (SELECT wikidata_id FROM moved)' % schema,
+                 (wikipedia_id, wikidata_id))
   cursor.execute('INSERT INTO %s.wikidata (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties)' % schema +
                  'VALUES (%s, %s, %s, %s, %s, %s, %s)'
                  'ON CONFLICT (wikidata_id) DO UPDATE SET wikipedia_id = EXCLUDED.wikipedia_id, title = EXCLUDED.title, labels = EXCLUDED.labels, sitelinks = EXCLUDED.sitelinks,'
@@ -155,76 +171,209 @@ def update_DB(wikipedia_id, title, wikidata_id, labels, sitelinks, description,
                  (wikidata_id, ))
 
 
-class WikiXmlHandler(xml.sax.handler.ContentHandler):
-  def __init__(self, cursor, conn, schema, id_name_map):
-    xml.sax.handler.ContentHandler.__init__(self)
-    self._db_cursor = cursor
-    self._db_conn = conn
-    self._db_schema = schema
-    self._id_name_map = id_name_map
-    self._count = 0
-    self.reset()
-
-  def reset(self):
-    self._buffer = []
-    self._state = None
-    self._values = {}
-
-  def startElement(self, name, attrs):
-    if name in ('title', 'text', 'id'):
-      self._state = name
-
-  def endElement(self, name):
-    if name == self._state:
-      if name not in self._values:
-        self._values[name] = ''.join(self._buffer)
-      self._state = None
-      self._buffer = []
-
-    if name == 'revision':
-      try:
-        data = self._values['text']
-        data = json.loads(data)
-
-        wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties = parse_props(
-            data, self._id_name_map)
-        # print(wikipedia_id, title, wikidata_id, description)
-        if wikipedia_id:
-            update_DB(wikipedia_id, title, wikidata_id, labels, sitelinks, description,
-                      properties, self._db_conn, self._db_cursor, self._db_schema)
-        else:
-            # sometimes records get removed/merged
-            delete_one(wikidata_id, self._db_conn, self._db_cursor, self._db_schema)
-
-        self._count += 1
-        if self._count % 1000 == 0:
-            print(self._count, wikidata_id, flush=True)
-            self._db_conn.commit()
-      except mwparserfromhell.parser.ParserError:
-        print('mwparser error for:', self._values['title'], flush=True)
-      except ValueError:
-        # print('failed to parse json', wikidata_id)
-        pass
-      self._values = {}
-
-    if name == 'page':
-      self.reset()
-
-  def characters(self, content):
-    if self._state:
-      self._buffer.append(content)
-
-
-def parse(dump, id_name_map, conn, cursor, schema):
-  parser = xml.sax.make_parser()
-  xmlHandler = WikiXmlHandler(cursor, conn, schema, id_name_map)
-  parser.setContentHandler(xmlHandler)
-
-  for line in subprocess.Popen(['bzcat'], stdin=open(dump, 'r'), stdout=subprocess.PIPE).stdout:
+def delete_one(wikidata_id, conn, cursor, schema):
+  for table in 'wikidata', 'geo', 'labels', 'instance':
+    cursor.execute('DELETE FROM %s.%s ' % (schema, table) + 'WHERE wikidata_id = %s', (wikidata_id, ))
+
+
+def update_name(d, page_title, id_name_map):
+  """Keeps the id -> name map current with what the entity is called now, so that values pointing at new
+     entities resolve. It goes before the entity's own claims get mapped, an entity can point at itself."""
+  if 'id' in d:
+    name = entity_name(d) if isinstance(d.get('labels'), dict) else None
+    if name:
+      id_name_map[d['id']] = name
+    else:
+      id_name_map.pop(d['id'], None)
+  else:
+    # merged into another entity, nothing can point at this one anymore
+    id_name_map.pop(page_title.rsplit(':', 1)[-1], None)
+
+
+def revision_op(text, page_title, id_name_map):
+  """What a revision does: (wikidata_id, row) with the values for update_DB, or (wikidata_id, None) when the
+     entity should go. Raises ValueError for revisions we can't use."""
+  data = json_decoder.loads_entity(text)
+  if type(data) != dict:
+    raise ValueError('not an entity')
+  update_name(data, page_title, id_name_map)
+
+  wikidata_id, wikipedia_id, title, labels, sitelinks, description, properties = parse_props(data, id_name_map)
+  if wikipedia_id:
+    return wikidata_id, (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties)
+  if wikidata_id:
+    # no english wikipedia page (anymore), so it isn't one of ours
+    return wikidata_id, None
+  if not 'id' in data:
+    # what's left after a merge is a redirect that only has the id in the page title (Q42, Property:P31)
+    return page_title.rsplit(':', 1)[-1], None
+  raise ValueError('can\'t parse %s' % page_title)
+
+
+def apply_revision(record, id_name_map, conn, cursor, schema):
+  """Writes one revision of an entity, returns its wikidata id. Raises ValueError for revisions we can't use."""
+  wikidata_id, row = revision_op(record.text, record.title, id_name_map)
+  if row:
+      update_DB(*row, conn, cursor, schema)
+  else:
+      # sometimes records get removed/merged
+      delete_one(wikidata_id, conn, cursor, schema)
+  return wikidata_id
+
+
+BATCH_COLUMNS = ('wikidata_id', 'deleted', 'wikipedia_id', 'title', 'labels', 'sitelinks', 'description', 'properties',
+                 'label_union', 'geo', 'instance')
+BATCH_TYPES = ('text', 'bool', 'text', 'text', 'jsonb', 'jsonb', 'text', 'jsonb', 'jsonb', 'jsonb', 'jsonb')
+
+
+def collapse(ops):
+  """Folds the (wikidata_id, row) ops of a batch into one row per entity for the batch table, which apply_batch
+     turns into the same end state as running update_DB and delete_one for each op in turn:
+     - deleted if any op removed the entity, the deletes go first
+     - the row of the last upsert after the last delete, if there is one
+     - the labels of all those upserts; update_DB only ever adds labels
+     - geo and instance come from the last of those upserts that had them, update_DB leaves them alone otherwise
+  """
+  entities = {}
+  for wikidata_id, row in ops:
+    if row is None or not wikidata_id in entities:
+      deleted = row is None or (wikidata_id in entities and entities[wikidata_id]['deleted'])
+      entities[wikidata_id] = {'deleted': deleted, 'row': None, 'labels': {}, 'geo': None, 'instance': None}
+    if row is None:
+      continue
+    entity = entities[wikidata_id]
+    entity['row'] = row
+    properties = row[6]
+    for label in row[3] or ():
+      entity['labels'][label] = True
+    if 'coordinate location' in properties:
+      entity['geo'] = {'coordinate location': properties['coordinate location']}
+    if type(properties.get('instance of')) in (list, str):
+      entity['instance'] = {'instance of': properties['instance of']}
+
+  rows = []
+  for wikidata_id, entity in entities.items():
+    if entity['row']:
+      wikipedia_id, title, _, labels, sitelinks, description, properties = entity['row']
+      label_union = list(entity['labels'])
+    else:
+      wikipedia_id = title = labels = sitelinks = description = properties = label_union = None
+    rows.append((wikidata_id, entity['deleted'], wikipedia_id, title, labels, sitelinks, description, properties,
+                 label_union, entity['geo'], entity['instance']))
+  return rows
+
+
+def create_batch_table(cursor):
+  cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wd_batch ('
+                 '    wikidata_id TEXT,'
+                 '    deleted BOOLEAN,'
+                 '    wikipedia_id TEXT,'
+                 '    title TEXT,'
+                 '    labels JSONB,'
+                 '    sitelinks JSONB,'
+                 '    description TEXT,'
+                 '    properties JSONB,'
+                 '    label_union JSONB,'
+                 '    geo JSONB,'
+                 '    instance JSONB'
+                 ') ON COMMIT DELETE ROWS')
+
+
+def apply_batch(ops, cursor, schema):
+  """update_DB and delete_one for a whole batch of ops at once: COPY the collapsed rows into a temp table and
+     apply them with a few set based statements."""
+  create_batch_table(cursor)
+  writer = pg_copy.BinaryCopyWriter(cursor, 'wd_batch', BATCH_COLUMNS, BATCH_TYPES, len(ops) + 1)
+  for row in collapse(ops):
+    writer.write(row)
+  writer.flush()
+
+  for table in 'wikidata', 'geo', 'labels', 'instance':
+    cursor.execute('DELETE FROM %s.%s t USING wd_batch b WHERE b.deleted AND t.wikidata_id = b.wikidata_id' % (schema, table))
+  # pages that moved to an entity of the batch, the entity they moved from could come after it in the insert.
+  # That one is gone like with delete_one, unless it has a row in the batch too and so comes straight back
+  cursor.execute('WITH moved AS (DELETE FROM %s.wikidata t USING wd_batch b ' % schema +
+                 'WHERE t.wikipedia_id = b.wikipedia_id AND t.wikidata_id <> b.wikidata_id RETURNING t.wikidata_id), '
+                 'gone AS (SELECT wikidata_id FROM moved m WHERE NOT EXISTS ('
+                 '  SELECT 1 FROM wd_batch b WHERE b.wikidata_id = m.wikidata_id AND b.wikipedia_id IS NOT NULL)), '
+                 'geo AS (DELETE FROM %s.geo WHERE wikidata_id IN (SELECT wikidata_id FROM gone)), ' % schema +
+                 'labels AS (DELETE FROM %s.labels WHERE wikidata_id IN (SELECT wikidata_id FROM gone)) ' % schema +
+                 'DELETE FROM %s.instance WHERE wikidata_id IN (SELECT wikidata_id FROM gone)' % schema)
+
+  cursor.execute('INSERT INTO %s.wikidata (wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties) ' % schema +
+                 'SELECT wikipedia_id, title, wikidata_id, labels, sitelinks, description, properties '
+                 'FROM wd_batch WHERE wikipedia_id IS NOT NULL '
+                 'ON CONFLICT (wikidata_id) DO UPDATE SET wikipedia_id = EXCLUDED.wikipedia_id, title = EXCLUDED.title, labels = EXCLUDED.labels, sitelinks = EXCLUDED.sitelinks,'
+                 'description = EXCLUDED.description, properties = EXCLUDED.properties;')
+
+  cursor.execute('INSERT into %s.geo (wikidata_id, geometry) ' % schema +
+                 'SELECT wikidata_id, ST_SETSRID(ST_MAKEPOINT((geo->\'coordinate location\'->>\'lng\')::DECIMAL, '
+                 '(geo->\'coordinate location\'->>\'lat\')::DECIMAL), 4326) AS geometry '
+                 'FROM wd_batch WHERE geo IS NOT NULL '
+                 'ON CONFLICT (wikidata_id) DO UPDATE SET geometry = EXCLUDED.geometry;')
+
+  cursor.execute('INSERT INTO %s.labels (label, wikidata_id) SELECT distinct(jsonb_array_elements_text(label_union)), wikidata_id ' % schema +
+                 'FROM wd_batch WHERE label_union IS NOT NULL ON CONFLICT (wikidata_id, label) DO NOTHING;')
+
+  cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
+                 'SELECT wikidata_id, lower(instance->>\'instance of\')::jsonb '
+                 'FROM wd_batch WHERE jsonb_typeof(instance->\'instance of\') = \'array\' '
+                 'ON CONFLICT (wikidata_id) DO UPDATE SET instance_of = EXCLUDED.instance_of;')
+  cursor.execute('INSERT INTO %s.instance (wikidata_id, instance_of) ' % schema +
+                 'SELECT wikidata_id, jsonb_build_array(lower(instance->>\'instance of\')) '
+                 'FROM wd_batch WHERE jsonb_typeof(instance->\'instance of\') = \'string\' '
+                 'ON CONFLICT (wikidata_id) DO UPDATE SET instance_of = EXCLUDED.instance_of;')
+
+
+def latest_revisions(records, stats):
+  """The highest revision of every page, counting the ones passed over in stats['skipped']. The revisions of a
+     page come one after the other, a revision whose text was deleted only counts if there's nothing else."""
+  for _, revisions in itertools.groupby(records, key=lambda record: record.id):
+    revisions = list(revisions)
+    stats['skipped'] += len(revisions) - 1
+    yield max([record for record in revisions if record.text] or revisions, key=lambda record: record.revision_id)
+
+
+def parse(dump, id_name_map, conn, cursor, schema, batch_size=BATCH_SIZE, metrics=None):
+  """Applies the latest revision of every entity in the dump, batch_size at a time with apply_batch. With a
+     batch_size of 1 they're written one by one with update_DB and delete_one.
+
+     The metrics have the time spent waiting on bzcat (decompress), reading the revisions (parse), decoding
+     and mapping them (transform), writing them (load) and waiting on postgres (db)."""
+  metrics = metrics or Metrics('wd_updater')
+  cursor = Cursor(cursor, metrics)
+  count = 0
+  ops = []
+  stats = {'skipped': 0}
+  commit_every = batch_size if batch_size > 1 else BATCH_SIZE
+  records = page_extractor.iter_pages(Reader(subprocess.Popen(['bzcat'], stdin=open(dump, 'r'),
+                                                              stdout=subprocess.PIPE).stdout, metrics))
+  for record in metrics.iterate('parse', latest_revisions(records, stats)):
     try:
-      parser.feed(line)
-    except StopIteration:
-      break
+      if batch_size <= 1:
+        with metrics.timer('load', 1):
+          wikidata_id = apply_revision(record, id_name_map, conn, cursor, schema)
+      else:
+        with metrics.timer('transform', 1):
+          wikidata_id, row = revision_op(record.text, record.title, id_name_map)
+        ops.append((wikidata_id, row))
+    except ValueError:
+      # print('failed to parse json', wikidata_id)
+      continue
+    count += 1
+    if count % commit_every == 0:
+      if ops:
+        with metrics.timer('load', len(ops)):
+          apply_batch(ops, cursor, schema)
+        ops = []
+      print(count, wikidata_id, stats['skipped'], 'older revisions skipped', flush=True)
+      metrics.commit(conn)
+      id_name_map.flush()
+  if ops:
+    with metrics.timer('load', len(ops)):
+      apply_batch(ops, cursor, schema)
+  print(count, 'entities updated,', stats['skipped'], 'older revisions skipped,', id_name_map.changes,
+        'names changed since the last compaction', flush=True)
 
 
 if __name__ == '__main__':
@@ -232,23 +381,36 @@ if __name__ == '__main__':
   parser.add_argument('postgres', type=str, help='postgres connection string')
   parser.add_argument('schema', type=str, help='DB schema containing wikidata tables')
   parser.add_argument('dump', type=str, help='BZipped wikipedia dump')
-
-  id_name_map = {}
-  # this file is required for updates
+  parser.add_argument('--json', type=str, choices=json_decoder.BACKENDS, default=None,
+                      help='json library to decode the entities with, by default the fastest one installed')
+  parser.add_argument('--batch_size', type=int, default=BATCH_SIZE,
+                      help='revisions to apply at a time, 1 writes them one by one')
+  parser.add_argument('--metrics_json', type=str, default=None,
+                      help='append the throughput of every stage to this file as json lines')
+  parser.add_argument('--metrics_textfile', type=str, default=None,
+                      help='keep the same in this .prom file for the textfile collector of the node exporter')
+  parser.add_argument('--metrics_interval', type=int, default=None,
+                      help='seconds between writes of the metrics, a minute by default')
+
+  # this store is required for updates
   # it is created by main WD import script during first time dump import
-  props_path = './properties.json'
-  if os.path.isfile(props_path):
+  id_name_map = id_name_store.load()
+  if id_name_map is not None:
       print('loading properties from file', flush=True)
-      id_name_map = json.load(open(props_path))
   else:
-      print('ERROR: properties.json file is missing', flush=True)
+      print('ERROR: properties.idx file is missing', flush=True)
       exit(-1)
 
   args = parser.parse_args()
+  update_metrics = Metrics('wd_updater', args.metrics_json, args.metrics_textfile, args.metrics_interval)
+  print('decoding json with', json_decoder.use(args.json), flush=True)
   print('Setup db', flush=True)
   conn, cursor = setup_db(args.postgres)
 
   print('Parsing...', flush=True)
-  parse(args.dump, id_name_map, conn, cursor, args.schema)
+  parse(args.dump, id_name_map, conn, cursor, args.schema, args.batch_size, update_metrics)
 
-  conn.commit()
+  update_metrics.commit(conn)
+  id_name_map.flush()
+  id_name_map.compact(id_name_store.COMPACT_AFTER)
+  update_metrics.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+
+from page_extractor import PageRecord
+from wd_updater import apply_batch, collapse, latest_revisions, revision_op, update_DB
+
+NAMES = {'P31': 'instance of', 'P625': 'coordinate location', 'Q5': 'human'}
+
+
+def row(wikidata_id, labels, properties):
+  return ('T' + wikidata_id, labels[0], wikidata_id, labels, ['T' + wikidata_id], None, properties)
+
+
+class FakeCursor():
+  def __init__(self):
+    self.sql = []
+
+  def execute(self, sql, params=None):
+    self.sql.append(sql)
+
+  def copy_expert(self, sql, f):
+    self.sql.append(sql)
+
+
+class TestWdUpdater(unittest.TestCase):
+  def test_revision_op(self):
+    entity = {'id': 'Q42', 'labels': {'en': {'value': 'Douglas Adams'}}, 'descriptions': {},
+              'sitelinks': {'enwiki': {'title': 'Douglas Adams'}},
+              'claims': {'P31': [{'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q5'}}},
+                                  'rank': 'normal'}]}}
+    wikidata_id, values = revision_op(json.dumps(entity), 'Q42', NAMES)
+    self.assertEqual(wikidata_id, 'Q42')
+    self.assertEqual(values[:6], ('Douglas Adams', 'Douglas Adams', 'Q42', ['Douglas Adams'], ['Douglas Adams'], None))
+    self.assertEqual(values[6]['instance of'], 'human')
+
+    del entity['sitelinks']['enwiki']
+    self.assertEqual(revision_op(json.dumps(entity), 'Q42', NAMES), ('Q42', None))
+    self.assertEqual(revision_op('{"entity": "P7", "redirect": "P8"}', 'Property:P7', NAMES), ('P7', None))
+    self.assertRaises(ValueError, revision_op, '', 'Q1', NAMES)
+    self.assertRaises(ValueError, revision_op, '[1]', 'Q1', NAMES)
+
+  def test_names_kept_current(self):
+    names = dict(NAMES, Q1='gone', P7='old name')
+    new = {'id': 'Q99', 'labels': {'en': {'value': 'New thing'}}, 'sitelinks': {},
+           'claims': {'P31': [{'mainsnak': {'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q99'}}},
+                               'rank': 'normal'}]}}
+    revision_op(json.dumps(new), 'Q99', names)
+    self.assertEqual(names['Q99'], 'New thing')
+    # with an english wikipedia page that's its name, and it can already be used by its own claims
+    new['sitelinks'] = {'enwiki': {'title': 'New Thing (band)'}}
+    _, values = revision_op(json.dumps(new), 'Q99', names)
+    self.assertEqual(names['Q99'], 'New Thing (band)')
+    self.assertEqual(values[6]['instance of'], 'New Thing (band)')
+
+    revision_op('{"id": "Q1", "labels": {}, "sitelinks": {}, "claims": {}}', 'Q1', names)
+    revision_op('{"entity": "P7", "redirect": "P8"}', 'Property:P7', names)
+    self.assertNotIn('Q1', names)
+    self.assertNotIn('P7', names)
+
+  def test_collapse(self):
+    a1 = row('Q1', ['a', 'b'], {'coordinate location': {'lat': 1, 'lng': 2}, 'instance of': ['human']})
+    a2 = row('Q1', ['b', 'c'], {'instance of': 5})
+    b1 = row('Q2', ['x'], {'instance of': 'city'})
+    c1 = row('Q3', ['y'], {})
+    rows = collapse([('Q1', a1), ('Q2', b1), ('Q3', c1), ('Q1', a2), ('Q2', None), ('Q3', None), ('Q3', c1)])
+    self.assertEqual(rows, [
+      # the last row, but geo and instance of the revision that had them and the labels of both
+      ('Q1', False, 'TQ1', 'b', ['b', 'c'], ['TQ1'], None, {'instance of': 5}, ['a', 'b', 'c'],
+       {'coordinate location': {'lat': 1, 'lng': 2}}, {'instance of': ['human']}),
+      ('Q2', True, None, None, None, None, None, None, None, None, None),
+      # deleted and then added again, the deletes go first
+      ('Q3', True, 'TQ3', 'y', ['y'], ['TQ3'], None, {}, ['y'], None, None),
+    ])
+
+  def test_sitelink_moves(self):
+    # Q2 gets the page of Q1, whose row has to go before Q2's goes in whatever order they're inserted
+    cursor = FakeCursor()
+    page = ('TQ1',) + row('Q2', ['a'], {})[1:]
+    apply_batch([('Q2', page), ('Q1', row('Q1', ['b'], {}))], cursor, 'wd')
+    moved = [i for i, sql in enumerate(cursor.sql) if 't.wikipedia_id = b.wikipedia_id AND t.wikidata_id <> b.wikidata_id' in sql]
+    inserted = [i for i, sql in enumerate(cursor.sql) if sql.startswith('INSERT INTO wd.wikidata')]
+    self.assertEqual(len(moved), 1)
+    self.assertLess(moved[0], inserted[0])
+    # and the rest of the entity it moved from goes too
+    for table in 'geo', 'labels', 'instance':
+      self.assertIn('DELETE FROM wd.%s WHERE wikidata_id IN (SELECT wikidata_id FROM gone)' % table, cursor.sql[moved[0]])
+
+    cursor = FakeCursor()
+    update_DB(*row('Q2', ['a'], {}), None, cursor, 'wd')
+    self.assertIn('DELETE FROM wd.wikidata WHERE wikipedia_id = %s AND wikidata_id <> %s', cursor.sql[0])
+    for table in 'geo', 'labels', 'instance':
+      self.assertIn('DELETE FROM wd.%s WHERE wikidata_id IN (SELECT wikidata_id FROM moved)' % table, cursor.sql[0])
+    self.assertTrue(cursor.sql[1].startswith('INSERT INTO wd.wikidata'))
+
+  def test_latest_revisions(self):
+    records = [PageRecord(1, 0, 'Q1', 10, '{}', 0), PageRecord(1, 0, 'Q1', 12, '{}', 0), PageRecord(1, 0, 'Q1', 11, '{}', 0),
+               PageRecord(2, 0, 'Q2', 20, '{}', 0),
+               PageRecord(3, 0, 'Q3', 30, '{}', 0), PageRecord(3, 0, 'Q3', 31, '', 0),
+               PageRecord(4, 0, 'Q4', 40, '', 0)]
+    stats = {'skipped': 0}
+    self.assertEqual([record.revision_id for record in latest_revisions(records, stats)], [12, 20, 30, 40])
+    self.assertEqual(stats['skipped'], 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
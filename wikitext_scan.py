@@ -0,0 +1,97 @@
+#!/bin/python3
+
+import re
+
+# tags mwparserfromhell doesn't parse the contents of
+UNPARSED_TAGS = ('categorytree', 'ce', 'chem', 'gallery', 'graph', 'hiero', 'imagemap', 'inputbox', 'math',
+                 'nowiki', 'pre', 'score', 'section', 'source', 'syntaxhighlight', 'templatedata', 'timeline')
+
+RE_TOKEN = re.compile(r'<!--|\{\{+|\}\}+|\[\[|\]\]|\||<(%s)\b[^>]*?(/?)>' % '|'.join(UNPARSED_TAGS), re.I)
+RE_COMMENT = re.compile(r'<!--.*?(-->|$)', re.S)
+# mwparserfromhell reads a template with any of these in its name as text
+RE_BAD_NAME = re.compile(r'[\[\]<>]|\n\s*\S')
+
+TEMPLATE = 2
+ARGUMENT = 3
+LINK = 0
+
+
+def _open_braces(count):
+  """How mwparserfromhell reads a run of {: templates on the outside, {{{arguments}}} inside."""
+  if count % 3 == 0:
+    return [ARGUMENT] * (count // 3)
+  if count % 3 == 2:
+    return [TEMPLATE] + [ARGUMENT] * (count // 3)
+  return [TEMPLATE, TEMPLATE] + [ARGUMENT] * (count // 3 - 1)
+
+
+def scan(text):
+  """Single pass over wikitext that returns (templates, template_names, links): the source of every
+     template, nested ones included, their names and the titles of all wikilinks. Meant to give what
+     mwparserfromhell's filter_templates/filter_wikilinks give for real pages without building a tree.
+  """
+  templates = []
+  names = []
+  links = []
+  # frames of [kind, start, end of name]
+  stack = []
+  pos = 0
+  length = len(text)
+  while pos < length:
+    m = RE_TOKEN.search(text, pos)
+    if not m:
+      break
+    token = m.group(0)
+    pos = m.end()
+    first = token[0]
+    if token == '<!--':
+      end = text.find('-->', pos)
+      pos = length if end < 0 else end + 3
+    elif first == '<':
+      if m.group(2):
+        continue
+      end = re.compile(r'</%s\s*>' % m.group(1), re.I).search(text, pos)
+      if end:
+        pos = end.end()
+    elif first == '{':
+      start = m.start()
+      for kind in _open_braces(len(token)):
+        stack.append([kind, start, None])
+        start += kind
+    elif first == '}':
+      count = len(token)
+      at = m.start()
+      while count >= 2 and stack:
+        kind, start, name_end = stack[-1]
+        if kind == LINK:
+          if all(frame[0] == LINK for frame in stack):
+            break
+          # an unclosed link inside a template is just text
+          stack.pop()
+          continue
+        if kind == ARGUMENT and count >= 3:
+          stack.pop()
+          count -= 3
+          at += 3
+          continue
+        if kind == ARGUMENT:
+          # {{{name}} is a { followed by a template
+          start += 1
+        stack.pop()
+        count -= 2
+        at += 2
+        name = RE_COMMENT.sub('', text[start + 2:name_end or at - 2]).strip()
+        if name and not RE_BAD_NAME.search(name):
+          templates.append(text[start:at])
+          names.append(name)
+    elif token == '[[':
+      stack.append([LINK, m.start(), None])
+    elif token == ']]':
+      if stack and stack[-1][0] == LINK:
+        _, start, name_end = stack.pop()
+        title = text[start + 2:name_end or m.start()]
+        if '\n' not in title:
+          links.append(title)
+    elif stack and stack[-1][2] is None:
+      stack[-1][2] = m.start()
+  return templates, names, links
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import unittest
+
+from compare_analyzers import compare
+from import_wikipedia import read_pages
+from import_wikipedia_test import DUMP
+from wikitext_scan import scan
+
+TRICKY = [
+  "{{Infobox person <!-- c -->\n| name = {{nowrap|A B}}\n| x = [[Category:Nope]]}} text [[Category:Foo of bar|sort]]",
+  "<!-- {{hidden}} [[Category:Hidden]] --> <nowiki>{{no}}</nowiki> {{{arg|{{dflt}}}}} {{ lower }}",
+  "{| class=wikitable\n|-\n| a || b\n|}\n{{cite web|url=http://x|title=[[a|b]]}}",
+  "{{{{{x}}}}} [[File:a.png|thumb|caption [[link]] {{tmpl}}]] [[ Category:X]] [[Category:Y\nZ]]",
+  "{{a|[[b}} [[Category:Q]] <math>{{m}}</math> <ref name=x/> {{b}}",
+  "{{foo}} }} {{ {{bar}} [[Category:Cities in the Netherlands]] {{x<ref>y</ref>}}",
+]
+
+
+class TestWikitextScan(unittest.TestCase):
+  def test_scan(self):
+    templates, names, links = scan('{{Infobox city|name={{lang|nl|Den Haag}}}} [[Category:Cities|x]] <!-- {{no}} -->')
+    self.assertEqual(templates, ['{{lang|nl|Den Haag}}', '{{Infobox city|name={{lang|nl|Den Haag}}}}'])
+    self.assertEqual(names, ['lang', 'Infobox city'])
+    self.assertEqual(links, ['Category:Cities'])
+
+  def test_agrees_with_mwparser(self):
+    for _, title, text, _ in read_pages(line + '\n' for line in DUMP.split('\n')):
+      self.assertEqual(compare(title, text), [], title)
+    for text in TRICKY:
+      self.assertEqual(compare('Tricky', text), [], text)
+
+if __name__ == '__main__':
+  unittest.main()
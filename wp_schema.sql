@@ -18,7 +18,7 @@ CREATE TABLE import.page (
   "page_id" integer NOT NULL ,
   "page_namespace" integer NOT NULL DEFAULT '0',
   "page_title" TEXT NOT NULL DEFAULT '',
-  "page_restrictions" TEXT NOT NULL,
+  "page_restrictions" TEXT NOT NULL DEFAULT '',
   "page_is_redirect" integer NOT NULL DEFAULT '0',
   "page_is_new" integer NOT NULL DEFAULT '0',
   "page_random" float NOT NULL DEFAULT '0',